@@ -0,0 +1,345 @@
+import asyncio
+import os
+import time
+from datetime import datetime
+from async_rate_limited_fetcher import (AsyncRateLimitedFetcher, ASYNC_RETRYABLE_EXCEPTIONS,
+                                        create_client_session)
+from attachment_file import AttachmentFile, ATTACHMENT_CHUNK_SIZE
+from attachment_policy import AttachmentTooLarge
+from fdms_archive_downloader import (FDMSArchiveDownloader, API_DATE_FORMAT, DEAD_LETTER_ERRORS,
+                                     MAX_ITEMS_PER_RESULT_BATCH, page_data, to_filter_date)
+from http_sessions import http_settings
+from request_retry import TransientRequestError, is_transient_status
+
+"""
+An asyncio version of the FDMSArchiveDownloader
+
+AsyncFDMSArchiveDownloader(logger, api_key, docket_id, output_directory,
+                           resume_download, concurrency)
+
+Runs the same stages (and writes the same output and resume info) as the
+FDMSArchiveDownloader, but keeps up to `concurrency` comment requests
+in flight on a single thread. Attachments are streamed to disk the same way
+(see AttachmentFile).
+"""
+
+
+class AsyncFDMSArchiveDownloader(FDMSArchiveDownloader):
+    def __init__(self, logger, api_key, docket_id, output_directory, resume_download=True, concurrency=100,
+                 config=None):
+        self._concurrency = max(1, concurrency)
+        super().__init__(logger, api_key, docket_id,
+                         output_directory, resume_download, config=config)
+
+    def _create_sessions(self, api_key, fetcher=None):
+        self._fetcher = AsyncRateLimitedFetcher(self._logger, 1000, api_key,
+                                                http_settings(
+                                                    self._config, 'api'),
+                                                self._response_cache, self._metrics,
+                                                self._retry_policy)
+        self._attachment_settings = http_settings(
+            self._config, 'attachments')
+        self._attachment_session = None
+
+    @property
+    def attachment_session(self):
+        if self._attachment_session is None:
+            self._attachment_session = create_client_session(
+                self._attachment_settings)
+        return self._attachment_session
+
+    async def _get_all_data_pages(self, resource_url, query_params={}, include_page_count=False):
+        ret = []
+        page_number = 1
+        while True:
+            these_params = {**query_params, 'page[number]': page_number}
+            this_response = await self._fetcher.get_or_wait(
+                resource_url, these_params)
+            items, has_next_page = page_data(this_response.data)
+            ret.extend(items)
+            if not has_next_page:
+                break
+            page_number = page_number + 1
+
+        if include_page_count:
+            return ret, page_number
+        return ret
+
+    async def _get_all_data_pages_for_comments(self, resource_url, document_object_id):
+        query_params = self._comments_query_params(document_object_id)
+        ret = await self._get_all_data_pages(resource_url, query_params)
+
+        if len(ret) < MAX_ITEMS_PER_RESULT_BATCH:
+            return ret
+
+        object_id_hash = {}
+        for ret_item in ret:
+            if not ret_item:
+                continue
+            object_id_hash[ret_item["id"]] = True
+
+        while True:
+            last_modified_date = ret[-1]["attributes"]["lastModifiedDate"]
+            query_params["filter[lastModifiedDate][ge]"] = to_filter_date(
+                last_modified_date)
+            this_batch = await self._get_all_data_pages(resource_url, query_params)
+
+            if len(this_batch) == 0:
+                break
+
+            for item in this_batch:
+                if item["id"] in object_id_hash:
+                    continue
+                ret.append(item)
+                object_id_hash[item["id"]] = True
+
+            if len(this_batch) < MAX_ITEMS_PER_RESULT_BATCH:
+                break
+
+        return ret
+
+    async def _get_comment_details_and_attachments(self, comment_id):
+        query_params = {
+            "include": "attachments"
+        }
+        details_response = await self._fetcher.get_or_wait(
+            f'{self._api_base}/comments/{comment_id}', query_params)
+        return details_response.data
+
+    async def _save_attachments(self, comments_dir, comment_id, attachments):
+        self._logger.info(
+            f"-- saving attachments for: {comment_id}, {len(attachments)} attachments...")
+        attachment_base, full_attachment_path = None, None
+
+        ret = []
+        for file_url, filename, size in self._attachment_file_urls(attachments):
+            if self._defer_attachment(file_url, size):
+                ret.append(file_url)
+                continue
+            if full_attachment_path is None:
+                attachment_base, full_attachment_path = self._attachment_path(
+                    comments_dir, comment_id)
+            full_path = os.path.join(full_attachment_path, filename)
+            try:
+                if not await self._download_attachment(file_url, full_path):
+                    continue
+            except AttachmentTooLarge as e:
+                self._defer_attachment(file_url, e.size)
+                ret.append(file_url)
+                continue
+            ret.append(f'{attachment_base}/{filename}')
+
+        return ret
+
+    async def _download_attachment(self, file_url, full_path, attempts=2):
+        attachment = AttachmentFile(full_path)
+        if attachment.is_complete():
+            self._metrics.increment('attachments_already_complete')
+            return True
+        if self._attachment_from_store(file_url, full_path):
+            return True
+        return await self._retry_policy.call_async('attachments', lambda: self._stream_attachment(
+            file_url, full_path, attachment, attempts), ASYNC_RETRYABLE_EXCEPTIONS)
+
+    async def _stream_attachment(self, file_url, full_path, attachment, attempts):
+        for _ in range(attempts):
+            started = time.time()
+            received = 0
+            async with self.attachment_session.get(file_url, headers=attachment.request_headers(),
+                                                 allow_redirects=True) as response:
+                self._check_attachment_size(
+                    file_url, response.status, response.headers)
+                if is_transient_status(response.status):
+                    self._metrics.observe_request(
+                        'attachments', time.time() - started, 0, response.status)
+                    raise TransientRequestError(file_url, response.status)
+                if not attachment.start(response.status, response.headers):
+                    self._metrics.observe_request(
+                        'attachments', time.time() - started, 0, response.status)
+                    if response.status == 416:
+                        continue
+                    return False
+                try:
+                    async for chunk in response.content.iter_chunked(ATTACHMENT_CHUNK_SIZE):
+                        attachment.write(chunk)
+                        received = received + len(chunk)
+                except BaseException:
+                    attachment.abort()
+                    raise
+                self._metrics.observe_request(
+                    'attachments', time.time() - started, received, response.status)
+            if attachment.finish():
+                self._add_attachment_to_store(file_url, full_path)
+                return True
+            self._logger.info(
+                f'-- incomplete attachment download: {file_url} ({attachment.error})')
+        return False
+
+    async def _get_docket_details(self):
+        docket_response = await self._fetcher.get_or_wait(
+            f'{self._api_base}/dockets/{self._docket_id}')
+        return docket_response.data['data']
+
+    async def _get_docket_documents(self):
+        if not self._resume or 'document_ids' not in self._resume_info:
+            self._start_listing()
+            docket_documents = await self._get_all_data_pages(
+                f'{self._api_base}/documents', self._documents_query_params())
+            return self._record_docket_documents(docket_documents)
+        self._logger.info('- already have document ids, skipping...')
+        return self._resume_info['document_ids']
+
+    async def _gather_document_comment_ids(self, document):
+        document_id = document['id']
+        document_object_id = document['document_object_id']
+        document_object_key = f"doc_{document_object_id}"
+        if not self._resume or document_object_key not in self._resume_info:
+            self._logger.info(
+                f'-------- getting comments for document: {document_id}, objectId: {document_object_id}')
+            comments = await self._get_all_data_pages_for_comments(
+                f'{self._api_base}/comments', document_object_id)
+            return self._record_document_comments(
+                document_id, document_object_id, comments)
+        self._logger.info(
+            f"- already have document info for {document_object_key} - skipping...")
+        return list(self._document_comment_ids(document))
+
+    async def _gather_comment_ids(self, comments_dir, documents_info):
+        total_document_count = len(documents_info)
+        self._logger.info(
+            "-------- getting comments for all documents --------")
+        self._logger.info(f"---- {total_document_count} total documents")
+        listing_slots = asyncio.Semaphore(self._concurrency)
+
+        async def gather_document(document):
+            async with listing_slots:
+                return await self._gather_document_comment_ids(document)
+
+        all_comments = []
+        for document_comments in await asyncio.gather(*[gather_document(document) for document in documents_info]):
+            all_comments.extend(document_comments)
+        return all_comments
+
+    async def _gather_comment(self, comments_dir, comment_id):
+        self._logger.info(
+            f"--- getting comment details and attachments for: {comment_id}")
+        comment = await self._get_comment_details_and_attachments(comment_id)
+        attachments = self._write_comment_details(
+            comments_dir, comment_id, comment)
+        if attachments is None:
+            return None
+        return await self._save_attachments(comments_dir, comment_id, attachments)
+
+    async def _gather_comments_and_attachments(self, comments_dir, all_comments):
+        """
+        Fetches the details (and attachments) for every comment with up to
+        `concurrency` comments in flight at once
+        """
+        self._total_comments = len(all_comments)
+        self._completed_comments = 0
+        pending = asyncio.Queue(maxsize=self._concurrency * 2)
+
+        async def comment_worker():
+            while True:
+                comment_id = await pending.get()
+                try:
+                    if comment_id is None:
+                        return
+                    try:
+                        these_attachments = await self._gather_comment(comments_dir, comment_id)
+                    except DEAD_LETTER_ERRORS as e:
+                        self._dead_letter(comment_id, e)
+                        continue
+                    self._record_comment(comment_id, these_attachments)
+                finally:
+                    pending.task_done()
+
+        workers = [asyncio.ensure_future(comment_worker())
+                   for _ in range(self._concurrency)]
+        try:
+            for comment_id in all_comments:
+                if self._have_comment(comment_id):
+                    self._logger.info(
+                        f"- already have comment details and attachments for {comment_id} - skipping...")
+                    self._metrics.increment('resume_skips')
+                    self._record_comment(comment_id, None, False)
+                    continue
+                await self._put_or_raise(pending, comment_id, workers)
+            for _ in workers:
+                await self._put_or_raise(pending, None, workers)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def _put_or_raise(self, queue, item, workers):
+        # surface a failed worker rather than blocking on a queue no one drains
+        while True:
+            for worker in workers:
+                if worker.done() and not worker.cancelled() and worker.exception():
+                    raise worker.exception()
+            try:
+                await asyncio.wait_for(queue.put(item), timeout=1.0)
+                return
+            except asyncio.TimeoutError:
+                continue
+
+    async def _download_archive(self):
+        self._resume_info = self._open_resume_info()
+        self._start_metrics()
+        if 'run_started' not in self._resume_info:
+            self._resume_info['run_started'] = datetime.utcnow().strftime(
+                API_DATE_FORMAT)
+
+        self._logger.info('-------- getting docket and details --------')
+        if not self._resume or 'docket' not in self._resume_info:
+            self._record_docket_details(await self._get_docket_details())
+        else:
+            self._logger.info('- already have docket details, skipping...')
+
+        documents_info = await self._get_docket_documents()
+
+        comments_dir = self._open_comments_dir()
+
+        all_comments = await self._gather_comment_ids(
+            comments_dir, documents_info)
+
+        self._logger.info(
+            '-------- getting all comment details and attachments --------')
+        self._logger.info(f"---- {len(all_comments)} total comments")
+
+        await self._gather_comments_and_attachments(comments_dir, all_comments)
+        self._write_comment_attachments()
+        self._write_dead_letters()
+
+        # so a later (threaded) --sync run can pick up from here
+        self._complete_run()
+
+        self._logger.info('-------- Done! --------')
+
+    async def _run(self):
+        try:
+            await self._download_archive()
+        finally:
+            await self._fetcher.close()
+            if self._attachment_session is not None:
+                await self._attachment_session.close()
+                self._attachment_session = None
+
+    def download_archive(self):
+        self._logger.info('----------------')
+        self._logger.info(f'output to: {self._output_directory}')
+        self._logger.info('')
+
+        start_time = time.time()
+        loop = asyncio.new_event_loop()
+        try:
+            # everything runs on the event loop's thread, so it is profiled as one stage
+            with self._metrics.profiled('download'):
+                loop.run_until_complete(self._run())
+        finally:
+            loop.close()
+            self._stop_metrics()
+            self._close_resume_info()
+            end_time = time.time()
+            self._logger.info(f'total time taken: {end_time-start_time}')
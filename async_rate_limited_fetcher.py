@@ -0,0 +1,97 @@
+import asyncio
+import time
+import aiohttp
+from download_metrics import endpoint_for_url
+from http_sessions import http_settings
+from rate_limited_fetcher import RateLimitedFetcher
+from request_retry import TransientRequestError
+
+"""
+An asyncio version of the RateLimitedFetcher
+
+AsyncRateLimitedFetcher(logger, requests_per_hour, api_key, settings, cache, metrics, retry_policy)
+
+Shares the request budget accounting of RateLimitedFetcher, but sends
+requests (and waits for the budget) on the event loop rather than on
+a thread. Must be used from within a running event loop, and closed
+with `await fetcher.close()` when finished. `settings` are the pool size
+and timeout settings from http_sessions.http_settings.
+"""
+
+# the failures of an aiohttp request that may pass if it is tried again
+ASYNC_RETRYABLE_EXCEPTIONS = (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError,
+                              asyncio.TimeoutError, TransientRequestError)
+
+
+def create_client_session(settings):
+    connector = aiohttp.TCPConnector(limit=settings['pool_maxsize'])
+    timeout = aiohttp.ClientTimeout(sock_connect=settings['connect_timeout'],
+                                    sock_read=settings['read_timeout'])
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+class AsyncRateLimitedFetcher(RateLimitedFetcher):
+    def __init__(self, logger, requests_per_hour, api_key, settings=None, cache=None, metrics=None,
+                 retry_policy=None):
+        self._settings = settings or http_settings(None, 'api')
+        super().__init__(logger, requests_per_hour, api_key,
+                         cache=cache, metrics=metrics, retry_policy=retry_policy)
+
+    def _create_default_session(self):
+        # the aiohttp session has to be created on the running event loop
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = create_client_session(self._settings)
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _send_request(self, resource_url, query_params={}, extra_headers={}):
+        api_key, wait_response = self._reserve_request()
+        if wait_response:
+            return wait_response
+        request_headers = {
+            "Content-Type": "application/json",
+            **extra_headers
+        }
+
+        send_query_params = {key: str(value) for key, value in
+                             self._request_params(api_key, query_params).items()}
+
+        started = time.time()
+        async with self.session.get(resource_url,
+                                    params=send_query_params,
+                                    headers=request_headers
+                                    ) as response:
+            response_text = await response.text()
+            self._observe_request(resource_url, started,
+                                  response.status, response_text)
+            return self._handle_response(api_key, resource_url, response.status,
+                                         response.headers, response_text)
+
+    async def get_or_wait(self, resource_url, query_params={}):
+        """
+        Async version of RateLimitedFetcher.get_or_wait - waiting for the
+        rate limit only suspends the calling task, not the event loop.
+        """
+        cached, stale = self._check_cache(resource_url, query_params)
+        if cached is not None:
+            return cached
+        self._logger.info(
+            f'getting: {resource_url}{self._query_params_string(query_params)}')
+        validation_headers = stale.validation_headers() if stale else {}
+        endpoint = endpoint_for_url(resource_url)
+        while True:
+            response = await self._retry_policy.call_async(endpoint, lambda: self._send_request(
+                resource_url, query_params, validation_headers), ASYNC_RETRYABLE_EXCEPTIONS)
+            if response.is_rate_limited:
+                self._log_rate_limit_wait(response.wait_until)
+                await asyncio.sleep(max(0.0, response.wait_until - time.time()))
+                continue
+            return self._update_cache(resource_url, query_params, response, stale)
@@ -0,0 +1,206 @@
+import errno
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from attachment_policy import is_attachment_url
+from docket_index import DocketIndex, open_docket_index
+from json_utils import read_json_input, write_json_object_stream
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+EXPORT_MANIFEST_FILENAME = 'export_manifest.json'
+EXPORT_MODES = ['auto', 'reflink', 'hardlink', 'copy']
+DEFAULT_EXPORT_WORKERS = 8
+# the Linux ioctl that makes a file share another file's blocks (btrfs, xfs, ...)
+FICLONE = 0x40049409
+# errors that mean a placement method does not work between these directories at all
+UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+                      errno.EPERM, errno.ENOSYS, errno.EMLINK}
+
+"""
+Exports a selection of a downloaded docket's attachments to one directory
+
+AttachmentExporter(logger, output_directory, export_directory, mode, workers)
+
+Attachments are selected (through the docket index, which is brought up
+to date first) by file format, by the document commented on and by the
+date the comment was posted. Each one is placed in the export directory as
+`{commentId}_{filename}`, and `export_manifest.json` there maps every
+exported name back to its comment, document and source file.
+
+The `mode` says how files are placed:
+
+* `reflink` - a copy-on-write clone that shares the source's blocks
+  (Linux filesystems that support it, e.g. btrfs or xfs)
+* `hardlink` - another name for the source file (the same filesystem only;
+  changing the exported file changes the downloaded one)
+* `copy` - a full copy, made by `workers` threads in parallel
+* `auto` (the default) - the first of these that works
+
+Neither a reflink nor a hardlink copies any data, so exporting from the
+same filesystem takes about as long however large the attachments are.
+Files already exported as links to the same source are left as they are.
+
+`export_attachments(attachments, write_manifest)` places a list made by
+other means (e.g. listed_attachments(), which neither builds an index nor
+needs one) instead.
+"""
+
+
+def listed_attachments(output_directory, attachment_formats=None):
+    """
+    Returns (comment id, None, path, None) for the attachments (with the
+    given extensions) in comment_attachments.json - or the index's selection
+    if the docket has been indexed
+    """
+    docket_index = open_docket_index(output_directory)
+    if docket_index is not None:
+        try:
+            return docket_index.select_attachments(attachment_formats)
+        finally:
+            docket_index.close()
+    attachments_path = os.path.join(output_directory, 'comment_attachments.json')
+    extensions = tuple(f".{attachment_format.lstrip('.').lower()}"
+                       for attachment_format in attachment_formats or [])
+    return [(comment_id, None, path, None)
+            for comment_id, paths in (read_json_input(attachments_path) or {}).items()
+            for path in paths or []
+            if not extensions or path.lower().endswith(extensions)]
+
+
+def reflink_file(source_path, target_path):
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'reflinks are not supported on this platform')
+    with open(source_path, 'rb') as source, open(target_path, 'wb') as target:
+        try:
+            fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+        except OSError:
+            target.close()
+            os.remove(target_path)
+            raise
+
+
+def _place(method, source_path, target_path):
+    if method == 'reflink':
+        reflink_file(source_path, target_path)
+    elif method == 'hardlink':
+        os.link(source_path, target_path)
+    else:
+        shutil.copyfile(source_path, target_path)
+
+
+class AttachmentExporter:
+    def __init__(self, logger, output_directory, export_directory, mode='auto',
+                 workers=DEFAULT_EXPORT_WORKERS):
+        if mode not in EXPORT_MODES:
+            raise Exception(
+                f'unknown export mode: {mode} (expected one of {EXPORT_MODES})')
+        self._logger = logger
+        self._output_directory = output_directory
+        self._comments_dir = os.path.join(output_directory, 'comments')
+        self._export_directory = export_directory
+        self._methods = ['reflink', 'hardlink', 'copy'] if mode == 'auto' else [mode]
+        self._workers = max(1, workers)
+        self._lock = threading.Lock()
+        self._unsupported = set()
+        self._method_counts = {}
+
+    def select(self, attachment_formats=None, posted_since=None, posted_until=None, document_ids=None):
+        """
+        Returns (comment id, document id, path, size) for the selected
+        attachments that were downloaded
+        """
+        docket_index = DocketIndex(self._output_directory)
+        try:
+            docket_index.update()
+            attachments = docket_index.select_attachments(
+                attachment_formats, posted_since, posted_until, document_ids)
+        finally:
+            docket_index.close()
+        return attachments
+
+    def _place_file(self, source_path, target_path):
+        """
+        Atomically places the source file at the target path with the first
+        method that works, and returns the method
+        """
+        temp_path = f'{target_path}.{os.getpid()}.{threading.get_ident()}.export'
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        for method in self._methods:
+            if method in self._unsupported:
+                continue
+            try:
+                _place(method, source_path, temp_path)
+            except OSError as e:
+                if len(self._methods) == 1 or method == 'copy' or e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                with self._lock:
+                    if method not in self._unsupported:
+                        self._logger.info(
+                            f'-- {method} not possible ({e.strerror}), falling back')
+                        self._unsupported.add(method)
+                continue
+            os.replace(temp_path, target_path)
+            return method
+        raise Exception(f'could not export {source_path}')
+
+    def _export_attachment(self, attachment):
+        comment_id, document_id, path, size = attachment
+        source_path = os.path.join(self._comments_dir, path)
+        exported_name = f'{comment_id}_{os.path.basename(path)}'
+        target_path = os.path.join(self._export_directory, exported_name)
+        if not os.path.exists(source_path):
+            self._logger.info(f'-- missing attachment file: {path}')
+            return None
+        if os.path.exists(target_path) and os.path.samefile(source_path, target_path):
+            method = 'existing'
+        else:
+            method = self._place_file(source_path, target_path)
+        with self._lock:
+            self._method_counts[method] = self._method_counts.get(method, 0) + 1
+        return exported_name, {
+            'comment_id': comment_id,
+            'document_id': document_id,
+            'source': path,
+            'size': size,
+            'method': method
+        }
+
+    def export(self, attachment_formats=None, posted_since=None, posted_until=None, document_ids=None):
+        """
+        Exports the selected attachments and writes the manifest - returns
+        the number of files exported
+        """
+        return self.export_attachments(
+            self.select(attachment_formats, posted_since, posted_until, document_ids))
+
+    def export_attachments(self, attachments, write_manifest=True):
+        """
+        Exports (comment id, document id, path, size) attachments, skipping
+        those that were not downloaded - returns the number of files exported
+        """
+        start = time.time()
+        deferred = [path for _, _, path, _ in attachments if is_attachment_url(path)]
+        if deferred:
+            self._logger.info(
+                f'{len(deferred)} selected attachments were not downloaded (use --fetchattachments)')
+        attachments = [attachment for attachment in attachments if not is_attachment_url(attachment[2])]
+        os.makedirs(self._export_directory, exist_ok=True)
+        self._logger.info(
+            f'exporting {len(attachments)} attachments to: {self._export_directory}')
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            exported = [entry for entry in executor.map(self._export_attachment, attachments)
+                        if entry is not None]
+        if write_manifest:
+            write_json_object_stream(os.path.join(
+                self._export_directory, EXPORT_MANIFEST_FILENAME), exported)
+        methods = ', '.join(f'{count} {method}' for method, count in sorted(self._method_counts.items()))
+        self._logger.info(
+            f'exported {len(exported)} attachments ({methods or "none"}) in {time.time() - start:.1f}s')
+        return len(exported)
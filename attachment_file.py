@@ -0,0 +1,184 @@
+import base64
+import hashlib
+import os
+
+PARTIAL_SUFFIX = '.part'
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+
+"""
+An attachment being streamed to disk
+
+AttachmentFile(full_path)
+
+Chunks are written to `{full_path}.part`, which is renamed to `full_path`
+only once the download is complete and its size (Content-Length /
+Content-Range) and checksum (Content-MD5 / Digest, when the server sends
+one for the whole file) have been verified. A file at `full_path` is therefore always
+complete, and an interrupted download leaves only the `.part` file, which
+is continued with an HTTP Range request on the next attempt.
+
+Does no network I/O itself, so the threaded and asyncio downloaders
+can both use it:
+
+    attachment = AttachmentFile(full_path)
+    response = get(url, headers=attachment.request_headers())
+    if attachment.start(response.status_code, response.headers):
+        for chunk in response:
+            attachment.write(chunk)
+        attachment.finish()
+"""
+
+
+def _expected_digests(headers):
+    """
+    Returns {hash name: expected digest bytes} from the checksum headers
+    """
+    ret = {}
+    content_md5 = headers.get('Content-MD5')
+    if content_md5:
+        try:
+            ret['md5'] = base64.b64decode(content_md5)
+        except ValueError:
+            pass
+    digest = headers.get('Digest')
+    if digest:
+        for digest_item in digest.split(','):
+            algorithm, _, value = digest_item.strip().partition('=')
+            algorithm = algorithm.strip().lower()
+            if algorithm not in ('md5', 'sha-256'):
+                continue
+            try:
+                ret[algorithm.replace('-', '')] = base64.b64decode(value)
+            except ValueError:
+                pass
+    return ret
+
+
+def _content_range_total(headers):
+    content_range = headers.get('Content-Range')
+    if not content_range or '/' not in content_range:
+        return None
+    total = content_range.rsplit('/', 1)[1].strip()
+    if not total.isdigit():
+        return None
+    return int(total)
+
+
+def response_file_size(status_code, headers):
+    """
+    Returns the size of the whole file a response is for (or None if the
+    headers do not say)
+    """
+    if headers.get('Content-Encoding', 'identity') != 'identity':
+        return None
+    if status_code == 206:
+        return _content_range_total(headers)
+    content_length = headers.get('Content-Length')
+    return int(content_length) if content_length and content_length.isdigit() else None
+
+
+class AttachmentFile:
+    def __init__(self, full_path):
+        self.full_path = full_path
+        self.part_path = f'{full_path}{PARTIAL_SUFFIX}'
+        self._output = None
+        self._hashers = {}
+        self._expected_digests = {}
+        self._expected_size = None
+        self._written = 0
+        self.error = None
+
+    def is_complete(self):
+        return os.path.exists(self.full_path)
+
+    def resume_offset(self):
+        if not os.path.exists(self.part_path):
+            return 0
+        return os.path.getsize(self.part_path)
+
+    def request_headers(self):
+        offset = self.resume_offset()
+        if offset == 0:
+            return {}
+        return {'Range': f'bytes={offset}-'}
+
+    def discard(self):
+        self._close()
+        if os.path.exists(self.part_path):
+            os.remove(self.part_path)
+
+    def start(self, status_code, headers):
+        """
+        Prepares to receive the body of a response. Returns False if the
+        response has no usable body (in which case nothing is written).
+        """
+        if status_code == 416:
+            # the partial file does not fit the resource - start over next time
+            self.discard()
+            self.error = 'requested range not satisfiable'
+            return False
+        if status_code > 299:
+            self.error = f'status code {status_code}'
+            return False
+
+        append = status_code == 206 and self.resume_offset() > 0
+        if headers.get('Content-Encoding', 'identity') != 'identity':
+            # the headers describe the encoded body, not the decoded file
+            headers = {}
+        # on a partial response the checksum headers cover only the range
+        self._expected_digests = {} if append else _expected_digests(headers)
+        self._hashers = {name: hashlib.new(name)
+                         for name in self._expected_digests}
+
+        if append:
+            self._expected_size = _content_range_total(headers)
+            self._written = self.resume_offset()
+            self._output = open(self.part_path, 'ab')
+        else:
+            content_length = headers.get('Content-Length')
+            self._expected_size = int(
+                content_length) if content_length and content_length.isdigit() else None
+            self._written = 0
+            self._output = open(self.part_path, 'wb')
+        return True
+
+    def _update_hashers(self, chunk):
+        for hasher in self._hashers.values():
+            hasher.update(chunk)
+
+    def write(self, chunk):
+        if not chunk:
+            return
+        self._output.write(chunk)
+        self._update_hashers(chunk)
+        self._written = self._written + len(chunk)
+
+    def _close(self):
+        if self._output is not None:
+            self._output.close()
+            self._output = None
+
+    def abort(self):
+        """
+        Stops an interrupted download, keeping the partial file to continue from
+        """
+        self._close()
+
+    def finish(self):
+        """
+        Verifies the download and moves it into place. Returns False (and
+        removes the partial file) if verification fails.
+        """
+        self._close()
+        if self._expected_size is not None and self._written != self._expected_size:
+            self.error = f'expected {self._expected_size} bytes, received {self._written}'
+            if self._written > self._expected_size:
+                self.discard()
+            return False
+        for name, expected in self._expected_digests.items():
+            if self._hashers[name].digest() != expected:
+                self.error = f'{name} checksum mismatch'
+                self.discard()
+                return False
+        os.replace(self.part_path, self.full_path)
+        return True
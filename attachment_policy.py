@@ -0,0 +1,116 @@
+import os
+from urllib.parse import urlparse
+
+DEFAULT_ATTACHMENT_POLICY = {
+    'formats': None,
+    'include': None,
+    'exclude': None,
+    'max_bytes': None,
+    'deferred': False
+}
+
+"""
+Which attachment files are downloaded
+
+AttachmentPolicy(settings)
+
+Every attachment is offered by the API in one or more renditions (its
+`fileFormats`, e.g. the original .docx and a rendered .pdf). Without a
+policy all of them are downloaded. The `attachment_policy` section of
+config.json narrows that down, e.g.:
+
+    "attachment_policy": {"formats": ["xlsx", "docx", "pdf"], "exclude": ["tif"],
+                          "max_bytes": 52428800, "deferred": false}
+
+* `formats` - the renditions in order of preference. Only the most
+  preferred rendition of each attachment is downloaded (or, if it has none
+  of them, the first rendition the API lists).
+* `include` / `exclude` - the file extensions that may (or may never) be
+  downloaded
+* `max_bytes` - larger files are not downloaded, going by the size the API
+  lists for the rendition, or else the Content-Length of the response
+  (whose body is then not read)
+* `deferred` - no files are downloaded during the docket download
+
+Files that are not downloaded because of their size (or because
+downloads are deferred) are recorded by their URL in
+comment_attachments.json instead of their path, so they can be fetched on
+demand later (see `--fetchattachments`).
+"""
+
+
+def attachment_policy_settings(config):
+    policy_config = (config or {}).get('attachment_policy') or {}
+    return {**DEFAULT_ATTACHMENT_POLICY, **policy_config}
+
+
+def is_attachment_url(attachment):
+    """
+    Returns True if a comment_attachments.json entry is the URL of a file
+    that was not downloaded (rather than the path of one that was)
+    """
+    return attachment.startswith('http://') or attachment.startswith('https://')
+
+
+def file_extension(filename):
+    return os.path.splitext(filename)[1].lstrip('.').lower()
+
+
+def _extension_set(extensions):
+    if not extensions:
+        return None
+    return set(extension.lstrip('.').lower() for extension in extensions)
+
+
+class AttachmentPolicy:
+    def __init__(self, settings=None):
+        settings = {**DEFAULT_ATTACHMENT_POLICY, **(settings or {})}
+        self._formats = [file_format.lstrip('.').lower()
+                         for file_format in settings['formats'] or []]
+        self._include = _extension_set(settings['include'])
+        self._exclude = _extension_set(settings['exclude']) or set()
+        self._max_bytes = settings['max_bytes']
+        self.deferred = bool(settings['deferred'])
+
+    def _allowed(self, rendition_format):
+        if self._include is not None and rendition_format not in self._include:
+            return False
+        return rendition_format not in self._exclude
+
+    def select(self, file_formats):
+        """
+        Returns (file_url, filename, size) for the renditions of an
+        attachment (its `fileFormats`) that should be downloaded - size is
+        None if the API does not list it
+        """
+        renditions = []
+        for file_format in file_formats or []:
+            if not file_format or 'fileUrl' not in file_format:
+                continue
+            file_parts = file_format['fileUrl'].split('/')
+            if len(file_parts) < 2:
+                continue
+            filename = file_parts[-1]
+            rendition_format = (file_format.get('format') or file_extension(
+                urlparse(file_format['fileUrl']).path)).lower()
+            if not self._allowed(rendition_format):
+                continue
+            size = file_format.get('size')
+            renditions.append((file_format['fileUrl'], filename,
+                               size if isinstance(size, int) else None, rendition_format))
+        if self._formats and renditions:
+            preference = {rendition_format: index for index,
+                          rendition_format in enumerate(self._formats)}
+            renditions = [min(renditions, key=lambda rendition: preference.get(
+                rendition[3], len(preference)))]
+        return [(file_url, filename, size) for file_url, filename, size, _ in renditions]
+
+    def too_large(self, size):
+        return self._max_bytes is not None and size is not None and size > self._max_bytes
+
+
+class AttachmentTooLarge(Exception):
+    def __init__(self, file_url, size):
+        super().__init__(f'{file_url} is {size} bytes')
+        self.file_url = file_url
+        self.size = size
@@ -0,0 +1,236 @@
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from download_metrics import DownloadMetrics, MetricsReporter, metrics_settings
+from fdms_archive_downloader import FDMSArchiveDownloader
+from http_sessions import create_session, http_settings, request_timeout
+from rate_limited_fetcher import RateLimitedFetcher
+from request_retry import RetryPolicy, retry_settings
+from response_cache import create_response_cache
+
+BATCH_ORDERS = ['fair', 'priority']
+
+"""
+Scheduling of several dockets' requests through one shared request budget
+
+SharedBudgetScheduler(fetcher, max_in_flight, order)
+
+Hands out turns at the shared RateLimitedFetcher to the dockets that are
+waiting for one, with at most `max_in_flight` requests outstanding.
+With the 'fair' order, the docket that has had the fewest requests goes
+next; with 'priority', dockets with a higher priority go first (and
+dockets of equal priority share fairly). A turn is only handed out once
+the fetcher has budget for the request (which is reserved for it), so
+when the budget runs short, it is the order that decides who gets it.
+"""
+
+
+class SharedBudgetScheduler:
+    def __init__(self, fetcher, max_in_flight, order='fair'):
+        self._fetcher = fetcher
+        self._max_in_flight = max(1, max_in_flight)
+        self._order = order
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._granted = {}
+        self._priorities = {}
+
+    def register(self, docket_id, priority=0):
+        with self._condition:
+            self._granted.setdefault(docket_id, 0)
+            self._priorities[docket_id] = priority
+
+    def fetcher_for(self, docket_id):
+        return DocketFetcher(self, docket_id)
+
+    def _waiter_order(self, waiter):
+        sequence, docket_id = waiter
+        if self._order == 'priority':
+            return (-self._priorities.get(docket_id, 0), self._granted[docket_id], sequence)
+        return (self._granted[docket_id], sequence)
+
+    def _acquire(self, docket_id):
+        """
+        Waits for the docket's turn, and returns the API key whose budget
+        was reserved for it
+        """
+        with self._condition:
+            waiter = (next(self._sequence), docket_id)
+            self._waiting.append(waiter)
+            while True:
+                if (self._in_flight < self._max_in_flight and
+                        min(self._waiting, key=self._waiter_order) is waiter):
+                    api_key, wait_seconds = self._fetcher.reserve_api_key()
+                    if wait_seconds <= 0.0:
+                        break
+                    # still first in line once the budget refills (unless
+                    # a docket that goes before this one starts waiting)
+                    self._condition.wait(wait_seconds)
+                else:
+                    self._condition.wait()
+            self._waiting.remove(waiter)
+            self._in_flight = self._in_flight + 1
+            self._granted[docket_id] = self._granted[docket_id] + 1
+            self._condition.notify_all()
+            return api_key
+
+    def _release(self):
+        with self._condition:
+            self._in_flight = self._in_flight - 1
+            self._condition.notify_all()
+
+    def get_or_wait(self, docket_id, resource_url, query_params={}, revalidate=False):
+        api_key = self._acquire(docket_id)
+        try:
+            return self._fetcher.get_reserved(api_key, resource_url, query_params, revalidate)
+        finally:
+            self._release()
+
+    def requests_granted(self):
+        with self._condition:
+            return dict(self._granted)
+
+
+"""
+A single docket's view of a SharedBudgetScheduler - used by an
+FDMSArchiveDownloader in place of its own RateLimitedFetcher
+"""
+
+
+class DocketFetcher:
+    def __init__(self, scheduler, docket_id):
+        self._scheduler = scheduler
+        self._docket_id = docket_id
+
+    def get_or_wait(self, resource_url, query_params={}, revalidate=False):
+        return self._scheduler.get_or_wait(self._docket_id, resource_url, query_params, revalidate)
+
+
+def read_batch_file(batch_file):
+    """
+    Reads a batch file of docket IDs - one per line, optionally followed by
+    a priority (higher goes first). Blank lines and lines starting with #
+    are ignored. Returns a list of (docket_id, priority).
+    """
+    ret = []
+    with open(batch_file, 'r', encoding='utf-8') as batch_input:
+        for line in batch_input:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = line.split()
+            priority = int(parts[1]) if len(parts) > 1 else 0
+            ret.append((parts[0], priority))
+    return ret
+
+
+"""
+Downloads a batch of dockets through one shared request budget
+
+BatchDocketDownloader(logger, api_key, dockets, output_directory,
+                      resume_download, workers, config, parallel_dockets,
+                      order, sync, attachment_workers)
+
+`dockets` is a list of (docket_id, priority). Up to `parallel_dockets`
+dockets are downloaded at once (highest priority first), each with
+`workers` threads (and `attachment_workers` attachment download threads),
+into `{output_directory}/{docket_id}` - each docket keeps its own resume
+journal there. All of their API requests go through
+one RateLimitedFetcher (and so one set of API keys and one budget),
+scheduled across the dockets by a SharedBudgetScheduler.
+
+With metrics configured, the shared fetcher's requests (for all of the
+dockets) are published from the output directory - the stats file there,
+and the Prometheus endpoint - and each docket's own stats file has its
+progress and stages.
+"""
+
+
+class BatchDocketDownloader:
+    def __init__(self, logger, api_key, dockets, output_directory, resume_download=True, workers=1,
+                 config=None, parallel_dockets=4, order='fair', sync=False, attachment_workers=None):
+        self._logger = logger
+        self._api_key = api_key
+        self._dockets = sorted(dockets, key=lambda x: -x[1])
+        self._output_directory = output_directory
+        self._resume = resume_download
+        self._workers = max(1, workers)
+        self._config = config or {}
+        self._metrics_settings = metrics_settings(self._config)
+        self._metrics = DownloadMetrics()
+        self._parallel_dockets = max(1, min(parallel_dockets, len(dockets)))
+        self._sync = sync
+        self._attachment_workers = attachment_workers
+        in_flight = self._workers * self._parallel_dockets
+        api_settings = http_settings(self._config, 'api', in_flight)
+        fetcher = RateLimitedFetcher(self._logger, 1000, api_key,
+                                     create_session(api_settings),
+                                     request_timeout(api_settings),
+                                     create_response_cache(self._config, output_directory),
+                                     self._metrics,
+                                     RetryPolicy(retry_settings(self._config), logger, self._metrics))
+        self._scheduler = SharedBudgetScheduler(fetcher, in_flight, order)
+        for docket_id, priority in self._dockets:
+            self._scheduler.register(docket_id, priority)
+
+    def _docket_config(self):
+        """
+        Returns the configuration for each docket's download - the batch
+        serves the Prometheus endpoint, so the dockets do not
+        """
+        if self._metrics_settings is None:
+            return self._config
+        return {**self._config, 'metrics': {**self._metrics_settings, 'prometheus_port': None}}
+
+    def _download_docket(self, docket_id):
+        downloader = FDMSArchiveDownloader(self._logger, self._api_key, docket_id,
+                                           os.path.join(
+                                               self._output_directory, docket_id),
+                                           self._resume, self._workers,
+                                           config=self._docket_config(), sync=self._sync,
+                                           fetcher=self._scheduler.fetcher_for(docket_id),
+                                           attachment_workers=self._attachment_workers)
+        downloader.download_archive()
+
+    def download_all(self):
+        self._logger.info('----------------')
+        self._logger.info(
+            f'batch of {len(self._dockets)} dockets, {self._parallel_dockets} at a time')
+        self._logger.info('')
+
+        start_time = time.time()
+        failed = {}
+        metrics_reporter = None
+        if self._metrics_settings is not None:
+            os.makedirs(self._output_directory, exist_ok=True)
+            metrics_reporter = MetricsReporter(self._metrics, self._output_directory,
+                                               {**self._metrics_settings, 'profile': False})
+            metrics_reporter.start()
+        try:
+            with ThreadPoolExecutor(max_workers=self._parallel_dockets) as executor:
+                futures = {executor.submit(self._download_docket, docket_id): docket_id
+                           for docket_id, _ in self._dockets}
+                for future, docket_id in futures.items():
+                    try:
+                        future.result()
+                    except Exception as e:
+                        self._logger.exception(
+                            f'!! download of docket {docket_id} failed')
+                        failed[docket_id] = str(e)
+        finally:
+            if metrics_reporter is not None:
+                metrics_reporter.stop()
+
+        granted = self._scheduler.requests_granted()
+        self._logger.info('-------- batch summary --------')
+        for docket_id, _ in self._dockets:
+            status = f'FAILED ({failed[docket_id]})' if docket_id in failed else 'done'
+            self._logger.info(
+                f'---- {docket_id}: {status}, {granted.get(docket_id, 0)} API requests')
+        self._logger.info(
+            f'total time taken: {time.time()-start_time}')
+        return failed
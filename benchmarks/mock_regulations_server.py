@@ -0,0 +1,433 @@
+import argparse
+import bisect
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from comment_store import open_comment_store  # noqa: E402
+from json_utils import read_json_input, iter_json_array  # noqa: E402
+
+API_PREFIX = '/v4'
+FILES_PREFIX = '/files'
+STATS_PATH = '/__stats'
+API_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+FILTER_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+MAX_PAGES = 20
+DEFAULT_RATE_LIMIT = 1000000
+
+"""
+A local stand-in for the regulations.gov v4 API
+
+python benchmarks/mock_regulations_server.py [--port 8099] [--documents 3] [--comments 2000] ...
+
+Serves `/v4/dockets/{id}`, `/v4/documents`, `/v4/comments` (with paging,
+`meta.totalElements` / `meta.hasNextPage`, the 20 page limit, sorting and
+the lastModifiedDate filters) and `/v4/comments/{id}?include=attachments`,
+plus the attachment files themselves under `/files`. The docket is either
+synthetic (generated from the size options) or recorded - a docket
+downloaded earlier, given with `--recorded {output_directory}`.
+
+Latency, 429s (with Retry-After) and 5xx errors can be injected, and
+`/__stats` returns the number of requests and bytes served. Point the
+downloader at it with `"api_base_url": "http://127.0.0.1:{port}/v4"` in
+config.json.
+"""
+
+
+def api_date(value):
+    return value.strftime(API_DATE_FORMAT)
+
+
+class SyntheticDocket:
+    def __init__(self, docket_id, documents, comments_per_document, attachments_per_comment,
+                 attachment_bytes, seed=1, renditions=('pdf',)):
+        self.docket_id = docket_id
+        self._attachments_per_comment = attachments_per_comment
+        self._renditions = renditions
+        self._attachment = b'%PDF-1.4\n' + \
+            (b'x' * max(0, attachment_bytes - 9))
+        chooser = random.Random(seed)
+        start = datetime(2021, 1, 1)
+        self._documents = []
+        self._listings = {}
+        for document_index in range(documents):
+            document_id = f'{docket_id}-{document_index + 1:04d}'
+            object_id = f'09000064{document_index:08x}'
+            self._documents.append({
+                'id': document_id,
+                'type': 'documents',
+                'attributes': {'objectId': object_id, 'documentType': 'Proposed Rule',
+                               'title': f'Document {document_index + 1}',
+                               'lastModifiedDate': api_date(start)}
+            })
+            listing = []
+            for comment_index in range(comments_per_document):
+                modified = start + \
+                    timedelta(seconds=chooser.randint(0, 90 * 24 * 60 * 60))
+                listing.append({
+                    'id': f'{document_id}-C{comment_index + 1:07d}',
+                    'type': 'comments',
+                    'attributes': {'lastModifiedDate': api_date(modified), 'title': f'Comment {comment_index + 1}'}
+                })
+            listing.sort(key=lambda comment: (
+                comment['attributes']['lastModifiedDate'], comment['id']))
+            self._listings[object_id] = listing
+        self._comment_documents = {comment['id']: document['id'] for document in self._documents
+                                   for comment in self._listings[document['attributes']['objectId']]}
+
+    def docket_details(self):
+        return {'id': self.docket_id, 'type': 'dockets', 'attributes': {'title': f'Docket {self.docket_id}'}}
+
+    def documents(self):
+        return self._documents
+
+    def listing(self, object_id):
+        return self._listings.get(object_id, [])
+
+    def comment_detail(self, comment_id, files_url):
+        document_id = self._comment_documents.get(comment_id)
+        if document_id is None:
+            return None
+        attachments = [{
+            'id': f'{comment_id}-A{attachment_index}',
+            'type': 'attachments',
+            'attributes': {'fileFormats': [{
+                'fileUrl': f'{files_url}/{comment_id}/attachment_{attachment_index}.{rendition}',
+                'format': rendition,
+                'size': len(self._attachment)
+            } for rendition in self._renditions]}
+        } for attachment_index in range(1, self._attachments_per_comment + 1)]
+        return {
+            'data': {
+                'id': comment_id,
+                'type': 'comments',
+                'attributes': {'commentOnDocumentId': document_id, 'comment': f'Synthetic comment {comment_id}. ' * 20,
+                               'postedDate': '2021-01-01T00:00:00Z', 'organization': 'Benchmark'},
+                'relationships': {'attachments': {'data': [{'id': attachment['id'], 'type': 'attachments'}
+                                                           for attachment in attachments]}}
+            },
+            'included': attachments
+        }
+
+    def attachment(self, comment_id, filename):
+        if comment_id not in self._comment_documents:
+            return None
+        return self._attachment
+
+
+class RecordedDocket:
+    """
+    Serves a docket downloaded earlier (its comment records, listings and
+    attachment files)
+    """
+
+    def __init__(self, output_directory):
+        self._output_directory = output_directory
+        self._comments_dir = os.path.join(output_directory, 'comments')
+        details = read_json_input(os.path.join(
+            output_directory, 'docket_details.json'))
+        self.docket_id = details['id']
+        self._details = details
+        self._documents = read_json_input(os.path.join(
+            output_directory, 'docket_documents.json')) or []
+        self._listings = {}
+        for document in self._documents:
+            object_id = document['attributes']['objectId']
+            listing_path = os.path.join(
+                output_directory, f"{document['id']}_{object_id}_comments.json")
+            self._listings[object_id] = sorted(
+                iter_json_array(listing_path) if os.path.exists(
+                    listing_path) else [],
+                key=lambda comment: (comment['attributes'].get('lastModifiedDate') or '', comment['id']))
+        attachments_path = os.path.join(
+            output_directory, 'comment_attachments.json')
+        self._attachments = read_json_input(
+            attachments_path) if os.path.exists(attachments_path) else {}
+        self._comment_store = open_comment_store(self._comments_dir)
+        self._comment_documents = {comment['id']: document['id'] for document in self._documents
+                                   for comment in self._listings[document['attributes']['objectId']]}
+
+    def docket_details(self):
+        return self._details
+
+    def documents(self):
+        return self._documents
+
+    def listing(self, object_id):
+        return self._listings.get(object_id, [])
+
+    def comment_detail(self, comment_id, files_url):
+        document_id = self._comment_documents.get(comment_id)
+        if document_id is None:
+            return None
+        record = self._comment_store.get(document_id, comment_id)
+        if record is None:
+            return None
+        attachments = [{
+            'id': f'{comment_id}-A{attachment_index}',
+            'type': 'attachments',
+            'attributes': {'fileFormats': [{
+                'fileUrl': f'{files_url}/{comment_id}/{os.path.basename(attachment_path)}'
+            }]}
+        } for attachment_index, attachment_path in enumerate(self._attachments.get(comment_id) or [])]
+        record = {**record, 'relationships': {**(record.get('relationships') or {}), 'attachments': {
+            'data': [{'id': attachment['id'], 'type': 'attachments'} for attachment in attachments]}}}
+        return {'data': record, 'included': attachments}
+
+    def attachment(self, comment_id, filename):
+        attachment_path = os.path.join(
+            self._comments_dir, f'{comment_id}_attachments', os.path.basename(filename))
+        if not os.path.exists(attachment_path):
+            return None
+        with open(attachment_path, 'rb') as attachment_input:
+            return attachment_input.read()
+
+
+def filter_date(value):
+    return api_date(datetime.strptime(value, FILTER_DATE_FORMAT))
+
+
+def select_items(items, query):
+    """
+    Applies the lastModifiedDate filters and sort of a listing query to
+    items sorted by (lastModifiedDate, id)
+    """
+    dates = [item['attributes'].get('lastModifiedDate') or '' for item in items]
+    lower, upper = 0, len(items)
+    if 'filter[lastModifiedDate][ge]' in query:
+        lower = bisect.bisect_left(dates, filter_date(
+            query['filter[lastModifiedDate][ge]']))
+    if 'filter[lastModifiedDate][le]' in query:
+        upper = bisect.bisect_right(dates, filter_date(
+            query['filter[lastModifiedDate][le]']))
+    selected = items[lower:max(lower, upper)]
+    if query.get('sort', '').startswith('-'):
+        selected = selected[::-1]
+    return selected
+
+
+class MockServerStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {'api_calls': 0, 'attachment_calls': 0, 'api_bytes': 0, 'attachment_bytes': 0,
+                       'injected_429s': 0, 'injected_5xxs': 0}
+
+    def add(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                self.counts[name] = self.counts[name] + value
+
+    def snapshot(self):
+        with self._lock:
+            return {**self.counts}
+
+
+class MockRegulationsHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send(self, status, body, content_type='application/json', headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-RateLimit-Limit', str(self.server.rate_limit))
+        self.send_header('X-RateLimit-Remaining', str(self.server.rate_limit))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.server.stats.add(api_calls=1, api_bytes=len(body))
+        self._send(status, body)
+
+    def _inject_fault(self):
+        if self.server.latency:
+            time.sleep(self.server.latency *
+                       (0.5 + self.server.chooser.random()))
+        if self.server.chooser.random() < self.server.rate_429:
+            self.server.stats.add(injected_429s=1)
+            self._send(429, b'{}', headers={
+                       'Retry-After': str(self.server.retry_after)})
+            return True
+        if self.server.chooser.random() < self.server.rate_5xx:
+            self.server.stats.add(injected_5xxs=1)
+            self._send(503, b'{}')
+            return True
+        return False
+
+    def _listing(self, items, query):
+        selected = select_items(items, query)
+        page_size = int(query.get('page[size]', 25))
+        page_number = int(query.get('page[number]', 1))
+        if page_number > MAX_PAGES:
+            self._send_json(400, {'errors': [{'detail': 'page[number] must be at most 20'}]})
+            return
+        page = selected[(page_number - 1) * page_size:page_number * page_size]
+        self._send_json(200, {'data': page, 'meta': {
+            'totalElements': len(selected),
+            'pageNumber': page_number,
+            'pageSize': page_size,
+            'hasNextPage': page_number * page_size < len(selected) and page_number < MAX_PAGES
+        }})
+
+    def _attachment(self, path):
+        match = re.match(rf'^{FILES_PREFIX}/([^/]+)/([^/]+)$', path)
+        content = self.server.docket.attachment(
+            *match.groups()) if match else None
+        if content is None:
+            self._send(404, b'')
+            return
+        start = 0
+        range_match = re.match(
+            r'^bytes=(\d+)-$', self.headers.get('Range') or '')
+        if range_match:
+            start = int(range_match.group(1))
+            if start >= len(content):
+                self._send(416, b'', 'application/pdf',
+                           {'Content-Range': f'bytes */{len(content)}'})
+                return
+        body = content[start:]
+        self.server.stats.add(attachment_calls=1, attachment_bytes=len(body))
+        if range_match:
+            self._send(206, body, 'application/pdf',
+                       {'Content-Range': f'bytes {start}-{len(content) - 1}/{len(content)}'})
+        else:
+            self._send(200, body, 'application/pdf')
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {key: values[-1]
+                 for key, values in parse_qs(url.query).items()}
+        if url.path == STATS_PATH:
+            self._send(200, json.dumps(
+                self.server.stats.snapshot()).encode('utf-8'))
+            return
+        if self._inject_fault():
+            return
+        if url.path.startswith(FILES_PREFIX):
+            self._attachment(url.path)
+            return
+        docket = self.server.docket
+        path = url.path[len(API_PREFIX):] if url.path.startswith(
+            API_PREFIX) else url.path
+        if path == f'/dockets/{docket.docket_id}':
+            self._send_json(200, {'data': docket.docket_details()})
+        elif path == '/documents':
+            documents = docket.documents() if query.get(
+                'filter[docketId]') == docket.docket_id else []
+            self._listing(documents, query)
+        elif path == '/comments':
+            self._listing(docket.listing(
+                query.get('filter[commentOnId]')), query)
+        elif path.startswith('/comments/'):
+            comment_id = path[len('/comments/'):]
+            if self.server.is_broken(comment_id):
+                self.server.stats.add(injected_5xxs=1)
+                self._send(500, b'{}')
+                return
+            files_url = f'http://{self.headers.get("Host")}{FILES_PREFIX}'
+            detail = docket.comment_detail(comment_id, files_url)
+            if detail is None:
+                self._send_json(404, {'errors': [{'detail': 'not found'}]})
+            else:
+                self._send_json(200, detail)
+        else:
+            self._send_json(404, {'errors': [{'detail': 'not found'}]})
+
+
+class MockRegulationsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, docket, latency=0.0, rate_429=0.0, rate_5xx=0.0, retry_after=1,
+                 rate_limit=DEFAULT_RATE_LIMIT, verbose=False, seed=1, broken_every=0):
+        super().__init__(address, MockRegulationsHandler)
+        self.docket = docket
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.retry_after = retry_after
+        self.rate_limit = rate_limit
+        self.verbose = verbose
+        self.chooser = random.Random(seed)
+        self.broken_every = broken_every
+        self.stats = MockServerStats()
+
+    def is_broken(self, comment_id):
+        """
+        True for every `broken_every`th comment (by the number its id ends
+        with), whose details always fail
+        """
+        number = re.search(r'(\d+)$', comment_id)
+        return bool(self.broken_every and number and int(number.group(1)) % self.broken_every == 0)
+
+
+def add_server_arguments(parser):
+    parser.add_argument('--docketid', default='BENCH-2021-0001',
+                        help='docket ID of the synthetic docket')
+    parser.add_argument('--documents', type=int, default=3,
+                        help='documents in the synthetic docket')
+    parser.add_argument('--comments', type=int, default=2000,
+                        help='comments per document')
+    parser.add_argument('--attachments', type=int, default=1,
+                        help='attachments per comment')
+    parser.add_argument('--attachmentkb', type=int, default=64,
+                        help='size of each attachment (KB)')
+    parser.add_argument('--renditions', default='pdf',
+                        help='comma separated formats each attachment is offered in')
+    parser.add_argument('--recorded',
+                        help='serve this downloaded docket instead of a synthetic one')
+    parser.add_argument('--latencyms', type=float, default=0,
+                        help='mean latency added to every response (ms)')
+    parser.add_argument('--rate429', type=float, default=0,
+                        help='fraction of requests answered with a 429')
+    parser.add_argument('--rate5xx', type=float, default=0,
+                        help='fraction of requests answered with a 503')
+    parser.add_argument('--retryafter', type=int, default=1,
+                        help='Retry-After (seconds) sent with injected 429s')
+    parser.add_argument('--ratelimit', type=int, default=DEFAULT_RATE_LIMIT,
+                        help='requests per hour reported in the rate limit headers')
+    parser.add_argument('--brokencomments', type=int, default=0,
+                        help='answer the details of every Nth comment with a 500, always')
+
+
+def create_server(args, port=0, verbose=False):
+    if args.recorded:
+        docket = RecordedDocket(args.recorded)
+    else:
+        docket = SyntheticDocket(args.docketid, args.documents, args.comments,
+                                 args.attachments, args.attachmentkb * 1024,
+                                 renditions=args.renditions.split(','))
+    return MockRegulationsServer(('127.0.0.1', port), docket, args.latencyms / 1000.0,
+                                 args.rate429, args.rate5xx, args.retryafter, args.ratelimit, verbose,
+                                 broken_every=args.brokencomments)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--verbose', action='store_true',
+                        help='log every request')
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    server = create_server(args, args.port, args.verbose)
+    print(f'listening on http://127.0.0.1:{server.server_address[1]}{API_PREFIX} '
+          f'(docket {server.docket.docket_id})', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
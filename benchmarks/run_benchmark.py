@@ -0,0 +1,130 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fdms_archive_downloader import FDMSArchiveDownloader  # noqa: E402
+from mock_regulations_server import add_server_arguments, create_server, API_PREFIX, STATS_PATH  # noqa: E402
+
+"""
+End-to-end download benchmark against the local mock API
+
+python benchmarks/run_benchmark.py [--workers 8] [--comments 2000] [--latencyms 50] [--rate429 0.01] ...
+
+Starts the mock server (see mock_regulations_server.py) in its own process,
+downloads its docket with FDMSArchiveDownloader into a scratch directory,
+and reports comments/sec, attachment bytes/sec, API calls per comment and
+the downloader's peak RSS. `--json` also writes the results to a file, so
+runs can be compared over time.
+"""
+
+
+def _serve(args, port_queue):
+    server = create_server(args)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_mock_server(args):
+    port_queue = multiprocessing.Queue()
+    server_process = multiprocessing.Process(
+        target=_serve, args=(args, port_queue), daemon=True)
+    server_process.start()
+    return server_process, port_queue.get(timeout=60)
+
+
+def server_stats(port):
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}{STATS_PATH}') as response:
+        return json.loads(response.read())
+
+
+def peak_rss_mb():
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform == 'darwin':
+        return peak_rss / (1024 * 1024)
+    return peak_rss / 1024
+
+
+def run_benchmark(args):
+    server_process, port = start_mock_server(args)
+    output_directory = args.output or tempfile.mkdtemp(prefix='fdms_benchmark_')
+    logger = logging.getLogger('benchmark')
+    config = {
+        'api_key': 'benchmark',
+        'api_base_url': f'http://127.0.0.1:{port}{API_PREFIX}',
+        **(json.loads(args.config) if args.config else {})
+    }
+    try:
+        downloader = FDMSArchiveDownloader(logger, config['api_key'], server_docket_id(args),
+                                           output_directory, resume_download=False,
+                                           workers=args.workers, config=config,
+                                           attachment_workers=args.attachmentworkers)
+        start_time = time.time()
+        downloader.download_archive()
+        elapsed = time.time() - start_time
+        stats = server_stats(port)
+    finally:
+        server_process.terminate()
+        if not args.output and not args.keep:
+            shutil.rmtree(output_directory, ignore_errors=True)
+
+    comments = max(1, downloader._completed_comments)
+    return {
+        'workers': args.workers,
+        'attachment_workers': args.attachmentworkers or args.workers,
+        'comments': downloader._completed_comments,
+        'seconds': round(elapsed, 3),
+        'comments_per_second': round(comments / elapsed, 2),
+        'attachment_bytes_per_second': round(stats['attachment_bytes'] / elapsed),
+        'api_calls': stats['api_calls'],
+        'api_calls_per_comment': round(stats['api_calls'] / comments, 3),
+        'attachment_calls': stats['attachment_calls'],
+        'injected_429s': stats['injected_429s'],
+        'injected_5xxs': stats['injected_5xxs'],
+        'peak_rss_mb': round(peak_rss_mb(), 1)
+    }
+
+
+def server_docket_id(args):
+    if args.recorded:
+        with open(os.path.join(args.recorded, 'docket_details.json'), encoding='utf-8') as details_input:
+            return json.load(details_input)['id']
+    return args.docketid
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', '--workers', type=int, default=8,
+                        help='number of concurrent comment detail fetches')
+    parser.add_argument('--attachmentworkers', type=int,
+                        help='number of concurrent attachment downloads (default: --workers)')
+    parser.add_argument('-o', '--output',
+                        help='download into this directory (and keep it) instead of a scratch directory')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the scratch download directory')
+    parser.add_argument('--config',
+                        help='extra config.json settings for the downloader, as JSON')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--verbose', action='store_true',
+                        help='show the downloader log')
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='[%(asctime)s] %(message)s',
+                        level=logging.INFO if args.verbose else logging.WARNING)
+    results = run_benchmark(args)
+    for name, value in results.items():
+        print(f'{name}: {value}')
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as results_output:
+            json.dump(results, results_output, indent=2)
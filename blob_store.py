@@ -0,0 +1,102 @@
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+"""
+A content-addressed store for attachment files
+
+BlobStore(store_directory)
+
+Files are kept once, under `blobs/{sha[:2]}/{sha256}`, no matter how many
+comments (or dockets) attach them - each comment's attachment folder gets
+a hardlink to the stored file (or a copy, where the store is on another
+filesystem). The store also remembers which URL gave which file, so an
+attachment URL that has been downloaded before is linked straight from
+the store without being fetched again.
+
+The store directory may be shared by any number of dockets (and processes).
+"""
+
+
+def file_sha256(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(HASH_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def link_or_copy(source_path, target_path):
+    """
+    Atomically places a hardlink to (or if that is not possible, a copy of)
+    the source file at the target path
+    """
+    temp_path = f'{target_path}.{os.getpid()}.{threading.get_ident()}.link'
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+    try:
+        os.link(source_path, temp_path)
+    except OSError:
+        shutil.copyfile(source_path, temp_path)
+    os.replace(temp_path, target_path)
+
+
+class BlobStore:
+    def __init__(self, store_directory):
+        self._blob_directory = os.path.join(store_directory, 'blobs')
+        os.makedirs(self._blob_directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(os.path.join(store_directory, 'url_index.db'),
+                                           check_same_thread=False,
+                                           isolation_level=None,
+                                           timeout=60)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, sha256 TEXT NOT NULL, size INTEGER NOT NULL)')
+
+    def blob_path(self, sha256):
+        return os.path.join(self._blob_directory, sha256[:2], sha256)
+
+    def hash_for_url(self, url):
+        """
+        Returns the hash of the file previously downloaded from the URL,
+        if it is (still) in the store
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT sha256 FROM urls WHERE url = ?', (url,)).fetchone()
+        if row is None or not os.path.exists(self.blob_path(row[0])):
+            return None
+        return row[0]
+
+    def link_to(self, sha256, target_path):
+        link_or_copy(self.blob_path(sha256), target_path)
+
+    def add_file(self, path, url=None):
+        """
+        Adds a downloaded file to the store (replacing the file with a link
+        to the stored copy if the store already had it), and records the
+        URL it came from. Returns the file's hash.
+        """
+        sha256 = file_sha256(path)
+        blob_path = self.blob_path(sha256)
+        if os.path.exists(blob_path):
+            link_or_copy(blob_path, path)
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            link_or_copy(path, blob_path)
+        if url:
+            with self._lock:
+                self._connection.execute('INSERT OR REPLACE INTO urls (url, sha256, size) VALUES (?, ?, ?)',
+                                         (url, sha256, os.path.getsize(blob_path)))
+        return sha256
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
@@ -0,0 +1,156 @@
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from comment_store import open_comment_store
+
+EXTRACT_STATE_FILENAME = '__extract_state.db'
+EXTRACT_BATCH_SIZE = 500
+
+"""
+Extraction of comment text from a downloaded docket
+
+extract_comment_records(logger, comments_dir, extract_output_dir, processes)
+
+Writes a `{commentId}-comment.txt` for every comment record, spreading
+batches of records over a pool of processes. The version of each record
+that was extracted (its file's mtime and size, or its place in a shard)
+is kept in `__extract_state.db` in the output directory, so records that
+have not changed since the last extraction are skipped without being
+read - after a sync, only the changed comments are extracted again.
+"""
+
+headers_to_ignore = ["displayProperties", "comment"]
+
+
+def extract_comment_headers(comment_data):
+    ret = {}
+    for key, value in comment_data.items():
+        if key in headers_to_ignore:
+            continue
+        if not value:
+            continue
+        ret[key] = value
+    return ret
+
+
+def extract_comment_body(comment_data):
+    if not "comment" in comment_data:
+        return None
+    return comment_data["comment"]
+
+
+def extract_write_comment(output_dir, comment_data):
+    """
+    Writes the comment's headers and body to `{commentId}-comment.txt`,
+    returning the filename (or None if the comment has no body)
+    """
+    if not comment_data or not "id" in comment_data or not "attributes" in comment_data or not "type" in comment_data:
+        return None
+    comment_id = comment_data["id"]
+    comment_headers = extract_comment_headers(comment_data["attributes"])
+    comment_body = extract_comment_body(comment_data["attributes"])
+    if not comment_body:
+        return None
+
+    output_filename = f"{comment_id}-comment.txt"
+    with open(os.path.join(output_dir, output_filename), 'w', encoding='utf-8') as output:
+        for key, value in comment_headers.items():
+            output.write(f"{key}: {value}" + os.linesep)
+        output.write(os.linesep)
+        output.write(comment_body + os.linesep)
+    return output_filename
+
+
+# each worker process opens the comment store once
+_worker_stores = {}
+
+
+def _extract_batch(comments_dir, extract_output_dir, keys):
+    comment_store = _worker_stores.get(comments_dir)
+    if comment_store is None:
+        comment_store = open_comment_store(comments_dir)
+        _worker_stores[comments_dir] = comment_store
+    return [(key, extract_write_comment(extract_output_dir, comment_store.read_entry(key)) or '')
+            for key in keys]
+
+
+class ExtractState:
+    def __init__(self, extract_output_dir):
+        self._connection = sqlite3.connect(os.path.join(extract_output_dir, EXTRACT_STATE_FILENAME),
+                                           isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS extracted (key TEXT PRIMARY KEY, version TEXT NOT NULL, output TEXT NOT NULL)')
+
+    def is_current(self, extract_output_dir, key, version):
+        row = self._connection.execute(
+            'SELECT version, output FROM extracted WHERE key = ?', (key,)).fetchone()
+        if row is None or row[0] != version:
+            return False
+        # a record with no body has no output file to check
+        return not row[1] or os.path.exists(os.path.join(extract_output_dir, row[1]))
+
+    def record(self, results, versions):
+        self._connection.execute('BEGIN')
+        self._connection.executemany('INSERT OR REPLACE INTO extracted (key, version, output) VALUES (?, ?, ?)',
+                                     ((key, versions[key], output) for key, output in results))
+        self._connection.execute('COMMIT')
+
+    def close(self):
+        self._connection.close()
+
+
+def _pending_batches(comment_store, state, extract_output_dir, counts):
+    """
+    Yields ({key: version}) batches of the records that need extracting
+    """
+    batch = {}
+    for key, version in comment_store.iter_entries():
+        if state.is_current(extract_output_dir, key, version):
+            counts['skipped'] += 1
+            continue
+        batch[key] = version
+        if len(batch) >= EXTRACT_BATCH_SIZE:
+            yield batch
+            batch = {}
+    if batch:
+        yield batch
+
+
+def extract_comment_records(logger, comments_dir, extract_output_dir, processes=None):
+    if not os.path.exists(extract_output_dir):
+        os.makedirs(extract_output_dir)
+    processes = processes or os.cpu_count() or 1
+    counts = {'extracted': 0, 'written': 0, 'skipped': 0}
+    start_time = time.time()
+
+    comment_store = open_comment_store(comments_dir)
+    state = ExtractState(extract_output_dir)
+    try:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            in_flight = []
+            for batch in _pending_batches(comment_store, state, extract_output_dir, counts):
+                in_flight.append((executor.submit(
+                    _extract_batch, comments_dir, extract_output_dir, list(batch)), batch))
+                # keep a few batches queued per process, recording the oldest as they finish
+                while len(in_flight) > processes * 2:
+                    _record_batch(state, counts, *in_flight.pop(0))
+            for future, batch in in_flight:
+                _record_batch(state, counts, future, batch)
+    finally:
+        state.close()
+        comment_store.close()
+
+    elapsed = max(time.time() - start_time, 0.001)
+    logger.info(f'extracted {counts["extracted"]} comments ({counts["written"]} with text) and skipped '
+                f'{counts["skipped"]} unchanged in {elapsed:.1f}s with {processes} processes '
+                f'({counts["extracted"] / elapsed:.1f} comments/s)')
+    return counts
+
+
+def _record_batch(state, counts, future, batch):
+    results = future.result()
+    state.record(results, batch)
+    counts['extracted'] += len(results)
+    counts['written'] += sum(1 for _, output in results if output)
@@ -0,0 +1,282 @@
+import gzip
+import os
+import re
+import sqlite3
+import threading
+from json_utils import write_json_output, read_json_input, json_dumps_bytes, json_loads
+
+SHARD_DIRECTORY = 'shards'
+SHARD_INDEX_FILENAME = 'index.db'
+DEFAULT_COMMENT_STORE_SETTINGS = {
+    'layout': 'files',
+    'compression': 'gzip',
+    'max_shard_bytes': 64 * 1024 * 1024
+}
+COMMENT_STORE_LAYOUTS = ['files', 'shards']
+SHARD_EXTENSIONS = {
+    'gzip': 'gz',
+    'zstd': 'zst'
+}
+
+"""
+Storage for the comment detail records of a downloaded docket
+
+The `comment_store` section of config.json picks the layout, e.g.:
+
+    "comment_store": {"layout": "shards", "compression": "zstd", "max_shard_bytes": 67108864}
+
+* `files` (the default) - one `{documentId}_{commentId}.json` file per
+  comment in the comments directory
+* `shards` - comment records are appended (one compressed JSON line each)
+  to size-bounded shard files, `shards/comments-{n}.jsonl.gz` (or `.zst`),
+  with an index (`shards/index.db`) of where each comment's record is, so
+  any one comment can be read without scanning a shard. Zstandard needs the
+  `zstandard` package; gzip needs nothing extra.
+
+Attachments are kept in `{commentId}_attachments` folders in either layout.
+Readers use `open_comment_store`, which works out the layout of an existing
+comments directory.
+"""
+
+
+def comment_store_settings(config):
+    store_config = (config or {}).get('comment_store') or {}
+    settings = {**DEFAULT_COMMENT_STORE_SETTINGS, **store_config}
+    if settings['layout'] not in COMMENT_STORE_LAYOUTS:
+        raise Exception(
+            f"unknown comment_store layout: {settings['layout']} (expected one of {COMMENT_STORE_LAYOUTS})")
+    if settings['compression'] not in SHARD_EXTENSIONS:
+        raise Exception(
+            f"unknown comment_store compression: {settings['compression']} (expected one of {list(SHARD_EXTENSIONS)})")
+    return settings
+
+
+def create_comment_store(config, comments_dir):
+    """
+    Returns the comment store for a download, as configured - or, if the
+    comments directory already holds shards, the sharded store
+    """
+    settings = comment_store_settings(config)
+    if settings['layout'] == 'shards' or is_sharded(comments_dir):
+        return ShardedCommentStore(comments_dir, settings['compression'], settings['max_shard_bytes'])
+    return FileCommentStore(comments_dir)
+
+
+def open_comment_store(comments_dir):
+    if is_sharded(comments_dir):
+        return ShardedCommentStore(comments_dir)
+    return FileCommentStore(comments_dir)
+
+
+def is_sharded(comments_dir):
+    return os.path.exists(os.path.join(comments_dir, SHARD_DIRECTORY, SHARD_INDEX_FILENAME))
+
+
+class FileCommentStore:
+    def __init__(self, comments_dir):
+        self._comments_dir = comments_dir
+        os.makedirs(comments_dir, exist_ok=True)
+
+    def _record_path(self, document_id, comment_id):
+        return os.path.join(self._comments_dir, f'{document_id}_{comment_id}.json')
+
+    def write(self, document_id, comment_id, record):
+        write_json_output(self._record_path(document_id, comment_id), record)
+
+    def get(self, document_id, comment_id):
+        record_path = self._record_path(document_id, comment_id)
+        if not os.path.exists(record_path):
+            return None
+        return read_json_input(record_path)
+
+    def iter_records(self):
+        for entry in os.scandir(self._comments_dir):
+            if entry.is_file() and entry.name.endswith('.json'):
+                yield read_json_input(entry.path)
+
+    def iter_entries(self):
+        """
+        Yields (key, version) for every record without reading it - the
+        version changes whenever the record is rewritten
+        """
+        for entry in os.scandir(self._comments_dir):
+            if entry.is_file() and entry.name.endswith('.json'):
+                stat = entry.stat()
+                yield entry.name, f'{stat.st_mtime_ns}:{stat.st_size}'
+
+    def read_entry(self, key):
+        return read_json_input(os.path.join(self._comments_dir, key))
+
+    def close(self):
+        pass
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception(
+            'zstd compressed comment shards need the zstandard package (pip install zstandard)')
+    return zstandard
+
+
+class ShardedCommentStore:
+    def __init__(self, comments_dir, compression='gzip',
+                 max_shard_bytes=DEFAULT_COMMENT_STORE_SETTINGS['max_shard_bytes']):
+        self._shard_dir = os.path.join(comments_dir, SHARD_DIRECTORY)
+        os.makedirs(self._shard_dir, exist_ok=True)
+        self._max_shard_bytes = max_shard_bytes
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(os.path.join(self._shard_dir, SHARD_INDEX_FILENAME),
+                                           check_same_thread=False,
+                                           isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS records (
+            comment_id TEXT PRIMARY KEY, document_id TEXT NOT NULL, shard TEXT NOT NULL,
+            offset INTEGER NOT NULL, length INTEGER NOT NULL)''')
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS records_position ON records (shard, offset)')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        # an existing store keeps the compression it was created with
+        row = self._connection.execute(
+            "SELECT value FROM settings WHERE key = 'compression'").fetchone()
+        if row is None:
+            self._connection.execute(
+                "INSERT INTO settings (key, value) VALUES ('compression', ?)", (compression,))
+        else:
+            compression = row[0]
+        self._compression = compression
+        if compression == 'zstd':
+            zstandard = _zstandard()
+            self._compressor = zstandard.ZstdCompressor()
+            self._decompressor = zstandard.ZstdDecompressor()
+        self._shard_name = None
+        self._shard_output = None
+        # zstandard (de)compressors are not thread-safe
+        self._codec_lock = threading.Lock()
+
+    def _compress(self, data):
+        if self._compression == 'zstd':
+            with self._codec_lock:
+                return self._compressor.compress(data)
+        return gzip.compress(data)
+
+    def _decompress(self, data):
+        if self._compression == 'zstd':
+            with self._codec_lock:
+                return self._decompressor.decompress(data)
+        return gzip.decompress(data)
+
+    def _shard_filename(self, shard_number):
+        return f'comments-{shard_number:05d}.jsonl.{SHARD_EXTENSIONS[self._compression]}'
+
+    def _shard_numbers(self):
+        shard_pattern = re.compile(r'^comments-(\d+)\.jsonl\.')
+        return sorted(int(match.group(1)) for match in
+                      (shard_pattern.match(name) for name in os.listdir(self._shard_dir)) if match)
+
+    def _open_shard(self, record_size):
+        """
+        Returns the shard file to append the next record to - the latest
+        shard, until it would grow past max_shard_bytes
+        """
+        if self._shard_output is None:
+            shard_numbers = self._shard_numbers()
+            shard_number = shard_numbers[-1] if shard_numbers else 0
+            self._shard_name = self._shard_filename(shard_number)
+            self._shard_output = open(os.path.join(
+                self._shard_dir, self._shard_name), 'ab')
+        offset = self._shard_output.seek(0, os.SEEK_END)
+        if offset > 0 and offset + record_size > self._max_shard_bytes:
+            self._shard_output.close()
+            shard_number = self._shard_numbers()[-1] + 1
+            self._shard_name = self._shard_filename(shard_number)
+            self._shard_output = open(os.path.join(
+                self._shard_dir, self._shard_name), 'ab')
+            offset = 0
+        return offset
+
+    def write(self, document_id, comment_id, record):
+        """
+        Appends the comment's record to the current shard - a record that is
+        written again (e.g. by a sync) replaces the earlier one in the index
+        """
+        data = self._compress(json_dumps_bytes(record) + b'\n')
+        with self._lock:
+            offset = self._open_shard(len(data))
+            self._shard_output.write(data)
+            # the record must be on disk before the index points at it
+            self._shard_output.flush()
+            self._connection.execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)',
+                                     (comment_id, document_id, self._shard_name, offset, len(data)))
+
+    def _read_record(self, shard_input, offset, length):
+        shard_input.seek(offset)
+        return json_loads(self._decompress(shard_input.read(length)))
+
+    def get(self, document_id, comment_id):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT shard, offset, length FROM records WHERE comment_id = ?', (comment_id,)).fetchone()
+        if row is None:
+            return None
+        shard_name, offset, length = row
+        with open(os.path.join(self._shard_dir, shard_name), 'rb') as shard_input:
+            return self._read_record(shard_input, offset, length)
+
+    def iter_records(self, batch_size=1000):
+        """
+        Yields every comment record, reading the shards in order
+        """
+        last_position = ('', -1)
+        shard_name, shard_input = None, None
+        try:
+            while True:
+                with self._lock:
+                    rows = self._connection.execute(
+                        '''SELECT shard, offset, length FROM records WHERE (shard, offset) > (?, ?)
+                           ORDER BY shard, offset LIMIT ?''', (*last_position, batch_size)).fetchall()
+                if not rows:
+                    return
+                for row_shard, offset, length in rows:
+                    if row_shard != shard_name:
+                        if shard_input is not None:
+                            shard_input.close()
+                        shard_name = row_shard
+                        shard_input = open(os.path.join(
+                            self._shard_dir, shard_name), 'rb')
+                    yield self._read_record(shard_input, offset, length)
+                last_position = rows[-1][:2]
+        finally:
+            if shard_input is not None:
+                shard_input.close()
+
+    def iter_entries(self, batch_size=1000):
+        """
+        Yields (key, version) for every record without reading it - the
+        version changes whenever the record is rewritten
+        """
+        last_comment_id = ''
+        while True:
+            with self._lock:
+                rows = self._connection.execute(
+                    'SELECT comment_id, shard, offset FROM records WHERE comment_id > ? ORDER BY comment_id LIMIT ?',
+                    (last_comment_id, batch_size)).fetchall()
+            if not rows:
+                return
+            for comment_id, shard_name, offset in rows:
+                yield comment_id, f'{shard_name}:{offset}'
+            last_comment_id = rows[-1][0]
+
+    def read_entry(self, key):
+        return self.get(None, key)
+
+    def close(self):
+        with self._lock:
+            if self._shard_output is not None:
+                self._shard_output.close()
+                self._shard_output = None
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
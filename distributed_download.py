@@ -0,0 +1,468 @@
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from comment_store import comment_store_settings
+from fdms_archive_downloader import FDMSArchiveDownloader, API_DATE_FORMAT
+from json_utils import json_dumps, json_loads
+from request_retry import RequestFailed
+
+WORK_QUEUE_FILENAME = '__work_queue.db'
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_LEASE_SECONDS = 600
+# a batch that has been leased this many times without completing is failed
+MAX_BATCH_ATTEMPTS = 5
+WORK_QUEUE_POLL_SECONDS = 10
+BATCH_STATES = ['pending', 'leased', 'done', 'failed']
+
+"""
+A download of one docket shared by several processes (or hosts)
+
+DocketCoordinator(logger, api_key, docket_id, output_directory, workers,
+                  config, batch_size).coordinate()
+DocketWorker(logger, api_key, output_directory, workers, config,
+             attachment_workers, lease_seconds).work()
+
+The output directory is on storage that every host can reach. The
+coordinator fetches the docket, its documents and the comment listings
+once, queueing the comment ids in batches in a work queue
+(`__work_queue.db` in the output directory). Each worker - with its own
+config, and so its own API key(s) - leases a batch at a time, fetches the
+comments' details and attachments into the output directory, and reports
+the batch complete with each comment's attachments.
+
+A lease expires after `lease_seconds` unless the worker holding it renews
+it (which it does while it works), so the batches of a crashed worker go
+back to the queue, and a worker that has lost its lease discards its
+results rather than reporting them. Batches that fail (because the API
+kept failing) or expire MAX_BATCH_ATTEMPTS times are set aside as failed,
+and retried the next time the coordinator is started. A worker that fails
+in any other way (e.g. its API key is rejected) hands its batch back
+without counting the attempt, and stops. A comment the worker had to give up on
+(see FDMSArchiveDownloader._dead_letter) does not fail its batch - it is
+reported as a dead letter with the batch's other results, and queued again
+the next time the coordinator is started.
+
+Once every batch is complete, the coordinator records the comments in the
+resume journal and writes comment_attachments.json (and dead_letters.json),
+exactly as a single-process download would - so the output is the same,
+and a later --sync of the docket works as usual.
+"""
+
+
+def _check_comment_store(config):
+    if comment_store_settings(config)['layout'] != 'files':
+        raise Exception(
+            'a distributed download needs the files comment_store layout - shards cannot be shared between hosts')
+
+
+class WorkQueue:
+    def __init__(self, output_directory):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(os.path.join(output_directory, WORK_QUEUE_FILENAME),
+                                           check_same_thread=False,
+                                           isolation_level=None,
+                                           timeout=60)
+        # not WAL - it relies on shared memory, which hosts sharing the
+        # file over a network filesystem do not have
+        self._connection.execute('PRAGMA journal_mode=DELETE')
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS batches (
+                id INTEGER PRIMARY KEY, state TEXT NOT NULL DEFAULT 'pending', owner TEXT,
+                lease_expires REAL, attempts INTEGER NOT NULL DEFAULT 0, error TEXT);
+            CREATE INDEX IF NOT EXISTS batches_state ON batches (state);
+            CREATE TABLE IF NOT EXISTS items (
+                comment_id TEXT PRIMARY KEY, batch_id INTEGER NOT NULL,
+                done INTEGER NOT NULL DEFAULT 0, attachments TEXT, dead_letter TEXT);
+            CREATE INDEX IF NOT EXISTS items_batch ON items (batch_id);
+        ''')
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            # take the write lock up front, so two workers cannot lease the same batch
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._connection
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
+
+    def get_setting(self, key, default=None):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT value FROM settings WHERE key = ?', (key,)).fetchone()
+        return json_loads(row[0]) if row is not None else default
+
+    def set_setting(self, key, value):
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)',
+                                     (key, json_dumps(value)))
+
+    def add_batch(self, comment_ids):
+        """
+        Queues a batch of comment ids - any that are already queued (by an
+        earlier, interrupted listing) are left where they are
+        """
+        with self._transaction() as connection:
+            batch_id = connection.execute(
+                'INSERT INTO batches (state) VALUES (?)', ('pending',)).lastrowid
+            added = connection.executemany('INSERT OR IGNORE INTO items (comment_id, batch_id) VALUES (?, ?)',
+                                           ((comment_id, batch_id) for comment_id in comment_ids)).rowcount
+            if added == 0:
+                connection.execute(
+                    'DELETE FROM batches WHERE id = ?', (batch_id,))
+
+    def lease(self, worker_id, lease_seconds):
+        """
+        Leases the next pending (or expired) batch to the worker, returning
+        (batch id, comment ids) - or None if there is none to lease
+        """
+        with self._transaction() as connection:
+            while True:
+                now = time.time()
+                row = connection.execute('''SELECT id, attempts FROM batches
+                    WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?)
+                    ORDER BY id LIMIT 1''', (now,)).fetchone()
+                if row is None:
+                    return None
+                batch_id, attempts = row
+                if attempts >= MAX_BATCH_ATTEMPTS:
+                    connection.execute('''UPDATE batches SET state = 'failed', owner = NULL,
+                        error = COALESCE(error, 'lease expired') WHERE id = ?''', (batch_id,))
+                    continue
+                connection.execute('''UPDATE batches SET state = 'leased', owner = ?, lease_expires = ?,
+                    attempts = attempts + 1 WHERE id = ?''', (worker_id, now + lease_seconds, batch_id))
+                comment_ids = [comment_id for comment_id, in connection.execute(
+                    'SELECT comment_id FROM items WHERE batch_id = ? ORDER BY rowid', (batch_id,))]
+                return batch_id, comment_ids
+
+    def renew(self, batch_id, worker_id, lease_seconds):
+        """
+        Extends the worker's lease of the batch. Returns False if the worker
+        no longer holds it.
+        """
+        with self._transaction() as connection:
+            return connection.execute('''UPDATE batches SET lease_expires = ?
+                WHERE id = ? AND owner = ? AND state = 'leased' ''',
+                                      (time.time() + lease_seconds, batch_id, worker_id)).rowcount > 0
+
+    def complete(self, batch_id, worker_id, results, dead_letters=()):
+        """
+        Records the (comment id, attachments) results of a batch, and the
+        (comment id, dead letter) of the comments that could not be
+        downloaded. Returns False (recording nothing) if the worker no
+        longer holds the lease.
+        """
+        with self._transaction() as connection:
+            row = connection.execute(
+                'SELECT state, owner FROM batches WHERE id = ?', (batch_id,)).fetchone()
+            if row is None or row[0] != 'leased' or row[1] != worker_id:
+                return False
+            connection.executemany('UPDATE items SET done = 1, attachments = ? WHERE comment_id = ?',
+                                   ((json_dumps(these_attachments), comment_id)
+                                    for comment_id, these_attachments in results))
+            connection.executemany('UPDATE items SET done = 1, attachments = NULL, dead_letter = ? WHERE comment_id = ?',
+                                   ((json_dumps(dead_letter), comment_id)
+                                    for comment_id, dead_letter in dead_letters))
+            connection.execute('''UPDATE batches SET state = 'done', owner = NULL, lease_expires = NULL,
+                error = NULL WHERE id = ?''', (batch_id,))
+            return True
+
+    def release(self, batch_id, worker_id, error, count_attempt=True):
+        """
+        Returns a batch the worker could not complete to the queue (or sets
+        it aside as failed, once it has been tried MAX_BATCH_ATTEMPTS times).
+        Without `count_attempt` (when it was the worker that failed, not the
+        batch) the attempt does not count.
+        """
+        with self._transaction() as connection:
+            if not count_attempt:
+                connection.execute('''UPDATE batches SET attempts = attempts - 1
+                    WHERE id = ? AND owner = ? AND state = 'leased' AND attempts > 0''', (batch_id, worker_id))
+            connection.execute('''UPDATE batches SET
+                state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                owner = NULL, lease_expires = NULL, error = ?
+                WHERE id = ? AND owner = ? AND state = 'leased' ''',
+                               (MAX_BATCH_ATTEMPTS, error, batch_id, worker_id))
+
+    def retry_failed(self):
+        with self._transaction() as connection:
+            return connection.execute('''UPDATE batches SET state = 'pending', attempts = 0
+                WHERE state = 'failed' ''').rowcount
+
+    def retry_dead_letters(self):
+        """
+        Queues the dead-lettered comments again, in a batch of their own -
+        returns the number of comments
+        """
+        with self._transaction() as connection:
+            if connection.execute('SELECT 1 FROM items WHERE dead_letter IS NOT NULL LIMIT 1').fetchone() is None:
+                return 0
+            batch_id = connection.execute(
+                'INSERT INTO batches (state) VALUES (?)', ('pending',)).lastrowid
+            return connection.execute('''UPDATE items SET batch_id = ?, done = 0, dead_letter = NULL
+                WHERE dead_letter IS NOT NULL''', (batch_id,)).rowcount
+
+    def progress(self):
+        """
+        Returns the number of batches in each state, and of comments queued
+        and done
+        """
+        with self._lock:
+            ret = {state: 0 for state in BATCH_STATES}
+            for state, count in self._connection.execute('SELECT state, COUNT(*) FROM batches GROUP BY state'):
+                ret[state] = count
+            ret['comments'], ret['done_comments'] = self._connection.execute(
+                'SELECT COUNT(*), COALESCE(SUM(done), 0) FROM items').fetchone()
+        return ret
+
+    def is_finished(self):
+        """
+        Returns True once the queue is complete and nothing is left to lease
+        """
+        progress = self.progress()
+        return bool(self.get_setting('listing_complete')) and progress['pending'] == 0 and progress['leased'] == 0
+
+    def iter_results(self, batch_size=1000):
+        """
+        Yields (comment id, attachments) for every completed comment, in
+        comment id order
+        """
+        last_comment_id = ''
+        while True:
+            with self._lock:
+                rows = self._connection.execute('''SELECT comment_id, attachments FROM items
+                    WHERE done = 1 AND dead_letter IS NULL AND comment_id > ? ORDER BY comment_id LIMIT ?''',
+                                                (last_comment_id, batch_size)).fetchall()
+            if not rows:
+                return
+            for comment_id, these_attachments in rows:
+                yield comment_id, json_loads(these_attachments)
+            last_comment_id = rows[-1][0]
+
+    def dead_letters(self):
+        """
+        Returns (comment id, dead letter) for every comment the workers
+        could not download
+        """
+        with self._lock:
+            return [(comment_id, json_loads(dead_letter)) for comment_id, dead_letter in self._connection.execute(
+                'SELECT comment_id, dead_letter FROM items WHERE dead_letter IS NOT NULL ORDER BY comment_id')]
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+class DocketCoordinator(FDMSArchiveDownloader):
+    def __init__(self, logger, api_key, docket_id, output_directory, workers=1, config=None,
+                 batch_size=DEFAULT_BATCH_SIZE):
+        _check_comment_store(config)
+        super().__init__(logger, api_key, docket_id, output_directory,
+                         resume_download=True, workers=workers, config=config)
+        self._batch_size = max(1, batch_size)
+
+    def _queue_comments(self, work_queue, comments_dir):
+        documents_info = self._gather_docket_and_documents()
+        comment_pipe, listing_thread = self._start_comment_listing(
+            comments_dir, documents_info)
+        try:
+            batch = []
+            for comment_id in comment_pipe:
+                batch.append(comment_id)
+                if len(batch) >= self._batch_size:
+                    work_queue.add_batch(batch)
+                    batch = []
+            if batch:
+                work_queue.add_batch(batch)
+        except BaseException:
+            comment_pipe.abort()
+            raise
+        finally:
+            listing_thread.join()
+        work_queue.set_setting('listing_complete', True)
+
+    def _wait_for_workers(self, work_queue, poll_seconds):
+        while True:
+            progress = work_queue.progress()
+            self._metrics.set_progress(
+                progress['done_comments'], progress['comments'])
+            self._logger.info(
+                f"---- {progress['done_comments']} of {progress['comments']} comments done "
+                f"({progress['pending']} batches pending, {progress['leased']} leased, {progress['failed']} failed)")
+            if progress['pending'] == 0 and progress['leased'] == 0:
+                if progress['failed']:
+                    raise Exception(
+                        f"{progress['failed']} batches failed - start the coordinator again to retry them")
+                return
+            time.sleep(poll_seconds)
+
+    def coordinate(self, poll_seconds=WORK_QUEUE_POLL_SECONDS):
+        """
+        Queues the docket's comments for the workers, waits for them to
+        finish, and then completes the download
+        """
+        self._logger.info('----------------')
+        self._logger.info(f'coordinating download to: {self._output_directory}')
+        self._logger.info('')
+
+        start_time = time.time()
+        work_queue = WorkQueue(self._output_directory)
+        try:
+            self._resume_info = self._open_resume_info()
+            self._start_metrics()
+            if 'run_started' not in self._resume_info:
+                self._resume_info['run_started'] = datetime.utcnow().strftime(
+                    API_DATE_FORMAT)
+
+            queued_docket_id = work_queue.get_setting('docket_id')
+            if queued_docket_id is not None and queued_docket_id != self._docket_id:
+                raise Exception(
+                    f'the work queue in {self._output_directory} is for docket {queued_docket_id}')
+            work_queue.set_setting('docket_id', self._docket_id)
+            retried = work_queue.retry_failed()
+            if retried:
+                self._logger.info(f'- retrying {retried} failed batches')
+            retried = work_queue.retry_dead_letters()
+            if retried:
+                self._logger.info(
+                    f'- retrying {retried} comments that could not be downloaded before')
+
+            comments_dir = self._open_comments_dir()
+            if not work_queue.get_setting('listing_complete'):
+                self._queue_comments(work_queue, comments_dir)
+            else:
+                self._logger.info('- comments already queued, skipping...')
+
+            self._logger.info('-------- waiting for the workers --------')
+            self._wait_for_workers(work_queue, poll_seconds)
+
+            self._resume_info.update((f"comment_{comment_id}", these_attachments)
+                                     for comment_id, these_attachments in work_queue.iter_results())
+            dead_letters = work_queue.dead_letters()
+            dead_ids = set(comment_id for comment_id, _ in dead_letters)
+            for comment_id in self._dead_letters - dead_ids:
+                del self._resume_info[f"dead_{comment_id}"]
+            self._resume_info.update((f"dead_{comment_id}", dead_letter)
+                                     for comment_id, dead_letter in dead_letters)
+            self._write_comment_attachments()
+            self._write_dead_letters()
+            self._complete_run()
+
+            self._logger.info('-------- Done! --------')
+        finally:
+            work_queue.close()
+            self._stop_metrics()
+            self._close_resume_info()
+            end_time = time.time()
+            self._logger.info(f'total time taken: {end_time-start_time}')
+
+
+class DocketWorker(FDMSArchiveDownloader):
+    def __init__(self, logger, api_key, output_directory, workers=1, config=None, attachment_workers=None,
+                 lease_seconds=DEFAULT_LEASE_SECONDS, worker_id=None):
+        _check_comment_store(config)
+        self._work_queue = WorkQueue(output_directory)
+        docket_id = self._work_queue.get_setting('docket_id')
+        if docket_id is None:
+            self._work_queue.close()
+            raise Exception(
+                f'no work queue in {output_directory} - start the coordinator first')
+        self._worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}'
+        self._lease_seconds = lease_seconds
+        # each comment's details are fetched once, so there is nothing to
+        # gain from a response cache (which could not be shared anyway)
+        super().__init__(logger, api_key, docket_id, output_directory, resume_download=False,
+                         workers=workers, config={**(config or {}), 'response_cache': None},
+                         attachment_workers=attachment_workers)
+        if self._metrics_settings is not None and self._metrics_settings['stats_file']:
+            root, extension = os.path.splitext(
+                self._metrics_settings['stats_file'])
+            self._metrics_settings['stats_file'] = f'{root}_{self._worker_id}{extension}'
+
+    def _renew_lease(self, batch_id, stopped):
+        while not stopped.wait(self._lease_seconds / 3):
+            if not self._work_queue.renew(batch_id, self._worker_id, self._lease_seconds):
+                self._logger.warning(
+                    f'!! lost the lease of batch {batch_id} - another worker will download it')
+                return
+
+    def _work_on_batch(self, comments_dir, batch_id, comment_ids):
+        self._logger.info(
+            f'-------- batch {batch_id}: {len(comment_ids)} comments --------')
+        # the batch's progress is reported to the queue, not a resume journal
+        self._resume_info = {}
+        self._dead_letters = set()
+        self._total_comments = len(comment_ids)
+        stopped = threading.Event()
+        renewer = threading.Thread(target=self._renew_lease, args=(
+            batch_id, stopped), daemon=True)
+        renewer.start()
+        try:
+            self._gather_comments_and_attachments(comments_dir, comment_ids)
+        except RequestFailed as e:
+            # the API kept failing - another attempt (or worker) may fare better
+            stopped.set()
+            renewer.join()
+            self._work_queue.release(batch_id, self._worker_id, repr(e))
+            self._logger.warning(f'!! batch {batch_id} failed: {e!r}')
+            return
+        except BaseException as e:
+            # e.g. a 401 or 403 for this worker's API key - leave the batch
+            # to the other workers rather than failing every batch in turn
+            stopped.set()
+            renewer.join()
+            self._work_queue.release(batch_id, self._worker_id, repr(e), count_attempt=False)
+            raise
+        stopped.set()
+        renewer.join()
+        dead_letters = [(comment_id, self._resume_info[f"dead_{comment_id}"])
+                        for comment_id in comment_ids if comment_id in self._dead_letters]
+        results = [(comment_id, self._resume_info.get(f"comment_{comment_id}"))
+                   for comment_id in comment_ids if comment_id not in self._dead_letters]
+        if dead_letters:
+            self._logger.warning(
+                f'!! batch {batch_id}: {len(dead_letters)} comments could not be downloaded')
+        if not self._work_queue.complete(batch_id, self._worker_id, results, dead_letters):
+            self._logger.warning(
+                f'!! lost the lease of batch {batch_id} - its results were discarded')
+
+    def work(self, poll_seconds=WORK_QUEUE_POLL_SECONDS):
+        """
+        Downloads leased batches of comments until the queue is finished
+        """
+        self._logger.info('----------------')
+        self._logger.info(
+            f'worker {self._worker_id} for docket {self._docket_id}, output to: {self._output_directory}')
+        self._logger.info('')
+
+        start_time = time.time()
+        batches = 0
+        try:
+            self._start_metrics()
+            comments_dir = self._open_comments_dir()
+            while True:
+                lease = self._work_queue.lease(
+                    self._worker_id, self._lease_seconds)
+                if lease is None:
+                    if self._work_queue.is_finished():
+                        break
+                    time.sleep(poll_seconds)
+                    continue
+                self._work_on_batch(comments_dir, *lease)
+                batches = batches + 1
+            self._logger.info(f'-------- Done! ({batches} batches) --------')
+        finally:
+            self._stop_metrics()
+            self._close_resume_info()
+            self._work_queue.close()
+            end_time = time.time()
+            self._logger.info(f'total time taken: {end_time-start_time}')
@@ -0,0 +1,118 @@
+import os
+from comment_store import open_comment_store
+from json_utils import JsonArrayWriter, read_json_input, iter_json_array
+
+CHANGE_MANIFEST_FILENAME = 'change_manifest.json'
+
+"""
+Differences between two downloads of a docket
+
+diff_dockets(new_dir, orig_dir)
+
+Yields a change record for every comment that was added, removed or
+modified between the original download and the new one, e.g.:
+
+    {"change": "modified", "comment_id": "...", "document_id": "...",
+     "fields": ["lastModifiedDate", "body", "attachments"]}
+
+Comments are matched by id. Only the original download's comment ids (and
+their lastModifiedDate) are held in memory - the new download's comment
+listings are streamed past them, so the diff takes time (and memory) in
+proportion to the size of the dockets.
+"""
+
+
+def iter_listed_comments(base_dir):
+    """
+    Yields (document id, comment listing item) for every comment listed
+    for the docket's documents
+    """
+    for document in read_json_input(os.path.join(base_dir, 'docket_documents.json')) or []:
+        document_id = document["id"]
+        object_id = document["attributes"]["objectId"]
+        comment_list_file = os.path.join(
+            base_dir, f'{document_id}_{object_id}_comments.json')
+        if not os.path.exists(comment_list_file):
+            continue
+        for comment in iter_json_array(comment_list_file):
+            yield document_id, comment
+
+
+def last_modified_date(comment):
+    return (comment.get("attributes") or {}).get("lastModifiedDate")
+
+
+def attachment_sets(base_dir):
+    """
+    Returns {comment id: set of attachment filenames} from comment_attachments.json
+    """
+    attachments_file = os.path.join(base_dir, 'comment_attachments.json')
+    if not os.path.exists(attachments_file):
+        return {}
+    return {comment_id: frozenset(os.path.basename(attachment) for attachment in attachments or [])
+            for comment_id, attachments in read_json_input(attachments_file).items()}
+
+
+def comment_body(record):
+    if record is None:
+        return None
+    return (record.get("attributes") or {}).get("comment")
+
+
+def diff_dockets(new_dir, orig_dir, compare_records=True):
+    """
+    Yields the change records between the two downloads. With
+    `compare_records`, comments listed in both are also checked for
+    changes to their body and attachments.
+    """
+    orig_comments = {}
+    for document_id, comment in iter_listed_comments(orig_dir):
+        orig_comments[comment["id"]] = (
+            document_id, last_modified_date(comment))
+
+    new_store, orig_store = None, None
+    new_attachments, orig_attachments = {}, {}
+    if compare_records:
+        new_store = open_comment_store(os.path.join(new_dir, 'comments'))
+        orig_store = open_comment_store(os.path.join(orig_dir, 'comments'))
+        new_attachments = attachment_sets(new_dir)
+        orig_attachments = attachment_sets(orig_dir)
+    empty = frozenset()
+    try:
+        for document_id, comment in iter_listed_comments(new_dir):
+            comment_id = comment["id"]
+            orig = orig_comments.pop(comment_id, None)
+            if orig is None:
+                yield {"change": "added", "comment_id": comment_id, "document_id": document_id}
+                continue
+            orig_document_id, orig_last_modified = orig
+            fields = []
+            if last_modified_date(comment) != orig_last_modified:
+                fields.append("lastModifiedDate")
+            if compare_records:
+                if comment_body(new_store.get(document_id, comment_id)) != \
+                        comment_body(orig_store.get(orig_document_id, comment_id)):
+                    fields.append("body")
+                if new_attachments.get(comment_id, empty) != orig_attachments.get(comment_id, empty):
+                    fields.append("attachments")
+            if fields:
+                yield {"change": "modified", "comment_id": comment_id, "document_id": document_id,
+                       "fields": fields}
+
+        for comment_id, (document_id, _) in orig_comments.items():
+            yield {"change": "removed", "comment_id": comment_id, "document_id": document_id}
+    finally:
+        if new_store is not None:
+            new_store.close()
+            orig_store.close()
+
+
+def write_change_manifest(manifest_path, changes):
+    """
+    Writes the change records to the manifest (a JSON array) as they are
+    produced, yielding each one on to the caller
+    """
+    with JsonArrayWriter(manifest_path) as writer:
+        for change in changes:
+            writer.write(change)
+            yield change
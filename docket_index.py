@@ -0,0 +1,220 @@
+import os
+import sqlite3
+from comment_store import open_comment_store
+from json_utils import read_json_input, iter_json_array
+
+DOCKET_INDEX_FILENAME = '__docket_index.db'
+
+"""
+A queryable index of a downloaded docket
+
+DocketIndex(output_directory)
+
+A SQLite database (`__docket_index.db` in the output directory) of the
+docket's documents, its comments (with their key attributes) and their
+attachments (with format, size and path), e.g.:
+
+    SELECT comment_id, path FROM attachments WHERE format = 'xlsx'
+    SELECT id FROM comments WHERE posted_date >= '2021-06-01'
+
+`update()` brings the index up to date with the download - only the
+files (and comment records) that changed since the last update are read
+again, so it is cheap to call before every query.
+"""
+
+
+def file_version(path):
+    stat = os.stat(path)
+    return f'{stat.st_mtime_ns}:{stat.st_size}'
+
+
+def open_docket_index(output_directory):
+    """
+    Returns the (updated) index of the download, or None if it has not
+    been indexed
+    """
+    if not os.path.exists(os.path.join(output_directory, DOCKET_INDEX_FILENAME)):
+        return None
+    docket_index = DocketIndex(output_directory)
+    docket_index.update()
+    return docket_index
+
+
+class DocketIndex:
+    def __init__(self, output_directory):
+        self._output_directory = output_directory
+        self._connection = sqlite3.connect(os.path.join(output_directory, DOCKET_INDEX_FILENAME),
+                                           isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, version TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS documents (
+                id TEXT PRIMARY KEY, object_id TEXT, document_type TEXT, title TEXT,
+                posted_date TEXT, last_modified_date TEXT, position INTEGER);
+            CREATE TABLE IF NOT EXISTS comments (
+                id TEXT PRIMARY KEY, document_id TEXT NOT NULL, position INTEGER,
+                last_modified_date TEXT, posted_date TEXT, title TEXT, organization TEXT,
+                has_body INTEGER, record_key TEXT, record_version TEXT);
+            CREATE INDEX IF NOT EXISTS comments_document ON comments (document_id, position);
+            CREATE INDEX IF NOT EXISTS comments_posted ON comments (posted_date);
+            CREATE INDEX IF NOT EXISTS comments_record ON comments (record_key);
+            CREATE TABLE IF NOT EXISTS attachments (
+                path TEXT PRIMARY KEY, comment_id TEXT NOT NULL, filename TEXT,
+                format TEXT, size INTEGER);
+            CREATE INDEX IF NOT EXISTS attachments_comment ON attachments (comment_id);
+            CREATE INDEX IF NOT EXISTS attachments_format ON attachments (format);
+        ''')
+
+    def _source_changed(self, path):
+        """
+        Returns the file's version if it changed since it was last indexed
+        (or None if it did not)
+        """
+        if not os.path.exists(path):
+            return None
+        version = file_version(path)
+        row = self._connection.execute(
+            'SELECT version FROM sources WHERE path = ?', (path,)).fetchone()
+        if row is not None and row[0] == version:
+            return None
+        return version
+
+    def _source_indexed(self, path, version):
+        self._connection.execute(
+            'INSERT OR REPLACE INTO sources (path, version) VALUES (?, ?)', (path, version))
+
+    def update(self):
+        documents = self._update_documents()
+        for document_id, object_id in documents:
+            self._update_document_comments(document_id, object_id)
+        self._update_comment_records()
+        self._update_attachments()
+
+    def _update_documents(self):
+        documents_path = os.path.join(
+            self._output_directory, 'docket_documents.json')
+        version = self._source_changed(documents_path)
+        if version is not None:
+            self._connection.execute('BEGIN')
+            self._connection.execute('DELETE FROM documents')
+            for position, document in enumerate(read_json_input(documents_path) or []):
+                attributes = document.get('attributes') or {}
+                self._connection.execute('INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                         (document['id'], attributes.get('objectId'), attributes.get('documentType'),
+                                          attributes.get('title'), attributes.get('postedDate'),
+                                          attributes.get('lastModifiedDate'), position))
+            self._source_indexed(documents_path, version)
+            self._connection.execute('COMMIT')
+        return self._connection.execute(
+            'SELECT id, object_id FROM documents ORDER BY position').fetchall()
+
+    def _update_document_comments(self, document_id, object_id):
+        comments_path = os.path.join(
+            self._output_directory, f'{document_id}_{object_id}_comments.json')
+        version = self._source_changed(comments_path)
+        if version is None:
+            return
+        self._connection.execute('BEGIN')
+        self._connection.execute('CREATE TEMP TABLE IF NOT EXISTS listed (id TEXT PRIMARY KEY)')
+        self._connection.execute('DELETE FROM listed')
+        for position, comment in enumerate(iter_json_array(comments_path)):
+            attributes = comment.get('attributes') or {}
+            self._connection.execute('INSERT OR IGNORE INTO listed VALUES (?)', (comment['id'],))
+            self._connection.execute('''INSERT INTO comments (id, document_id, position, last_modified_date, posted_date, title)
+                VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET
+                document_id = excluded.document_id, position = excluded.position,
+                last_modified_date = excluded.last_modified_date''',
+                                     (comment['id'], document_id, position, attributes.get('lastModifiedDate'),
+                                      attributes.get('postedDate'), attributes.get('title')))
+        self._connection.execute(
+            'DELETE FROM comments WHERE document_id = ? AND id NOT IN (SELECT id FROM listed)', (document_id,))
+        self._source_indexed(comments_path, version)
+        self._connection.execute('COMMIT')
+
+    def _update_comment_records(self):
+        comments_dir = os.path.join(self._output_directory, 'comments')
+        if not os.path.exists(comments_dir):
+            return
+        comment_store = open_comment_store(comments_dir)
+        try:
+            self._connection.execute('BEGIN')
+            for key, version in comment_store.iter_entries():
+                row = self._connection.execute(
+                    'SELECT 1 FROM comments WHERE record_key = ? AND record_version = ?', (key, version)).fetchone()
+                if row is not None:
+                    continue
+                record = comment_store.read_entry(key)
+                if not record or 'id' not in record:
+                    continue
+                attributes = record.get('attributes') or {}
+                self._connection.execute('''INSERT INTO comments (id, document_id, last_modified_date, posted_date,
+                        title, organization, has_body, record_key, record_version)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET
+                    last_modified_date = excluded.last_modified_date, posted_date = excluded.posted_date,
+                    title = excluded.title, organization = excluded.organization, has_body = excluded.has_body,
+                    record_key = excluded.record_key, record_version = excluded.record_version''',
+                                         (record['id'], attributes.get('commentOnDocumentId') or '',
+                                          attributes.get('lastModifiedDate'), attributes.get('postedDate'),
+                                          attributes.get('title'), attributes.get('organization'),
+                                          1 if attributes.get('comment') else 0, key, version))
+            self._connection.execute('COMMIT')
+        finally:
+            comment_store.close()
+
+    def _update_attachments(self):
+        attachments_path = os.path.join(
+            self._output_directory, 'comment_attachments.json')
+        version = self._source_changed(attachments_path)
+        if version is None:
+            return
+        comments_dir = os.path.join(self._output_directory, 'comments')
+        self._connection.execute('BEGIN')
+        self._connection.execute('DELETE FROM attachments')
+        for comment_id, attachments in read_json_input(attachments_path).items():
+            for attachment in attachments or []:
+                full_path = os.path.join(comments_dir, attachment)
+                filename = os.path.basename(attachment)
+                attachment_format = os.path.splitext(filename)[1].lstrip('.').lower()
+                size = os.path.getsize(full_path) if os.path.exists(full_path) else None
+                self._connection.execute('INSERT OR REPLACE INTO attachments VALUES (?, ?, ?, ?, ?)',
+                                         (attachment, comment_id, filename, attachment_format, size))
+        self._source_indexed(attachments_path, version)
+        self._connection.execute('COMMIT')
+
+    def select_attachments(self, attachment_formats=None, posted_since=None, posted_until=None,
+                           document_ids=None):
+        """
+        Returns (comment id, document id, path relative to the comments
+        directory, size) for every attachment of the given formats, on
+        comments posted in the date range (inclusive - dates or full
+        timestamps) to the given documents
+        """
+        conditions, params = [], []
+        if attachment_formats:
+            attachment_formats = [attachment_format.lstrip('.').lower()
+                                  for attachment_format in attachment_formats]
+            conditions.append(
+                f"attachments.format IN ({', '.join('?' * len(attachment_formats))})")
+            params.extend(attachment_formats)
+        if posted_since:
+            conditions.append('comments.posted_date >= ?')
+            params.append(posted_since)
+        if posted_until:
+            conditions.append(
+                'substr(comments.posted_date, 1, length(?)) <= ?')
+            params.extend([posted_until, posted_until])
+        if document_ids:
+            conditions.append(
+                f"comments.document_id IN ({', '.join('?' * len(document_ids))})")
+            params.extend(document_ids)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        return self._connection.execute(f'''SELECT attachments.comment_id, comments.document_id,
+                attachments.path, attachments.size FROM attachments
+            LEFT JOIN comments ON comments.id = attachments.comment_id
+            {where} ORDER BY attachments.comment_id, attachments.path''', params).fetchall()
+
+    def query(self, sql, params=()):
+        return self._connection.execute(sql, params).fetchall()
+
+    def close(self):
+        self._connection.close()
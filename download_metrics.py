@@ -0,0 +1,338 @@
+import cProfile
+import json
+import os
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse
+
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+DEFAULT_METRICS_SETTINGS = {
+    'stats_file': '__download_stats.json',
+    'interval_seconds': 30,
+    'prometheus_port': None,
+    'prometheus_host': '127.0.0.1',
+    'profile': False
+}
+ENDPOINT_STAGES = {
+    'dockets': 'docket',
+    'documents': 'listing',
+    'comments': 'listing',
+    'comment_details': 'details',
+    'attachments': 'attachments'
+}
+
+"""
+Runtime metrics for a docket download
+
+DownloadMetrics()
+
+Collected by the fetchers and the downloader as they run:
+* request latency histograms (and calls, bytes and error responses) per
+  endpoint - `dockets`, `documents`, `comments` (listings),
+  `comment_details` and `attachments` - and calls and bytes per stage
+* the time spent blocked on the rate limit
+* counters such as response cache hits and comments skipped on resume
+* progress, with an ETA from the throughput so far
+
+MetricsReporter(metrics, output_directory, settings)
+
+Publishes the metrics while a download runs, as configured by the
+`metrics` section of config.json, e.g.:
+
+    "metrics": {"stats_file": "__download_stats.json", "interval_seconds": 30,
+                "prometheus_port": 9464, "profile": true}
+
+The stats file (relative to the output directory) is rewritten every
+`interval_seconds`, `prometheus_port` serves the metrics in the Prometheus
+text format at /metrics (on `prometheus_host` - only to this machine unless
+it is set, e.g. to "0.0.0.0"), and `profile` runs each stage's work under
+cProfile, writing `__profile_{stage}.prof` to the output directory when
+the download finishes.
+"""
+
+
+def metrics_settings(config):
+    """
+    Returns the metrics settings from config.json (or None if the metrics
+    are not published)
+    """
+    metrics_config = (config or {}).get('metrics')
+    if not metrics_config:
+        return None
+    if not isinstance(metrics_config, dict):
+        metrics_config = {}
+    return {**DEFAULT_METRICS_SETTINGS, **metrics_config}
+
+
+def endpoint_for_url(resource_url):
+    path = urlparse(resource_url).path.rstrip('/')
+    parts = path.split('/')
+    if len(parts) >= 2 and parts[-2] == 'comments':
+        return 'comment_details'
+    if len(parts) >= 2 and parts[-2] == 'dockets':
+        return 'dockets'
+    if parts[-1] in ('documents', 'comments'):
+        return parts[-1]
+    return 'other'
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.bucket_counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.count = self.count + 1
+        self.sum = self.sum + seconds
+        for index, upper_bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= upper_bound:
+                self.bucket_counts[index] = self.bucket_counts[index] + 1
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum_seconds': round(self.sum, 3),
+            'mean_seconds': round(self.sum / self.count, 4) if self.count else None,
+            'buckets': {str(upper_bound): bucket_count for upper_bound, bucket_count
+                        in zip(LATENCY_BUCKETS, self.bucket_counts)}
+        }
+
+
+class DownloadMetrics:
+    def __init__(self, profile=False):
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._latency = {}
+        self._endpoints = {}
+        self._stages = {}
+        self._counters = {}
+        self._rate_limit_wait = 0.0
+        self._completed = 0
+        self._total = 0
+        self._profile = profile
+        self._profiles = {}
+        self._thread_profiles = threading.local()
+
+    def observe_request(self, endpoint, seconds, size, status_code=200):
+        stage = ENDPOINT_STAGES.get(endpoint, 'other')
+        with self._lock:
+            self._latency.setdefault(
+                endpoint, LatencyHistogram()).observe(seconds)
+            endpoint_counts = self._endpoints.setdefault(
+                endpoint, {'calls': 0, 'bytes': 0, 'errors': 0})
+            endpoint_counts['calls'] += 1
+            endpoint_counts['bytes'] += size
+            if status_code >= 400:
+                endpoint_counts['errors'] += 1
+            stage_counts = self._stages.setdefault(
+                stage, {'calls': 0, 'bytes': 0})
+            stage_counts['calls'] += 1
+            stage_counts['bytes'] += size
+
+    def add_rate_limit_wait(self, seconds):
+        with self._lock:
+            self._rate_limit_wait = self._rate_limit_wait + max(0.0, seconds)
+
+    def increment(self, counter, amount=1):
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + amount
+
+    def set_progress(self, completed, total):
+        with self._lock:
+            self._completed = completed
+            self._total = total
+
+    def eta_seconds(self):
+        """
+        Seconds left at the throughput so far (None until there is some)
+        """
+        with self._lock:
+            completed, total = self._completed, self._total
+        elapsed = time.time() - self._started
+        if completed <= 0 or elapsed <= 0 or total < completed:
+            return None
+        return (total - completed) / (completed / elapsed)
+
+    def snapshot(self):
+        eta = self.eta_seconds()
+        elapsed = time.time() - self._started
+        with self._lock:
+            return {
+                'updated': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'elapsed_seconds': round(elapsed, 1),
+                'progress': {
+                    'completed_comments': self._completed,
+                    'total_comments': self._total,
+                    'comments_per_second': round(self._completed / elapsed, 3) if elapsed > 0 else None,
+                    'eta_seconds': round(eta) if eta is not None else None
+                },
+                'rate_limit_wait_seconds': round(self._rate_limit_wait, 1),
+                'counters': {**self._counters},
+                'stages': {stage: {**counts} for stage, counts in self._stages.items()},
+                'endpoints': {endpoint: {**counts, 'latency': self._latency[endpoint].to_dict()}
+                              for endpoint, counts in self._endpoints.items()}
+            }
+
+    def prometheus_text(self):
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append(f'# HELP fdms_{name} {help_text}')
+            lines.append(f'# TYPE fdms_{name} {metric_type}')
+            for labels, value in samples:
+                label_text = ','.join(
+                    f'{key}="{label}"' for key, label in labels.items())
+                lines.append(
+                    f'fdms_{name}{{{label_text}}} {value}' if label_text else f'fdms_{name} {value}')
+
+        with self._lock:
+            histogram_samples = []
+            for endpoint, histogram in self._latency.items():
+                for upper_bound, bucket_count in zip(LATENCY_BUCKETS, histogram.bucket_counts):
+                    histogram_samples.append(
+                        ({'endpoint': endpoint, 'le': str(upper_bound)}, bucket_count))
+                histogram_samples.append(
+                    ({'endpoint': endpoint, 'le': '+Inf'}, histogram.count))
+        lines.append(
+            '# HELP fdms_request_duration_seconds Request latency by endpoint')
+        lines.append('# TYPE fdms_request_duration_seconds histogram')
+        for labels, value in histogram_samples:
+            label_text = ','.join(f'{key}="{label}"' for key,
+                                  label in labels.items())
+            lines.append(
+                f'fdms_request_duration_seconds_bucket{{{label_text}}} {value}')
+        for endpoint, counts in snapshot['endpoints'].items():
+            lines.append(
+                f'fdms_request_duration_seconds_sum{{endpoint="{endpoint}"}} {counts["latency"]["sum_seconds"]}')
+            lines.append(
+                f'fdms_request_duration_seconds_count{{endpoint="{endpoint}"}} {counts["latency"]["count"]}')
+
+        metric('requests_total', 'counter', 'Requests by endpoint',
+               [({'endpoint': endpoint}, counts['calls']) for endpoint, counts in snapshot['endpoints'].items()])
+        metric('request_errors_total', 'counter', 'Error responses by endpoint',
+               [({'endpoint': endpoint}, counts['errors']) for endpoint, counts in snapshot['endpoints'].items()])
+        metric('stage_bytes_total', 'counter', 'Bytes received by stage',
+               [({'stage': stage}, counts['bytes']) for stage, counts in snapshot['stages'].items()])
+        metric('rate_limit_wait_seconds_total', 'counter', 'Time spent blocked on the rate limit',
+               [({}, snapshot['rate_limit_wait_seconds'])])
+        metric('events_total', 'counter', 'Cache, resume and store events',
+               [({'event': counter}, value) for counter, value in snapshot['counters'].items()])
+        progress = snapshot['progress']
+        metric('comments_completed', 'gauge', 'Comments completed',
+               [({}, progress['completed_comments'])])
+        metric('comments_total', 'gauge', 'Comments listed so far',
+               [({}, progress['total_comments'])])
+        if progress['eta_seconds'] is not None:
+            metric('eta_seconds', 'gauge', 'Estimated seconds to completion',
+                   [({}, progress['eta_seconds'])])
+        return '\n'.join(lines) + '\n'
+
+    @contextmanager
+    def profiled(self, stage):
+        """
+        Runs the block under cProfile (when profiling is on), accumulating a
+        profile per stage and thread
+        """
+        if not self._profile or getattr(self._thread_profiles, 'active', False):
+            yield
+            return
+        profiles = getattr(self._thread_profiles, 'profiles', None)
+        if profiles is None:
+            profiles = self._thread_profiles.profiles = {}
+        profile = profiles.get(stage)
+        if profile is None:
+            profile = profiles[stage] = cProfile.Profile()
+            with self._lock:
+                self._profiles.setdefault(stage, []).append(profile)
+        self._thread_profiles.active = True
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._thread_profiles.active = False
+
+    def write_profiles(self, output_directory):
+        with self._lock:
+            stage_profiles = {stage: list(profiles)
+                              for stage, profiles in self._profiles.items()}
+        for stage, profiles in stage_profiles.items():
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(os.path.join(
+                output_directory, f'__profile_{stage}.prof'))
+
+
+class _PrometheusHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = self.server.metrics.prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _PrometheusServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsReporter:
+    def __init__(self, metrics, output_directory, settings):
+        self._metrics = metrics
+        self._output_directory = output_directory
+        self._settings = settings
+        self._stats_path = os.path.join(
+            output_directory, settings['stats_file']) if settings.get('stats_file') else None
+        self._stopped = threading.Event()
+        self._thread = None
+        self._server = None
+
+    def start(self):
+        if self._settings.get('prometheus_port'):
+            self._server = _PrometheusServer(
+                (self._settings['prometheus_host'], int(self._settings['prometheus_port'])),
+                _PrometheusHandler)
+            self._server.metrics = self._metrics
+            threading.Thread(target=self._server.serve_forever,
+                             daemon=True).start()
+        if self._stats_path:
+            self._thread = threading.Thread(
+                target=self._write_periodically, daemon=True)
+            self._thread.start()
+
+    def _write_periodically(self):
+        while not self._stopped.wait(self._settings['interval_seconds']):
+            self.write_stats()
+
+    def write_stats(self):
+        part_path = f'{self._stats_path}.part'
+        with open(part_path, 'w', encoding='utf-8') as stats_output:
+            json.dump(self._metrics.snapshot(), stats_output, indent=2)
+        os.replace(part_path, self._stats_path)
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._stats_path:
+            self.write_stats()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        if self._settings.get('profile'):
+            self._metrics.write_profiles(self._output_directory)
@@ -1,5 +1,4 @@
 import argparse
-import json
 import os
 import requests
 import time
@@ -10,6 +9,14 @@ from datetime import datetime
 
 from rate_limited_fetcher import RateLimitedFetcher
 from fdms_archive_downloader import FDMSArchiveDownloader
+from comment_store import open_comment_store
+from comment_extraction import extract_comment_records, extract_write_comment
+from docket_index import DocketIndex
+from json_utils import read_json_input
+from attachment_export import AttachmentExporter, listed_attachments, EXPORT_MODES, DEFAULT_EXPORT_WORKERS
+from docket_diff import diff_dockets, write_change_manifest, CHANGE_MANIFEST_FILENAME
+from distributed_download import DocketCoordinator, DocketWorker, DEFAULT_BATCH_SIZE, DEFAULT_LEASE_SECONDS
+from batch_scheduler import BatchDocketDownloader, BATCH_ORDERS, read_batch_file
 
 DEFAULT_CONFIG_FILE = './config.json'
 
@@ -34,145 +41,137 @@ logger = rootLogger
 
 
 def load_configuration(config_file):
-    with open(config_file) as config_input:
-        config = json.load(config_input)
+    config = read_json_input(config_file)
 
-        if not 'api_key' in config:
-            raise Exception("configuration is missing api_key")
-        return config
+    if not 'api_key' in config and not 'api_keys' in config:
+        raise Exception("configuration is missing api_key")
+    return config
+
+
+def config_api_keys(config):
+    """
+    Returns the API key(s) from the configuration - either the list
+    in `api_keys`, or the single `api_key`
+    """
+    if config.get('api_keys'):
+        return config['api_keys']
+    return config['api_key']
 
 
 def move_attachments(output_dir, attachment_outdir):
     logger.info('----------------')
     logger.info(f'copying spreadsheet attachements to: {attachment_outdir}')
     logger.info('')
+    exporter = AttachmentExporter(logger, output_dir, attachment_outdir, mode='copy')
+    exporter.export_attachments(listed_attachments(output_dir, ['xlsx']), write_manifest=False)
+
 
-    comments_dir = os.path.join(output_dir, 'comments')
-    attachments_file = os.path.join(output_dir, 'comment_attachments.json')
-    if not os.path.exists(attachment_outdir):
-        os.makedirs(attachment_outdir)
+def export_attachments(output_dir, export_dir, mode, workers, attachment_formats=None,
+                       posted_since=None, posted_until=None, document_ids=None):
+    logger.info('----------------')
+    logger.info(f'exporting attachments to: {export_dir}')
+    logger.info('')
+    exporter = AttachmentExporter(logger, output_dir, export_dir, mode, workers)
+    exporter.export(attachment_formats, posted_since, posted_until, document_ids)
 
-    with open(attachments_file, 'r', encoding='utf-8') as f:
-        attachment_data = json.load(f)
 
-    for key, value in attachment_data.items():
-        for attachment_file in value:
-            if not attachment_file.endswith('.xlsx'):
-                continue
-            logger.info(f'moving: {attachment_file}')
-            full_path = os.path.join(comments_dir, attachment_file)
-            filename = os.path.basename(full_path)
-            shutil.copy(full_path, attachment_outdir)
-
-            path_in_outdir = os.path.join(attachment_outdir, filename)
-            new_filename = f'{key}_{filename}'
-            full_new_filename = os.path.join(attachment_outdir, new_filename)
-            os.rename(path_in_outdir, full_new_filename)
-
-
-headers_to_ignore = ["displayProperties", "comment"]
-
-
-def extract_comment_headers(comment_data):
-    ret = {}
-    for key, value in comment_data.items():
-        if key in headers_to_ignore:
-            continue
-        if not value:
-            continue
-        ret[key] = value
-    return ret
-
-
-def extract_comment_body(comment_data):
-    if not "comment" in comment_data:
-        return None
-    return comment_data["comment"]
-
-
-def extract_write_comment(output_dir, comment_data):
-    if not comment_data or not "id" in comment_data or not "attributes" in comment_data or not "type" in comment_data:
-        return
-    comment_id = comment_data["id"]
-    comment_headers = extract_comment_headers(comment_data["attributes"])
-    comment_body = extract_comment_body(comment_data["attributes"])
-    if not comment_body:
-        return
-
-    with open(os.path.join(output_dir, f"{comment_id}-comment.txt"), 'w', encoding='utf-8') as output:
-        for key, value in comment_headers.items():
-            output.write(f"{key}: {value}" + os.linesep)
-        output.write(os.linesep)
-        output.write(comment_body + os.linesep)
-
-
-def extract_comments(output_dir, extract_output_dir):
-    comments_path = os.path.join(output_dir, 'comments')
-    if not os.path.exists(extract_output_dir):
-        os.makedirs(extract_output_dir)
-
-    for file in os.listdir(comments_path):
-        if not file.endswith(".json"):
-            continue
-        with open(os.path.join(comments_path, file), 'r', encoding='utf-8') as f:
-            comment_data = json.load(f)
-            extract_write_comment(extract_output_dir, comment_data)
-
-
-def get_comment_ids_from_documents(base_dir):
-    path_to_documents = os.path.join(base_dir, 'docket_documents.json')
-    with open(path_to_documents, 'r', encoding='utf-8') as f:
-        documents_json = json.load(f)
-    if not documents_json:
-        return []
-    ret = []
-    for document in documents_json:
-        doc_id = document["id"]
-        object_id = document["attributes"]["objectId"]
-        comment_list_file = os.path.join(
-            base_dir, f'{doc_id}_{object_id}_comments.json')
-        with open(comment_list_file, 'r', encoding='utf-8') as comment_input:
-            comments_json = json.load(comment_input)
-            for comment in comments_json:
-                ret.append({
-                    "file_id": f'{doc_id}_{comment["id"]}',
-                    "doc_id": doc_id,
-                    "comment_id": comment["id"]
-                })
-    return ret
+def extract_comments(output_dir, extract_output_dir, processes=None):
+    logger.info('----------------')
+    logger.info(f'extracting comments to: {extract_output_dir}')
+    logger.info('')
+    extract_comment_records(logger, os.path.join(output_dir, 'comments'),
+                            extract_output_dir, processes)
+
+
+def copy_comment_attachments(base_dir, comment_id, extractcommentsdir):
+    attachment_dir = os.path.join(
+        base_dir, f'comments', f'{comment_id}_attachments')
+    if os.path.exists(attachment_dir):
+        copy_attachment_dir = os.path.join(
+            extractcommentsdir, f'{comment_id}_attachments')
+        os.makedirs(copy_attachment_dir, exist_ok=True)
+        (_, _, filenames) = next(os.walk(attachment_dir))
+        for attachment in filenames:
+            shutil.copy(os.path.join(attachment_dir,
+                        attachment), copy_attachment_dir)
+
+
+def fetch_attachments(output_dir, config, workers, attachment_formats=None):
+    docket_id = read_json_input(os.path.join(
+        output_dir, 'docket_details.json'))['id']
+    downloader = FDMSArchiveDownloader(logger, config_api_keys(config), docket_id, output_dir,
+                                       workers=workers, config=config)
+    downloader.fetch_deferred_attachments(attachment_formats)
+
+
+def index_docket(output_dir):
+    logger.info('----------------')
+    logger.info(f'indexing: {output_dir}')
+    logger.info('')
+    docket_index = DocketIndex(output_dir)
+    try:
+        docket_index.update()
+        document_count, comment_count, attachment_count = docket_index.query(
+            'SELECT (SELECT COUNT(*) FROM documents), (SELECT COUNT(*) FROM comments), (SELECT COUNT(*) FROM attachments)')[0]
+        logger.info(
+            f'indexed {document_count} documents, {comment_count} comments and {attachment_count} attachments')
+    finally:
+        docket_index.close()
 
 
 def produce_outputdiff(output_dir, orig_outputdir, extractcommentsdir):
-    old_comment_ids = get_comment_ids_from_documents(orig_outputdir)
-    new_comment_ids = get_comment_ids_from_documents(output_dir)
-    diff_ids = [i for i in new_comment_ids +
-                old_comment_ids if i not in new_comment_ids or i not in old_comment_ids]
+    """
+    Diffs the download against an original one - the change manifest
+    (every added, removed and modified comment) is written to the
+    extraction directory (or the output directory), and the changed
+    comments are extracted
+    """
+    manifest_dir = extractcommentsdir or output_dir
+    if not os.path.exists(manifest_dir):
+        os.makedirs(manifest_dir)
+    manifest_path = os.path.join(manifest_dir, CHANGE_MANIFEST_FILENAME)
+    changes = write_change_manifest(
+        manifest_path, diff_dockets(output_dir, orig_outputdir))
+    change_counts = {'added': 0, 'removed': 0, 'modified': 0}
+
     if not extractcommentsdir:
+        diff_ids = []
+        for change in changes:
+            change_counts[change['change']] += 1
+            if change['change'] == 'modified':
+                continue
+            diff_ids.append({
+                "file_id": f'{change["document_id"]}_{change["comment_id"]}',
+                "doc_id": change["document_id"],
+                "comment_id": change["comment_id"]
+            })
         print(f'Missing IDs: {diff_ids}')
-        return
-
-    if not os.path.exists(extractcommentsdir):
-        os.makedirs(extractcommentsdir)
-
-    for this_id in diff_ids:
-        comment_path = os.path.join(
-            output_dir, 'comments', f'{this_id["file_id"]}.json')
-        if not os.path.exists(comment_path):
-            print(f'!! Could not find file for comment: {comment_path}')
-            continue
-        with open(comment_path, 'r', encoding='utf-8') as comment_input:
-            comment_data = json.load(comment_input)
-            extract_write_comment(extractcommentsdir, comment_data)
-        attachment_dir = os.path.join(
-            output_dir, f'comments', f'{this_id["comment_id"]}_attachments')
-        if os.path.exists(attachment_dir):
-            copy_attachment_dir = os.path.join(
-                extractcommentsdir, f'{this_id["comment_id"]}_attachments')
-            os.makedirs(copy_attachment_dir)
-            (_, _, filenames) = next(os.walk(attachment_dir))
-            for attachment in filenames:
-                shutil.copy(os.path.join(attachment_dir,
-                            attachment), copy_attachment_dir)
+    else:
+        # removed comments are extracted from the original download
+        comment_stores = {
+            output_dir: open_comment_store(os.path.join(output_dir, 'comments')),
+            orig_outputdir: open_comment_store(
+                os.path.join(orig_outputdir, 'comments'))
+        }
+        try:
+            for change in changes:
+                change_counts[change['change']] += 1
+                base_dir = orig_outputdir if change['change'] == 'removed' else output_dir
+                comment_data = comment_stores[base_dir].get(
+                    change["document_id"], change["comment_id"])
+                if comment_data is None:
+                    print(
+                        f'!! Could not find record for comment: {change["document_id"]}_{change["comment_id"]}')
+                    continue
+                extract_write_comment(extractcommentsdir, comment_data)
+                copy_comment_attachments(
+                    base_dir, change["comment_id"], extractcommentsdir)
+        finally:
+            for comment_store in comment_stores.values():
+                comment_store.close()
+
+    print(f'{change_counts["added"]} added, {change_counts["removed"]} removed, '
+          f'{change_counts["modified"]} modified comments - change manifest: {manifest_path}')
 
 
 if __name__ == "__main__":
@@ -186,11 +185,55 @@ if __name__ == "__main__":
                         help="directory to move attachments to")
     parser.add_argument("-e", "--extractcommentsdir",
                         help="directory to extract comments to")
+    parser.add_argument("-p", "--processes", type=int,
+                        help="number of processes to extract comments with (default: one per CPU)")
     parser.add_argument("-d", "--outputdiff",
                         help="directory diff with output")
     parser.add_argument("-c", "--config", help="path to config file")
+    parser.add_argument("--fetchattachments", action="store_true",
+                        help="download the attachments that were deferred by the attachment policy")
+    parser.add_argument("--attachmentformats",
+                        help="comma separated extensions of the attachments to fetch or export (default: all)")
+    parser.add_argument("--export",
+                        help="directory to export the selected attachments to")
+    parser.add_argument("--postedsince",
+                        help="only export attachments of comments posted on or after this date (e.g. 2021-06-01)")
+    parser.add_argument("--posteduntil",
+                        help="only export attachments of comments posted on or before this date")
+    parser.add_argument("--documentids",
+                        help="comma separated IDs of the documents whose comments' attachments are exported")
+    parser.add_argument("--exportmode", choices=EXPORT_MODES, default='auto',
+                        help="how exported attachments are placed (default: reflink, else hardlink, else copy)")
+    parser.add_argument("--exportworkers", type=int, default=DEFAULT_EXPORT_WORKERS,
+                        help="number of attachments copied at once when they cannot be linked")
+    parser.add_argument("--index", action="store_true",
+                        help="build (or update) the SQLite index of the downloaded docket")
     parser.add_argument("-n", "--noresume", dest='resume_download',
                         action="store_false", help="do not resume download if available")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="number of concurrent comment detail fetches")
+    parser.add_argument("--attachmentworkers", type=int,
+                        help="number of concurrent attachment downloads (default: the number of workers)")
+    parser.add_argument("-b", "--batchfile",
+                        help="file of docket IDs (and optional priorities) to download")
+    parser.add_argument("--paralleldockets", type=int, default=4,
+                        help="number of dockets from the batch file to download at once")
+    parser.add_argument("--batchorder", choices=BATCH_ORDERS, default='fair',
+                        help="how the shared API budget is split across the batch's dockets")
+    parser.add_argument("--coordinate", action="store_true",
+                        help="queue the docket's comments for --worker processes and complete the download once they finish")
+    parser.add_argument("--worker", action="store_true",
+                        help="download batches of comments from the work queue in the output directory")
+    parser.add_argument("--batchsize", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="comments per work queue batch")
+    parser.add_argument("--leaseseconds", type=int, default=DEFAULT_LEASE_SECONDS,
+                        help="how long a worker's lease of a batch lasts without being renewed")
+    parser.add_argument("-s", "--sync", action="store_true",
+                        help="only fetch what changed since the last completed download")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="use the asyncio download engine")
+    parser.add_argument("--concurrency", type=int, default=100,
+                        help="number of in-flight comment requests for the asyncio engine")
     parser.set_defaults(resume_download=True)
     args = parser.parse_args()
 
@@ -200,13 +243,53 @@ if __name__ == "__main__":
     if not os.path.exists(args.output):
         os.makedirs(args.output)
 
-    if (args.outputdiff):
+    if (args.index):
+        index_docket(args.output)
+    elif (args.fetchattachments):
+        config = load_configuration(args.config or DEFAULT_CONFIG_FILE)
+        fetch_attachments(args.output, config, args.attachmentworkers or args.workers,
+                          args.attachmentformats.split(',') if args.attachmentformats else None)
+    elif (args.export):
+        export_attachments(args.output, args.export, args.exportmode, args.exportworkers,
+                           args.attachmentformats.split(',') if args.attachmentformats else None,
+                           args.postedsince, args.posteduntil,
+                           args.documentids.split(',') if args.documentids else None)
+    elif (args.outputdiff):
         produce_outputdiff(args.output, args.outputdiff,
                            args.extractcommentsdir)
     elif (args.moveattachments):
         move_attachments(args.output, args.attachmentdir)
     elif (args.extractcommentsdir):
-        extract_comments(args.output, args.extractcommentsdir)
+        extract_comments(args.output, args.extractcommentsdir, args.processes)
+    elif (args.coordinate or args.worker) and args.use_async:
+        parser.error("distributed downloads are not supported by the asyncio engine")
+    elif (args.coordinate):
+        if not args.docketid:
+            parser.error("--coordinate needs a docket id")
+        config = load_configuration(args.config or DEFAULT_CONFIG_FILE)
+        coordinator = DocketCoordinator(logger, config_api_keys(config), args.docketid, args.output,
+                                        args.workers, config=config, batch_size=args.batchsize)
+        coordinator.coordinate()
+    elif (args.worker):
+        config = load_configuration(args.config or DEFAULT_CONFIG_FILE)
+        worker = DocketWorker(logger, config_api_keys(config), args.output, args.workers, config=config,
+                              attachment_workers=args.attachmentworkers, lease_seconds=args.leaseseconds)
+        worker.work()
+    elif (args.batchfile):
+        if args.use_async:
+            parser.error("--batchfile is not supported by the asyncio engine")
+        config_file_path = DEFAULT_CONFIG_FILE
+        if args.config:
+            config_file_path = args.config
+        config = load_configuration(config_file_path)
+        batch_downloader = BatchDocketDownloader(logger, config_api_keys(config),
+                                                 read_batch_file(args.batchfile),
+                                                 args.output, args.resume_download,
+                                                 args.workers, config=config,
+                                                 parallel_dockets=args.paralleldockets,
+                                                 order=args.batchorder, sync=args.sync,
+                                                 attachment_workers=args.attachmentworkers)
+        batch_downloader.download_all()
     else:
         if not args.docketid:
             raise "must include docket id"
@@ -214,6 +297,18 @@ if __name__ == "__main__":
         if args.config:
             config_file_path = args.config
         config = load_configuration(config_file_path)
-        downloader = FDMSArchiveDownloader(logger, config['api_key'], args.docketid,
-                                           args.output, args.resume_download)
+        if args.use_async and args.sync:
+            parser.error("--sync is not supported by the asyncio engine")
+        if args.use_async and (args.workers != parser.get_default('workers') or args.attachmentworkers):
+            logger.warning('!! the asyncio engine ignores --workers and --attachmentworkers (see --concurrency)')
+        if args.use_async:
+            from async_fdms_archive_downloader import AsyncFDMSArchiveDownloader
+            downloader = AsyncFDMSArchiveDownloader(logger, config_api_keys(config), args.docketid,
+                                                    args.output, args.resume_download,
+                                                    args.concurrency, config=config)
+        else:
+            downloader = FDMSArchiveDownloader(logger, config_api_keys(config), args.docketid,
+                                               args.output, args.resume_download,
+                                               args.workers, config=config, sync=args.sync,
+                                               attachment_workers=args.attachmentworkers)
         downloader.download_archive()
@@ -1,60 +1,222 @@
-import json
+import math
 import os
-import requests
+import sqlite3
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from rate_limited_fetcher import RateLimitedFetcher
-from json_utils import write_json_output
-from datetime import datetime
+from attachment_file import AttachmentFile, ATTACHMENT_CHUNK_SIZE, response_file_size
+from attachment_policy import (AttachmentPolicy, AttachmentTooLarge, attachment_policy_settings,
+                               is_attachment_url, file_extension)
+from blob_store import BlobStore
+from comment_store import create_comment_store
+from download_metrics import DownloadMetrics, MetricsReporter, metrics_settings
+from http_sessions import create_session, http_settings, request_timeout
+from json_utils import (write_json_output, read_json_input, iter_json_array,
+                        write_json_array_stream, write_json_object_stream, JsonArrayWriter,
+                        json_dumps, json_loads)
+from pipeline import BoundedPipe, PipeAborted, PipelineStage, ThreadBudget, join_stages
+from request_retry import (RetryPolicy, RequestFailed, ItemUnavailable, TransientRequestError,
+                           is_transient_status, retry_settings)
+from resume_journal import ResumeJournal
+from response_cache import create_response_cache
+from datetime import datetime, timedelta
+from urllib.parse import urlparse
 
 MAX_PAGES_PER_DATA_PAGE = 20
 MAX_ITEMS_PER_DATA_PAGE = 250
 MAX_ITEMS_PER_RESULT_BATCH = (MAX_PAGES_PER_DATA_PAGE*MAX_ITEMS_PER_DATA_PAGE)
+MIN_ITEMS_PER_DATA_PAGE = 5
+# date windows are sized to be this full (of a result batch), on average
+DATE_WINDOW_FILL = 0.5
+# how far beyond the first/last lastModifiedDate an open-ended date window
+# may reach when it is split - the date filters are not in UTC
+DATE_WINDOW_MARGIN = timedelta(days=1)
+FILTER_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+LISTING_SPOOL_DIR = '__listing_spool'
+# comment ids queued between the listing and detail stages, per worker
+COMMENT_QUEUE_DEPTH = 50
+# comments queued for the attachment stage, per attachment worker
+ATTACHMENT_QUEUE_DEPTH = 20
+# comment records and completions queued for the writer stage
+WRITER_QUEUE_DEPTH = 500
 API_ENDPOINT_BASE = 'https://api.regulations.gov/v4'
+API_DATE_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+# how far before the start of the previous run a sync looks for changes -
+# generous enough to cover clock skew and the timezone of the date filters
+SYNC_OVERLAP = timedelta(days=1)
+DEAD_LETTERS_FILENAME = 'dead_letters.json'
+# the failures of a single comment that the run records and skips - any
+# other exception (e.g. a 401 or 403 for a revoked API key) ends the run
+DEAD_LETTER_ERRORS = (RequestFailed, ItemUnavailable)
+
+
+def page_data(response_data):
+    """
+    Returns the (data items, has next page) of a single listing page response
+    """
+    if not response_data or 'data' not in response_data or len(response_data['data']) == 0:
+        return [], False
+    if not 'meta' in response_data:
+        return response_data['data'], False
+    if not 'hasNextPage' in response_data['meta']:
+        return response_data['data'], False
+    return response_data['data'], bool(response_data['meta']['hasNextPage'])
+
+
+def to_filter_date(api_date):
+    """
+    Converts an API timestamp (e.g. a lastModifiedDate) to the format
+    used by the date filters of the listing endpoints
+    """
+    return str(datetime.strptime(api_date, API_DATE_FORMAT))
+
+
+def page_total(response_data, default=0):
+    """
+    Returns the total number of items a listing query has (across all pages)
+    """
+    if not response_data or 'meta' not in response_data:
+        return default
+    return response_data['meta'].get('totalElements', default)
+
+
+def split_date_window(window, earliest, latest):
+    """
+    Splits a (lower, upper) lastModifiedDate window (either bound may be None
+    for an open end) into two windows at its midpoint. `earliest` and
+    `latest` stand in for the open ends. Returns None if the window cannot
+    be split any further.
+    """
+    lower, upper = window
+    lower_bound = lower or earliest
+    upper_bound = upper or latest
+    span = (upper_bound - lower_bound).total_seconds()
+    if span < 1:
+        return None
+    middle = lower_bound + timedelta(seconds=math.floor(span / 2))
+    return [(lower, middle), (middle + timedelta(seconds=1), upper)]
+
+
+def merge_by_id(existing_items, updated_items):
+    """
+    Yields the existing items with any updated items replacing those with
+    the same id (in place), and new items appended
+    """
+    updates = {item['id']: item for item in updated_items}
+    for item in existing_items:
+        yield updates.pop(item['id'], item)
+    for item in updated_items:
+        if item['id'] in updates:
+            yield updates.pop(item['id'])
 
 
 class FDMSArchiveDownloader:
-    def __init__(self, logger, api_key, docket_id, output_directory, resume_download=True):
+    def __init__(self, logger, api_key, docket_id, output_directory, resume_download=True, workers=1,
+                 config=None, sync=False, fetcher=None, attachment_workers=None):
         self._logger = logger
-        self._fetcher = RateLimitedFetcher(self._logger, 1000, api_key)
+        self._config = config or {}
         self._docket_id = docket_id
         self._output_directory = output_directory
-        self._resume = resume_download
+        self._resume = resume_download or sync
+        self._sync = sync
+        self._sync_run = None
+        self._api_base = self._config.get(
+            'api_base_url', API_ENDPOINT_BASE).rstrip('/')
         self._resume_info = {}
+        self._workers = max(1, workers)
+        # shared by the (nested) document, date window and page listings
+        self._listing_threads = ThreadBudget(self._workers)
+        self._attachment_workers = max(
+            1, attachment_workers or self._workers)
+        self._metrics_settings = metrics_settings(self._config)
+        self._metrics = DownloadMetrics(profile=bool(
+            self._metrics_settings and self._metrics_settings['profile']))
+        self._metrics_reporter = None
+        self._retry_policy = RetryPolicy(
+            retry_settings(self._config), logger, self._metrics)
+        self._response_cache = None
+        if fetcher is None:
+            self._response_cache = create_response_cache(
+                self._config, output_directory)
+        self._create_sessions(api_key, fetcher)
+        self._attachment_policy = AttachmentPolicy(
+            attachment_policy_settings(self._config))
+        self._blob_store = BlobStore(
+            self._config['blob_store']) if self._config.get('blob_store') else None
+        self._comment_store = None
+        self._lock = threading.Lock()
+        self._total_comments = 0
+        self._completed_comments = 0
+        self._dead_letters = set()
 
-    def _try_load_resume_info(self):
-        if not os.path.exists(self._output_directory):
-            return {}
-        resume_file = os.path.join(self._output_directory, '__resume_info.dat')
-        if not os.path.exists(resume_file):
-            return {}
+    def _create_sessions(self, api_key, fetcher=None):
+        if fetcher is not None:
+            # shared with other downloads (see batch_scheduler)
+            self._fetcher = fetcher
+        else:
+            api_settings = http_settings(self._config, 'api', self._workers)
+            self._fetcher = RateLimitedFetcher(self._logger, 1000, api_key,
+                                               create_session(api_settings),
+                                               request_timeout(api_settings),
+                                               self._response_cache, self._metrics,
+                                               self._retry_policy)
+        attachment_settings = http_settings(
+            self._config, 'attachments', self._attachment_workers)
+        self._attachment_session = create_session(attachment_settings)
+        self._attachment_timeout = request_timeout(attachment_settings)
+
+    def _open_resume_info(self):
+        """
+        Opens the resume journal - every update to it is committed as it
+        is made. Without resume, any earlier progress is discarded.
+        """
+        resume_info = ResumeJournal(self._output_directory)
+        if not self._resume:
+            resume_info.clear()
+        self._dead_letters = set(key[len('dead_'):]
+                                 for key, _ in resume_info.iter_prefix('dead_'))
+        return resume_info
+
+    def _open_comments_dir(self):
+        comments_dir = os.path.join(self._output_directory, 'comments')
+        if not os.path.exists(comments_dir):
+            os.makedirs(comments_dir)
+        self._comment_store = create_comment_store(self._config, comments_dir)
+        return comments_dir
 
-        with open(resume_file) as resume_input:
-            return json.load(resume_input)
+    def _start_metrics(self):
+        if self._metrics_settings is not None:
+            self._metrics_reporter = MetricsReporter(
+                self._metrics, self._output_directory, self._metrics_settings)
+            self._metrics_reporter.start()
 
-    def _save_resume_info(self):
-        if not os.path.exists(self._output_directory):
-            os.makedirs(self._output_directory)
-        resume_file = os.path.join(self._output_directory, '__resume_info.dat')
-        write_json_output(resume_file, self._resume_info)
+    def _stop_metrics(self):
+        if self._metrics_reporter is not None:
+            self._metrics_reporter.stop()
+            self._metrics_reporter = None
+
+    def _close_resume_info(self):
+        if isinstance(self._resume_info, ResumeJournal):
+            self._resume_info.close()
+        if self._comment_store is not None:
+            self._comment_store.close()
+            self._comment_store = None
+        if self._response_cache is not None:
+            self._logger.info(
+                f'response cache: {self._response_cache.saved_calls} API calls saved, '
+                f'{self._response_cache.revalidated_calls} responses revalidated')
 
-    def _get_all_data_pages(self, resource_url, query_params={}, include_page_count=False):
+    def _get_all_data_pages(self, resource_url, query_params={}, include_page_count=False, first_page_number=1):
         ret = []
-        page_number = 1
+        page_number = first_page_number
         while True:
             these_params = {**query_params, 'page[number]': page_number}
             this_response = self._fetcher.get_or_wait(
                 resource_url, these_params)
-            response_data = this_response.data
-
-            if not response_data or 'data' not in response_data or len(response_data['data']) == 0:
-                break
-
-            ret.extend(response_data['data'])
-            if not 'meta' in response_data:
-                break
-            if not 'hasNextPage' in response_data['meta']:
-                break
-            if not response_data['meta']['hasNextPage']:
+            items, has_next_page = page_data(this_response.data)
+            ret.extend(items)
+            if not has_next_page:
                 break
             page_number = page_number + 1
 
@@ -62,67 +224,199 @@ class FDMSArchiveDownloader:
             return ret, page_number
         return ret
 
-    def _get_all_data_pages_for_comments(self, resource_url, document_object_id):
-        # first - get all data pages
-        query_params = {
+    def _comments_query_params(self, document_object_id):
+        return {
             'filter[commentOnId]': document_object_id,
             'page[size]': MAX_ITEMS_PER_DATA_PAGE,
             'sort': 'lastModifiedDate,documentId'
         }
-        ret = self._get_all_data_pages(resource_url, query_params)
 
-        if len(ret) < MAX_ITEMS_PER_RESULT_BATCH:
-            return ret
+    def _iter_listing_pages(self, resource_url, query_params, first_page):
+        """
+        Yields the pages (lists of items) of a listing query with no more than
+        MAX_ITEMS_PER_RESULT_BATCH items, fetching the pages after the first
+        concurrently (on the listing threads that are free)
+        """
+        items, has_next_page = page_data(first_page)
+        yield items
+        if not has_next_page:
+            return
+        page_size = query_params.get('page[size]', MAX_ITEMS_PER_DATA_PAGE)
+        page_count = min(MAX_PAGES_PER_DATA_PAGE,
+                         math.ceil(page_total(first_page) / page_size))
+        if page_count < 2:
+            # the total is missing or wrong - fall back to following hasNextPage
+            yield self._get_all_data_pages(resource_url, query_params, first_page_number=2)
+            return
 
-        # now, use the lastModifiedDate of the last document
-        # to get further pages
-        object_id_hash = {}
-        for ret_item in ret:
-            if not ret_item:
-                continue
-            object_id_hash[ret_item["id"]] = True
+        def get_page(page_number):
+            response = self._fetcher.get_or_wait(
+                resource_url, {**query_params, 'page[number]': page_number})
+            return page_data(response.data)[0]
 
-        while True:
-            current_last_comment = ret[-1]
-            last_modified_date = current_last_comment["attributes"]["lastModifiedDate"]
-            last_modified_date_as_date = datetime.strptime(
-                last_modified_date, '%Y-%m-%dT%H:%M:%SZ')
-            query_params["filter[lastModifiedDate][ge]"] = str(
-                last_modified_date_as_date)
-            this_batch, page_count = self._get_all_data_pages(
-                resource_url, query_params, True)
-
-            if len(this_batch) == 0:
-                break
+        with self._listing_threads.executor(page_count - 1) as executor:
+            for items in executor.map(get_page, range(2, page_count + 1)):
+                yield items
 
-            for item in this_batch:
-                if item["id"] in object_id_hash:
-                    continue
-                ret.append(item)
-                object_id_hash[item["id"]] = True
+    def _date_window_params(self, query_params, window):
+        lower, upper = window
+        these_params = {**query_params}
+        these_params.pop("filter[lastModifiedDate][ge]", None)
+        if lower:
+            these_params["filter[lastModifiedDate][ge]"] = str(lower)
+        if upper:
+            these_params["filter[lastModifiedDate][le]"] = str(upper)
+        return these_params
 
-            if len(this_batch) < MAX_ITEMS_PER_RESULT_BATCH:
-                break
+    def _iter_date_window(self, resource_url, query_params, window, earliest, latest):
+        """
+        Yields the pages of a lastModifiedDate window, splitting it in two
+        (recursively) while it has more items than a result batch
+        """
+        these_params = self._date_window_params(query_params, window)
+        first_page = self._fetcher.get_or_wait(
+            resource_url, {**these_params, 'page[number]': 1}).data
+        total = page_total(first_page)
+        if total > MAX_ITEMS_PER_RESULT_BATCH:
+            halves = split_date_window(window, earliest, latest)
+            if halves is not None:
+                for half in halves:
+                    yield from self._iter_date_window(resource_url, query_params, half, earliest, latest)
+                return
+            self._logger.warning(
+                f'!! {total} items share a lastModifiedDate window of {window} - '
+                f'only the first {MAX_ITEMS_PER_RESULT_BATCH} can be listed')
+        yield from self._iter_listing_pages(resource_url, these_params, first_page)
 
-        return ret
+    def _spool_date_window(self, resource_url, query_params, window, earliest, latest, spool_path):
+        try:
+            with open(spool_path, 'w', encoding='utf-8') as spool:
+                for items in self._iter_date_window(resource_url, query_params, window, earliest, latest):
+                    for item in items:
+                        spool.write(json_dumps(item) + '\n')
+        except BaseException:
+            if os.path.exists(spool_path):
+                os.remove(spool_path)
+            raise
+        return spool_path
+
+    def _iter_comments(self, resource_url, document_object_id, modified_since=None):
+        """
+        Yields all of the comments on a document, in lastModifiedDate order.
+        The API returns at most MAX_ITEMS_PER_RESULT_BATCH items for a query,
+        so larger listings are split into lastModifiedDate windows that each
+        fit, and the windows are listed concurrently on the listing threads
+        that are free (and are split further if they turn out to be too
+        dense). Each window is spooled to disk as it is listed, so memory use
+        does not grow with the listing. A comment modified while the listing
+        runs can turn up in two windows - the ids already listed are kept
+        in a temporary (on-disk) SQLite database to skip it the second time.
+        """
+        query_params = self._comments_query_params(document_object_id)
+        if modified_since:
+            query_params["filter[lastModifiedDate][ge]"] = modified_since
+        first_page = self._fetcher.get_or_wait(
+            resource_url, {**query_params, 'page[number]': 1}).data
+        first_items, _ = page_data(first_page)
+        total = page_total(first_page, len(first_items))
+        if total <= MAX_ITEMS_PER_RESULT_BATCH:
+            for items in self._iter_listing_pages(resource_url, query_params, first_page):
+                yield from items
+            return
+
+        last_page = self._fetcher.get_or_wait(resource_url, {
+            **query_params,
+            'page[size]': MIN_ITEMS_PER_DATA_PAGE,
+            'page[number]': 1,
+            'sort': '-lastModifiedDate,-documentId'
+        }).data
+        last_items, _ = page_data(last_page)
+        first_date = datetime.strptime(
+            first_items[0]["attributes"]["lastModifiedDate"], API_DATE_FORMAT)
+        last_date = datetime.strptime(
+            last_items[0]["attributes"]["lastModifiedDate"], API_DATE_FORMAT) if last_items else first_date
+        earliest = first_date - DATE_WINDOW_MARGIN
+        latest = last_date + DATE_WINDOW_MARGIN
+
+        # the outermost windows are left open-ended, so (whatever the timezone
+        # of the date filters) the windows cover every comment exactly once
+        window_count = math.ceil(
+            total / (MAX_ITEMS_PER_RESULT_BATCH * DATE_WINDOW_FILL))
+        window_seconds = max(1, math.ceil(
+            ((last_date - first_date).total_seconds() + 1) / window_count))
+        lower_bound = datetime.strptime(
+            modified_since, FILTER_DATE_FORMAT) if modified_since else None
+        windows = []
+        window_start = lower_bound
+        for window_index in range(1, window_count):
+            window_end = first_date + \
+                timedelta(seconds=(window_index * window_seconds) - 1)
+            if window_start and window_end < window_start:
+                continue
+            windows.append((window_start, window_end))
+            window_start = window_end + timedelta(seconds=1)
+        windows.append((window_start, None))
+        self._logger.info(
+            f'---- {total} comments - listing in {len(windows)} lastModifiedDate windows')
+
+        spool_dir = os.path.join(self._output_directory, LISTING_SPOOL_DIR)
+        os.makedirs(spool_dir, exist_ok=True)
+        spool_paths = [os.path.join(spool_dir, f'{document_object_id}_{window_index}.jsonl')
+                       for window_index in range(len(windows))]
+        # an empty path is a private database that SQLite deletes once closed
+        seen_ids = sqlite3.connect('', check_same_thread=False)
+        seen_ids.execute('CREATE TABLE seen (id TEXT PRIMARY KEY)')
+        try:
+            with self._listing_threads.executor(len(windows)) as executor:
+                spools = [executor.submit(self._spool_date_window, resource_url, query_params, window,
+                                          earliest, latest, spool_path)
+                          for window, spool_path in zip(windows, spool_paths)]
+                try:
+                    for spool in spools:
+                        spool_path = spool.result()
+                        with open(spool_path, 'r', encoding='utf-8') as spool_input:
+                            for line in spool_input:
+                                item = json_loads(line)
+                                if seen_ids.execute('INSERT OR IGNORE INTO seen VALUES (?)',
+                                                    (item["id"],)).rowcount == 0:
+                                    continue
+                                yield item
+                        seen_ids.commit()
+                        os.remove(spool_path)
+                finally:
+                    for spool in spools:
+                        spool.cancel()
+        finally:
+            seen_ids.close()
+            # the windows that were not read back (if the listing failed)
+            for spool_path in spool_paths:
+                if os.path.exists(spool_path):
+                    os.remove(spool_path)
+            try:
+                os.rmdir(spool_dir)
+            except OSError:
+                # still in use by another document's listing
+                pass
+
+    def _get_all_data_pages_for_comments(self, resource_url, document_object_id, modified_since=None):
+        return list(self._iter_comments(resource_url, document_object_id, modified_since))
 
     def _get_comment_details_and_attachments(self, comment_id):
         query_params = {
             "include": "attachments"
         }
+        # a sync fetches the comments the listing says have changed - a
+        # cached copy may be older than the change
         details_response = self._fetcher.get_or_wait(
-            f'{API_ENDPOINT_BASE}/comments/{comment_id}', query_params)
+            f'{self._api_base}/comments/{comment_id}', query_params,
+            revalidate=self._sync_run is not None)
         return details_response.data
 
-    def _save_attachments(self, comments_dir, comment_id, attachments):
-        self._logger.info(
-            f"-- saving attachments for: {comment_id}, {len(attachments)} attachments...")
-        attachment_base = f'{comment_id}_attachments'
-        full_attachment_path = os.path.join(comments_dir, attachment_base)
-        if not os.path.exists(full_attachment_path):
-            os.makedirs(full_attachment_path)
-
-        ret = []
+    def _attachment_file_urls(self, attachments):
+        """
+        Yields (file_url, filename, size) for every file format of the given
+        attachments that the attachment policy selects
+        """
         for attachment in attachments:
             if ('attributes' in attachment and
                 'fileFormats' in attachment['attributes']
@@ -131,126 +425,651 @@ class FDMSArchiveDownloader:
                 if not attachment_formats or attachment_formats is None:
                     continue
 
-                for file_format in attachment['attributes']['fileFormats']:
-                    if not 'fileUrl' in file_format:
-                        continue
-                    file_parts = file_format['fileUrl'].split('/')
-                    if len(file_parts) < 2:
-                        continue
-                    response = requests.get(
-                        file_format['fileUrl'], allow_redirects=True)
-                    if not response or response.status_code > 299:
-                        continue
-                    filename = file_parts[-1]
-                    full_path = os.path.join(full_attachment_path, filename)
-                    open(full_path, 'wb').write(response.content)
-                    ret.append(f'{attachment_base}/{filename}')
+                yield from self._attachment_policy.select(attachment_formats)
+
+    def _attachment_path(self, comments_dir, comment_id):
+        attachment_base = f'{comment_id}_attachments'
+        full_attachment_path = os.path.join(comments_dir, attachment_base)
+        if not os.path.exists(full_attachment_path):
+            os.makedirs(full_attachment_path, exist_ok=True)
+        return attachment_base, full_attachment_path
+
+    def _save_attachments(self, comments_dir, comment_id, attachments):
+        self._logger.info(
+            f"-- saving attachments for: {comment_id}, {len(attachments)} attachments...")
+        return self._save_attachment_files(comments_dir, comment_id,
+                                           self._attachment_file_urls(attachments))
+
+    def _save_attachment_files(self, comments_dir, comment_id, attachment_files):
+        """
+        Downloads the (file_url, filename, size) attachment files of a
+        comment, returning the paths (relative to the comments directory) of
+        those that were saved - and the URLs of those left for later by the
+        attachment policy
+        """
+        attachment_base, full_attachment_path = None, None
+
+        ret = []
+        for file_url, filename, size in attachment_files:
+            if self._defer_attachment(file_url, size):
+                ret.append(file_url)
+                continue
+            if full_attachment_path is None:
+                attachment_base, full_attachment_path = self._attachment_path(
+                    comments_dir, comment_id)
+            full_path = os.path.join(full_attachment_path, filename)
+            try:
+                if not self._download_attachment(file_url, full_path):
+                    continue
+            except AttachmentTooLarge as e:
+                self._defer_attachment(file_url, e.size)
+                ret.append(file_url)
+                continue
+            ret.append(f'{attachment_base}/{filename}')
 
         return ret
 
+    def _defer_attachment(self, file_url, size):
+        """
+        Returns True if the attachment policy leaves the file to be fetched
+        later (because downloads are deferred, or it is too large)
+        """
+        if self._attachment_policy.deferred:
+            self._metrics.increment('attachments_deferred')
+            return True
+        if self._attachment_policy.too_large(size):
+            self._logger.info(
+                f'-- not downloading {file_url} ({size} bytes) - larger than the attachment policy allows')
+            self._metrics.increment('attachments_too_large')
+            return True
+        return False
+
+    def _attachment_from_store(self, file_url, full_path):
+        """
+        Links an attachment from the blob store (if there is one) when the
+        URL has been downloaded before. Returns True if it was.
+        """
+        if self._blob_store is None or self._sync_run:
+            return False
+        sha256 = self._blob_store.hash_for_url(file_url)
+        if sha256 is None:
+            return False
+        self._blob_store.link_to(sha256, full_path)
+        self._metrics.increment('blob_store_hits')
+        return True
+
+    def _add_attachment_to_store(self, file_url, full_path):
+        if self._blob_store is not None:
+            self._blob_store.add_file(full_path, file_url)
+
+    def _download_attachment(self, file_url, full_path, attempts=2):
+        """
+        Streams an attachment to disk, continuing a partial download if there
+        is one (as does a retry of a failed request). Returns True once the
+        complete file is in place.
+        """
+        attachment = AttachmentFile(full_path)
+        if attachment.is_complete() and not self._sync_run:
+            self._metrics.increment('attachments_already_complete')
+            return True
+        if self._attachment_from_store(file_url, full_path):
+            return True
+        return self._retry_policy.call('attachments', lambda: self._stream_attachment(
+            file_url, full_path, attachment, attempts))
+
+    def _stream_attachment(self, file_url, full_path, attachment, attempts):
+        for _ in range(attempts):
+            started = time.time()
+            received = 0
+            with self._attachment_session.get(file_url, headers=attachment.request_headers(),
+                                              allow_redirects=True, stream=True,
+                                              timeout=self._attachment_timeout) as response:
+                self._check_attachment_size(
+                    file_url, response.status_code, response.headers)
+                if is_transient_status(response.status_code):
+                    self._metrics.observe_request(
+                        'attachments', time.time() - started, 0, response.status_code)
+                    raise TransientRequestError(
+                        file_url, response.status_code)
+                if not attachment.start(response.status_code, response.headers):
+                    self._metrics.observe_request(
+                        'attachments', time.time() - started, 0, response.status_code)
+                    if response.status_code == 416:
+                        continue
+                    return False
+                try:
+                    for chunk in response.iter_content(chunk_size=ATTACHMENT_CHUNK_SIZE):
+                        attachment.write(chunk)
+                        received = received + len(chunk)
+                except BaseException:
+                    attachment.abort()
+                    raise
+                self._metrics.observe_request(
+                    'attachments', time.time() - started, received, response.status_code)
+            if attachment.finish():
+                self._add_attachment_to_store(file_url, full_path)
+                return True
+            self._logger.info(
+                f'-- incomplete attachment download: {file_url} ({attachment.error})')
+        return False
+
+    def _check_attachment_size(self, file_url, status_code, headers):
+        """
+        Raises AttachmentTooLarge (before the body is read) if the response
+        is for a file larger than the attachment policy allows
+        """
+        if status_code > 299:
+            return
+        size = response_file_size(status_code, headers)
+        if self._attachment_policy.too_large(size):
+            raise AttachmentTooLarge(file_url, size)
+
+    def _record_docket_details(self, docket_details):
+        write_json_output(os.path.join(
+            self._output_directory, 'docket_details.json'), docket_details)
+        self._resume_info['docket'] = docket_details['id']
+
     def _get_docket_details(self):
         docket_response = self._fetcher.get_or_wait(
-            f'{API_ENDPOINT_BASE}/dockets/{self._docket_id}')
+            f'{self._api_base}/dockets/{self._docket_id}')
         return docket_response.data['data']
 
+    def _documents_query_params(self):
+        return {
+            'filter[docketId]': self._docket_id,
+            'page[size]': MAX_ITEMS_PER_DATA_PAGE
+        }
+
+    def _record_docket_documents(self, docket_documents):
+        write_json_output(os.path.join(
+            self._output_directory, 'docket_documents.json'), docket_documents)
+        documents_info = []
+        for this_document in docket_documents:
+            documents_info.append(
+                {"id": this_document['id'], "document_object_id": this_document['attributes']['objectId']})
+        self._resume_info['document_ids'] = documents_info
+        return documents_info
+
+    def _document_comments_path(self, document_id, document_object_id):
+        return os.path.join(self._output_directory,
+                            f'{document_id}_{document_object_id}_comments.json')
+
+    def _record_document_comments(self, document_id, document_object_id, comments):
+        doc_comments = []
+
+        def each_comment():
+            for this_comment in comments:
+                doc_comments.append(this_comment['id'])
+                yield this_comment
+
+        comment_count = write_json_array_stream(
+            self._document_comments_path(document_id, document_object_id), each_comment())
+        self._resume_info[f"doc_{document_object_id}"] = comment_count
+        return doc_comments
+
+    def _document_comment_ids(self, document):
+        """
+        Yields the ids of a document's (already listed) comments
+        """
+        listed = self._resume_info[f"doc_{document['document_object_id']}"]
+        if isinstance(listed, list):
+            # recorded by an older version, which kept the ids in the resume info
+            yield from listed
+            return
+        for this_comment in iter_json_array(self._document_comments_path(
+                document['id'], document['document_object_id'])):
+            yield this_comment['id']
+
+    def _start_listing(self):
+        """
+        Records that this run lists the docket from the start - a later
+        --sync fetches what changed since then
+        """
+        self._resume_info['listing_started'] = self._resume_info['run_started']
+
+    def _complete_run(self):
+        """
+        Moves the sync high-water mark up to the start of the last listing -
+        a run that only resumed an earlier run's listing (and so may have
+        fetched nothing new) leaves it where that listing put it
+        """
+        self._resume_info['sync_high_water_mark'] = (self._resume_info.get('listing_started')
+                                                     or self._resume_info.get('sync_high_water_mark')
+                                                     or self._resume_info['run_started'])
+        del self._resume_info['run_started']
+
     def _get_docket_documents(self):
         documents_info = []
         if not self._resume or 'document_ids' not in self._resume_info:
-            docket_documents = self._get_all_data_pages(f'{API_ENDPOINT_BASE}/documents', {
-                'filter[docketId]': self._docket_id,
-                'page[size]': MAX_ITEMS_PER_DATA_PAGE
-            })
-            write_json_output(os.path.join(
-                self._output_directory, 'docket_documents.json'), docket_documents)
-            for this_document in docket_documents:
-                documents_info.append(
-                    {"id": this_document['id'], "document_object_id": this_document['attributes']['objectId']})
-            self._resume_info['document_ids'] = documents_info
+            self._start_listing()
+            docket_documents = self._get_all_data_pages(
+                f'{self._api_base}/documents', self._documents_query_params())
+            documents_info = self._record_docket_documents(docket_documents)
         else:
             self._logger.info('- already have document ids, skipping...')
             documents_info = self._resume_info['document_ids']
         return documents_info
 
-    def _gather_comment_ids(self, comments_dir, documents_info):
-        all_comments = []
+    def _for_each_document(self, document_function, documents_info):
+        """
+        Runs the function for every document on up to `workers` (listing)
+        threads, returning the results in document order
+        """
+        with self._listing_threads.executor(len(documents_info)) as executor:
+            return list(executor.map(document_function, documents_info))
+
+    def _queue_comment(self, comment_pipe, comment_id):
+        with self._lock:
+            self._total_comments = self._total_comments + 1
+        comment_pipe.put(comment_id)
+
+    def _gather_document_comment_ids(self, document, comment_pipe):
+        """
+        Lists a document's comments (or reads back the listing from an
+        earlier run), writing them to the document's comments file as they
+        arrive and passing each comment id on to the detail stage
+        """
+        document_id = document['id']
+        document_object_id = document['document_object_id']
+        document_object_key = f"doc_{document_object_id}"
+        if not self._resume or document_object_key not in self._resume_info:
+            self._logger.info(
+                f'-------- getting comments for document: {document_id}, objectId: {document_object_id}')
+            with self._metrics.profiled('listing'), JsonArrayWriter(self._document_comments_path(document_id, document_object_id)) as writer:
+                for this_comment in self._iter_comments(f'{self._api_base}/comments', document_object_id):
+                    writer.write(this_comment)
+                    self._queue_comment(comment_pipe, this_comment['id'])
+            self._resume_info[document_object_key] = writer.count
+            return
+        self._logger.info(
+            f"- already have document info for {document_object_key} - skipping...")
+        for comment_id in self._document_comment_ids(document):
+            self._queue_comment(comment_pipe, comment_id)
+
+    def _gather_comment_ids(self, comments_dir, documents_info, comment_pipe):
+        """
+        Lists the comments of every document into the comment pipe -
+        documents are listed concurrently, and each is recorded as soon as
+        it is complete
+        """
         total_document_count = len(documents_info)
         self._logger.info(
             f"-------- getting comments for all documents --------")
         self._logger.info(f"---- {total_document_count} total documents")
-        for document in documents_info:
-            document_id = document['id']
-            document_object_id = document['document_object_id']
-            document_object_key = f"doc_{document_object_id}"
-            if not self._resume or document_object_key not in self._resume_info:
-                self._logger.info(
-                    f'-------- getting comments for document: {document_id}, objectId: {document_object_id}')
-                comments = self._get_all_data_pages_for_comments(
-                    f'{API_ENDPOINT_BASE}/comments', document_object_id)
-                comments_filename = f'{document_id}_{document_object_id}_comments.json'
-                write_json_output(os.path.join(
-                    self._output_directory, comments_filename), comments)
-
-                doc_comments = []
-                for this_comment in comments:
-                    doc_comments.append(this_comment['id'])
-                    all_comments.append(this_comment['id'])
-                self._resume_info[document_object_key] = doc_comments
-            else:
-                self._logger.info(
-                    f"- already have document info for {document_object_key} - skipping...")
-                all_comments.extend(self._resume_info[document_object_key])
-        return all_comments
+        self._for_each_document(
+            lambda document: self._gather_document_comment_ids(document, comment_pipe), documents_info)
+        self._logger.info(f"---- {self._total_comments} total comments")
 
-    def _gather_comments_and_attachments(self, comments_dir, all_comments):
-        total_comments = len(all_comments)
-        current_comment_index = 0
-        comment_attachments = {}
-        for comment_id in all_comments:
-            current_comment_index = current_comment_index + 1
-            if (current_comment_index % 100) == 0:
-                current_percent = current_comment_index / total_comments
-                percent_format = "{:.2%}".format(current_percent)
-                self._logger.info(
-                    f"---- retrieved {current_comment_index} of {total_comments} ({percent_format})")
-
-            comment_id_key = f"comment_{comment_id}"
-            if not self._resume or comment_id_key not in self._resume_info:
-                self._logger.info(
-                    f"--- getting comment details and attachments for: {comment_id}")
+    def _write_comment_details(self, comments_dir, comment_id, comment):
+        """
+        Writes the comment details to the comment store and returns the
+        comment's attachment records (if any)
+        """
+        comment_details = comment['data']
+        self._comment_store.write(
+            comment_details['attributes']['commentOnDocumentId'], comment_id, comment_details)
+        return self._comment_attachments(comment)
+
+    def _comment_attachments(self, comment):
+        """
+        Returns the attachment records included with the comment details
+        (or None if it has none)
+        """
+        comment_details = comment['data']
+        if ('relationships' in comment_details and
+                'attachments' in comment_details['relationships'] and
+                'data' in comment_details['relationships']['attachments'] and
+            'included' in comment
+            ):
+
+            attachment_ids = list(
+                map(lambda x: x['id'], comment_details['relationships']['attachments']['data']))
+
+            attachments = list(
+                filter(lambda x: x['id'] in attachment_ids, comment['included']))
+
+            if attachments and len(attachments) > 0:
+                return attachments
+        return None
+
+    def _record_comment(self, comment_id, these_attachments, fetched=True):
+        """
+        Records a completed comment (its attachments, resume info and progress).
+        May be called from any worker thread.
+        """
+        with self._lock:
+            if fetched:
+                self._resume_info[f"comment_{comment_id}"] = these_attachments
+                if self._sync_run:
+                    self._resume_info[f"synced_{comment_id}"] = self._sync_run
+                if comment_id in self._dead_letters:
+                    self._dead_letters.discard(comment_id)
+                    del self._resume_info[f"dead_{comment_id}"]
+            self._completed_comments = self._completed_comments + 1
+            current_comment_index = self._completed_comments
+            self._metrics.set_progress(
+                current_comment_index, self._total_comments)
+        if (current_comment_index % 100) == 0:
+            current_percent = current_comment_index / self._total_comments
+            percent_format = "{:.2%}".format(current_percent)
+            eta_seconds = self._metrics.eta_seconds()
+            eta_format = f', ETA {timedelta(seconds=round(eta_seconds))}' if eta_seconds is not None else ''
+            self._logger.info(
+                f"---- retrieved {current_comment_index} of {self._total_comments} ({percent_format}{eta_format})")
+
+    def _dead_letter(self, comment_id, error):
+        """
+        Records a comment that failed permanently (or kept failing), so the
+        run can go on without it - the next run (or sync) tries it again
+        """
+        self._logger.warning(
+            f'!! giving up on comment {comment_id} for this run: {error}')
+        self._metrics.increment('dead_letters')
+        with self._lock:
+            self._dead_letters.add(comment_id)
+            self._resume_info[f"dead_{comment_id}"] = {
+                'error': repr(error),
+                'failed_at': datetime.utcnow().strftime(API_DATE_FORMAT)
+            }
+        self._record_comment(comment_id, None, False)
+
+    def _have_comment(self, comment_id):
+        if self._sync_run:
+            return self._resume_info.get(f"synced_{comment_id}") == self._sync_run
+        return self._resume and f"comment_{comment_id}" in self._resume_info
+
+    def _pending_attachments(self, comment_id):
+        """
+        Returns the (file_url, filename, size) attachment files of a comment
+        whose details were stored (by this run) before its attachments were
+        all saved, or None if the details still have to be fetched
+        """
+        pending = self._resume_info.get(f"details_{comment_id}")
+        if pending is None or pending.get('run') != self._sync_run:
+            return None
+        return pending['attachments']
+
+    def _fetch_comment_details(self, comment_id, attachment_pipe, writer_pipe):
+        """
+        The metadata stage - fetches a comment's details (the only stage
+        that uses the API budget), hands them to the writer stage and its
+        attachment files to the attachment stage
+        """
+        attachment_files = self._pending_attachments(comment_id)
+        if attachment_files is not None:
+            self._logger.info(
+                f"- already have comment details for {comment_id} - resuming its attachments...")
+            self._metrics.increment('attachment_resumes')
+            attachment_pipe.put((comment_id, attachment_files))
+            return
+        self._logger.info(
+            f"--- getting comment details and attachments for: {comment_id}")
+        with self._metrics.profiled('details'):
+            try:
                 comment = self._get_comment_details_and_attachments(comment_id)
+            except DEAD_LETTER_ERRORS as e:
+                writer_pipe.put(('dead', comment_id, e))
+                return
+            attachments = self._comment_attachments(comment)
+            if attachments is not None:
+                attachment_files = list(
+                    self._attachment_file_urls(attachments))
+        writer_pipe.put(('details', comment_id, comment, attachment_files))
+        if attachment_files is None:
+            writer_pipe.put(('complete', comment_id, None))
+            return
+        attachment_pipe.put((comment_id, attachment_files))
+
+    def _download_comment_attachments(self, comments_dir, job, writer_pipe):
+        """
+        The attachment stage - downloads a comment's attachment files, then
+        hands the comment to the writer stage to be recorded as complete
+        """
+        comment_id, attachment_files = job
+        self._logger.info(
+            f"-- saving attachments for: {comment_id}, {len(attachment_files)} files...")
+        with self._metrics.profiled('attachments'):
+            try:
+                these_attachments = self._save_attachment_files(
+                    comments_dir, comment_id, attachment_files)
+            except DEAD_LETTER_ERRORS as e:
+                # its details are kept, so the next run only retries the attachments
+                writer_pipe.put(('dead', comment_id, e))
+                return
+        writer_pipe.put(('complete', comment_id, these_attachments))
+
+    def _write_comment_result(self, message):
+        """
+        The writer stage - the only writer of comment records and completed
+        comments, on a single thread
+        """
+        with self._metrics.profiled('writer'):
+            if message[0] == 'details':
+                _, comment_id, comment, attachment_files = message
                 comment_details = comment['data']
-                comment_filename = f"{comment_details['attributes']['commentOnDocumentId']}_{comment_id}.json"
-                comment_outpath = os.path.join(
-                    comments_dir, comment_filename)
-                write_json_output(comment_outpath, comment_details)
-
-                these_attachments = []
-                if ('relationships' in comment_details and
-                        'attachments' in comment_details['relationships'] and
-                        'data' in comment_details['relationships']['attachments'] and
-                    'included' in comment
-                    ):
-
-                    attachment_ids = list(
-                        map(lambda x: x['id'], comment_details['relationships']['attachments']['data']))
-
-                    attachments = list(
-                        filter(lambda x: x['id'] in attachment_ids, comment['included']))
-
-                    if attachments and len(attachments) > 0:
-                        saved_filenames = self._save_attachments(
-                            comments_dir, comment_id, attachments)
-                        comment_attachments[comment_id] = []
-                        for saved_filename in saved_filenames:
-                            comment_attachments[comment_id].append(
-                                saved_filename)
-                            these_attachments.append(saved_filename)
-                self._resume_info[comment_id_key] = these_attachments
-            else:
-                self._logger.info(
-                    f"- already have comment details and attachments for {comment_id} - skipping...")
-                comment_attachments[comment_id] = self._resume_info[comment_id_key]
-        return comment_attachments
+                self._comment_store.write(
+                    comment_details['attributes']['commentOnDocumentId'], comment_id, comment_details)
+                if attachment_files is not None:
+                    # the details are kept, so a resumed run only needs the attachments
+                    self._resume_info[f"details_{comment_id}"] = {
+                        'run': self._sync_run, 'attachments': attachment_files}
+                return
+            if message[0] == 'dead':
+                self._dead_letter(message[1], message[2])
+                return
+            _, comment_id, these_attachments = message
+            self._record_comment(comment_id, these_attachments)
+            if these_attachments is not None:
+                del self._resume_info[f"details_{comment_id}"]
+
+    def _gather_comments_and_attachments(self, comments_dir, all_comments):
+        """
+        Fetches the details (and attachments) for every comment id in
+        `all_comments` (a list, or a pipe being filled by the listing stage)
+        through three stages, connected by bounded pipes:
+        * metadata - `workers` threads fetch the comment details. All of
+          them share the one fetcher (and so the one request budget).
+        * attachments - `attachment_workers` threads download the
+          attachment files, so large files do not hold up the API requests
+        * writer - one thread writes the comment records and records each
+          comment (its attachments, resume info and progress) as it completes
+        Each stage resumes on its own: comments whose details were stored
+        before the run was interrupted only have their attachments fetched.
+        """
+        self._completed_comments = 0
+        metadata_pipe = BoundedPipe(self._workers * 2)
+        attachment_pipe = BoundedPipe(
+            self._attachment_workers * ATTACHMENT_QUEUE_DEPTH)
+        writer_pipe = BoundedPipe(WRITER_QUEUE_DEPTH, producers=2)
+        stages = [
+            PipelineStage('details', lambda comment_id: self._fetch_comment_details(comment_id, attachment_pipe, writer_pipe),
+                          metadata_pipe, self._workers, (attachment_pipe, writer_pipe)),
+            PipelineStage('attachments', lambda job: self._download_comment_attachments(comments_dir, job, writer_pipe),
+                          attachment_pipe, self._attachment_workers, (writer_pipe,)),
+            PipelineStage('writer', self._write_comment_result, writer_pipe)
+        ]
+        for stage in stages:
+            stage.start()
+        try:
+            for comment_id in all_comments:
+                if self._have_comment(comment_id):
+                    self._logger.info(
+                        f"- already have comment details and attachments for {comment_id} - skipping...")
+                    self._metrics.increment('resume_skips')
+                    self._record_comment(comment_id, None, False)
+                    continue
+                metadata_pipe.put(comment_id)
+            metadata_pipe.close()
+        except PipeAborted:
+            # a stage failed - its exception is raised below
+            pass
+        except BaseException:
+            for pipe in (metadata_pipe, attachment_pipe, writer_pipe):
+                pipe.abort()
+            for stage in stages:
+                stage.join()
+            raise
+        join_stages(stages)
+
+    def _write_comment_attachments(self):
+        """
+        Writes comment_attachments.json from the resume info, a batch of
+        comments at a time
+        """
+        key_prefix = 'comment_'
+        write_json_object_stream(
+            os.path.join(self._output_directory, 'comment_attachments.json'),
+            ((key[len(key_prefix):], these_attachments)
+             for key, these_attachments in self._resume_info.iter_prefix(key_prefix)
+             if these_attachments is not None))
+
+    def _write_dead_letters(self):
+        """
+        Writes dead_letters.json - the comments that could not be downloaded,
+        and why - or removes it if every comment was
+        """
+        dead_letters_path = os.path.join(
+            self._output_directory, DEAD_LETTERS_FILENAME)
+        key_prefix = 'dead_'
+        dead_letters = [(key[len(key_prefix):], dead_letter)
+                        for key, dead_letter in self._resume_info.iter_prefix(key_prefix)]
+        if not dead_letters:
+            if os.path.exists(dead_letters_path):
+                os.remove(dead_letters_path)
+            return
+        write_json_object_stream(dead_letters_path, dead_letters)
+        self._logger.warning(
+            f'!! {len(dead_letters)} comments could not be downloaded - they are listed in '
+            f'{DEAD_LETTERS_FILENAME}, and the next run (or sync) tries them again')
+
+    def _sync_docket_documents(self, modified_since):
+        """
+        Fetches the documents modified since the given date and merges them
+        into docket_documents.json. Returns the documents info and the ids
+        of documents that are new to the archive.
+        """
+        changed_documents = self._get_all_data_pages(f'{self._api_base}/documents', {
+            **self._documents_query_params(),
+            'filter[lastModifiedDate][ge]': modified_since
+        })
+        documents_path = os.path.join(
+            self._output_directory, 'docket_documents.json')
+        existing_documents = read_json_input(
+            documents_path) if os.path.exists(documents_path) else []
+        existing_ids = set(document['id'] for document in existing_documents)
+        new_document_ids = set(document['id'] for document in changed_documents
+                               if document['id'] not in existing_ids)
+        self._logger.info(
+            f"---- {len(changed_documents)} changed documents ({len(new_document_ids)} new)")
+        documents_info = self._record_docket_documents(
+            list(merge_by_id(existing_documents, changed_documents)))
+        return documents_info, new_document_ids
+
+    def _sync_comment_ids(self, documents_info, new_document_ids, modified_since):
+        """
+        Fetches the comments modified since the given date for every document
+        (concurrently) and merges them into the document's comments file.
+        Returns the ids of the changed comments.
+        """
+        def sync_document(document):
+            document_id = document['id']
+            document_object_id = document['document_object_id']
+            comments_path = os.path.join(
+                self._output_directory, f'{document_id}_{document_object_id}_comments.json')
+            document_since = modified_since
+            if document_id in new_document_ids or not os.path.exists(comments_path):
+                document_since = None
+            self._logger.info(
+                f'-------- getting changed comments for document: {document_id}, objectId: {document_object_id}')
+            comments = self._get_all_data_pages_for_comments(
+                f'{self._api_base}/comments', document_object_id, document_since)
+            existing_comments = iter_json_array(
+                comments_path) if document_since else []
+            self._record_document_comments(document_id, document_object_id,
+                                           merge_by_id(existing_comments, comments))
+            return [comment['id'] for comment in comments]
+
+        changed_comments = []
+        for document_comments in self._for_each_document(sync_document, documents_info):
+            changed_comments.extend(document_comments)
+        return changed_comments
+
+    def _sync_archive(self, comments_dir, high_water_mark):
+        """
+        Brings an existing archive up to date, fetching only the documents,
+        comments and attachments modified since the last completed run
+        """
+        modified_since = str(datetime.strptime(
+            high_water_mark, API_DATE_FORMAT) - SYNC_OVERLAP)
+        self._logger.info(
+            f'-------- syncing changes since: {modified_since} --------')
+
+        self._record_docket_details(self._get_docket_details())
+        documents_info, new_document_ids = self._sync_docket_documents(
+            modified_since)
+        changed_comments = self._sync_comment_ids(
+            documents_info, new_document_ids, modified_since)
+        changed_ids = set(changed_comments)
+        retried_comments = sorted(comment_id for comment_id in self._dead_letters
+                                  if comment_id not in changed_ids)
+
+        self._logger.info(
+            '-------- getting changed comment details and attachments --------')
+        self._logger.info(f"---- {len(changed_comments)} changed comments")
+        if retried_comments:
+            self._logger.info(
+                f"---- retrying {len(retried_comments)} comments that could not be downloaded before")
+            changed_comments.extend(retried_comments)
+        self._total_comments = len(changed_comments)
+        self._gather_comments_and_attachments(comments_dir, changed_comments)
+
+    def _start_comment_listing(self, comments_dir, documents_info):
+        """
+        Lists the documents' comments on a thread of its own, returning the
+        bounded pipe that it hands the comment ids over through (and the thread)
+        """
+        self._total_comments = 0
+        comment_pipe = BoundedPipe(self._workers * COMMENT_QUEUE_DEPTH)
+
+        def list_comments():
+            try:
+                self._gather_comment_ids(
+                    comments_dir, documents_info, comment_pipe)
+            except PipeAborted:
+                return
+            except BaseException as e:
+                comment_pipe.close(e)
+                return
+            comment_pipe.close()
+
+        listing_thread = threading.Thread(target=list_comments, daemon=True)
+        listing_thread.start()
+        return comment_pipe, listing_thread
+
+    def _gather_docket_and_documents(self):
+        self._logger.info('-------- getting docket and details --------')
+        if not self._resume or 'docket' not in self._resume_info:
+            self._record_docket_details(self._get_docket_details())
+        else:
+            self._logger.info('- already have docket details, skipping...')
+
+        return self._get_docket_documents()
+
+    def _download_full_archive(self, comments_dir):
+        documents_info = self._gather_docket_and_documents()
+
+        # comments are fetched while the documents are still being listed
+        comment_pipe, listing_thread = self._start_comment_listing(
+            comments_dir, documents_info)
+        self._logger.info(
+            '-------- getting all comment details and attachments --------')
+        try:
+            self._gather_comments_and_attachments(comments_dir, comment_pipe)
+        except BaseException:
+            comment_pipe.abort()
+            raise
+        finally:
+            listing_thread.join()
 
     def download_archive(self):
         self._logger.info('----------------')
@@ -259,38 +1078,31 @@ class FDMSArchiveDownloader:
 
         start_time = time.time()
         try:
-            if (self._resume):
-                self._resume_info = self._try_load_resume_info()
-
-            self._logger.info('-------- getting docket and details --------')
-            if not self._resume or 'docket' not in self._resume_info:
-                docket_details = self._get_docket_details()
-                write_json_output(os.path.join(
-                    self._output_directory, 'docket_details.json'), docket_details)
-                self._resume_info['docket'] = docket_details['id']
-            else:
-                self._logger.info('- already have docket details, skipping...')
-
-            documents_info = self._get_docket_documents()
-
-            comments_dir = os.path.join(self._output_directory, 'comments')
-            if not os.path.exists(comments_dir):
-                os.makedirs(comments_dir)
-
-            all_comments = self._gather_comment_ids(
-                comments_dir, documents_info)
+            self._resume_info = self._open_resume_info()
+            self._start_metrics()
+            # the start of the first (possibly interrupted) attempt at this run
+            if 'run_started' not in self._resume_info:
+                self._resume_info['run_started'] = datetime.utcnow().strftime(
+                    API_DATE_FORMAT)
+            run_started = self._resume_info['run_started']
 
-            self._logger.info(
-                '-------- getting all comment details and attachments --------')
-
-            total_comments = len(all_comments)
-            self._logger.info(f"---- {total_comments} total comments")
+            comments_dir = self._open_comments_dir()
 
-            comment_attachments = self._gather_comments_and_attachments(
-                comments_dir, all_comments)
+            high_water_mark = self._resume_info.get('sync_high_water_mark')
+            if self._sync and high_water_mark:
+                self._sync_run = run_started
+                self._sync_archive(comments_dir, high_water_mark)
+                # only once every change has been fetched
+                self._start_listing()
+            else:
+                if self._sync:
+                    self._logger.info(
+                        '- no completed download to sync from, downloading the full docket...')
+                self._download_full_archive(comments_dir)
 
-            write_json_output(os.path.join(
-                self._output_directory, 'comment_attachments.json'), comment_attachments)
+            self._write_comment_attachments()
+            self._write_dead_letters()
+            self._complete_run()
 
             self._logger.info('-------- Done! --------')
         except Exception as e:
@@ -298,6 +1110,70 @@ class FDMSArchiveDownloader:
             t, v, tb = sys.exc_info()
             raise v.with_traceback(tb)
         finally:
-            self._save_resume_info()
+            self._stop_metrics()
+            self._close_resume_info()
             end_time = time.time()
             self._logger.info(f'total time taken: {end_time-start_time}')
+
+    def _fetch_deferred_comment_attachments(self, comments_dir, comment_id, these_attachments, attachment_formats):
+        updated = []
+        for attachment in these_attachments:
+            filename = attachment.split('/')[-1]
+            if not is_attachment_url(attachment) or (
+                    attachment_formats and file_extension(urlparse(attachment).path) not in attachment_formats):
+                updated.append(attachment)
+                continue
+            attachment_base, full_attachment_path = self._attachment_path(
+                comments_dir, comment_id)
+            try:
+                downloaded = self._download_attachment(
+                    attachment, os.path.join(full_attachment_path, filename))
+            except DEAD_LETTER_ERRORS as e:
+                self._logger.info(f'-- {e}')
+                downloaded = False
+            if downloaded:
+                updated.append(f'{attachment_base}/{filename}')
+            else:
+                self._logger.info(f'-- could not download: {attachment}')
+                updated.append(attachment)
+        return comment_id, updated
+
+    def fetch_deferred_attachments(self, attachment_formats=None):
+        """
+        Downloads the attachment files that comment_attachments.json lists by
+        URL (see attachment_policy) - all of them, or those with the given
+        extensions - whatever the attachment policy, and records their paths
+        in their place
+        """
+        self._logger.info('----------------')
+        self._logger.info(
+            f'fetching deferred attachments in: {self._output_directory}')
+        self._logger.info('')
+
+        attachment_formats = set(attachment_format.lstrip('.').lower()
+                                 for attachment_format in attachment_formats or [])
+        self._attachment_policy = AttachmentPolicy()
+        self._resume = True
+        attachments_path = os.path.join(
+            self._output_directory, 'comment_attachments.json')
+        comments_dir = os.path.join(self._output_directory, 'comments')
+        try:
+            self._resume_info = self._open_resume_info()
+            comment_attachments = read_json_input(attachments_path)
+            deferred = [(comment_id, these_attachments) for comment_id, these_attachments
+                        in comment_attachments.items()
+                        if any(is_attachment_url(attachment) for attachment in these_attachments or [])]
+            self._logger.info(
+                f'---- {len(deferred)} comments with deferred attachments')
+            with ThreadPoolExecutor(max_workers=self._attachment_workers) as executor:
+                for comment_id, updated in executor.map(
+                        lambda item: self._fetch_deferred_comment_attachments(comments_dir, *item, attachment_formats),
+                        deferred):
+                    comment_attachments[comment_id] = updated
+                    # so the next download (or sync) writes the same paths
+                    if f"comment_{comment_id}" in self._resume_info:
+                        self._resume_info[f"comment_{comment_id}"] = updated
+            write_json_object_stream(
+                attachments_path, comment_attachments.items())
+        finally:
+            self._close_resume_info()
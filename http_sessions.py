@@ -0,0 +1,69 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_HTTP_SETTINGS = {
+    'pool_connections': 4,
+    'pool_maxsize': 16,
+    'connect_timeout': 10,
+    'read_timeout': 120,
+    'retries': 3,
+    'backoff_factor': 0.5
+}
+
+"""
+Pooled, keep-alive HTTP sessions
+
+The API and the attachment downloads each get their own requests.Session,
+so connections (and their TLS handshakes) are reused across requests.
+Pool sizes, timeouts and retries come from the `http` section of
+config.json - settings directly under `http` apply to both, and the `api`
+and `attachments` sections override them for that traffic, e.g.:
+
+    "http": {
+        "read_timeout": 60,
+        "api": {"pool_maxsize": 8},
+        "attachments": {"pool_maxsize": 32, "read_timeout": 300}
+    }
+
+The sessions only retry (`retries` times) connections that could not be
+made, as those requests never reached the server. Failed responses and
+reads are retried by the fetchers' RetryPolicy (see request_retry), so
+that every request that is sent is paced and counted.
+"""
+
+
+def http_settings(config, section, min_pool_size=1):
+    """
+    Returns the merged HTTP settings for a section ('api' or 'attachments')
+    """
+    http_config = (config or {}).get('http', {})
+    settings = {**DEFAULT_HTTP_SETTINGS}
+    settings.update({key: value for key, value in http_config.items()
+                     if key in DEFAULT_HTTP_SETTINGS})
+    settings.update(http_config.get(section, {}))
+    settings['pool_maxsize'] = max(settings['pool_maxsize'], min_pool_size)
+    return settings
+
+
+def request_timeout(settings):
+    return (settings['connect_timeout'], settings['read_timeout'])
+
+
+def create_session(settings):
+    retry = Retry(total=settings['retries'],
+                  connect=settings['retries'],
+                  read=0,
+                  status=0,
+                  other=0,
+                  backoff_factor=settings['backoff_factor'],
+                  allowed_methods=['GET', 'HEAD'],
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=settings['pool_connections'],
+                          pool_maxsize=settings['pool_maxsize'],
+                          max_retries=retry,
+                          pool_block=True)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
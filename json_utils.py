@@ -1,6 +1,208 @@
 import json
+import os
+
+JSON_BACKEND_ENV = 'FDMS_JSON_BACKEND'
+JSON_READ_CHUNK_SIZE = 1024 * 1024
+
+"""
+The JSON encoder/decoder
+
+json_dumps(data), json_dumps_bytes(data), json_loads(text)
+
+Uses orjson when it is installed (pip install orjson) - it encodes and
+decodes several times faster than the standard library - and the json
+module otherwise. Set the FDMS_JSON_BACKEND environment variable to `json`
+to use the standard library regardless (or to `orjson` to require it).
+Both write compact JSON that either one reads back; anything orjson cannot
+encode (e.g. integers beyond 64 bits) falls back to the json module.
+"""
+
+
+def _load_backend():
+    requested = os.environ.get(JSON_BACKEND_ENV, '').strip().lower()
+    if requested in ('json', 'stdlib'):
+        return None
+    try:
+        import orjson
+    except ImportError:
+        if requested == 'orjson':
+            raise Exception(
+                f'{JSON_BACKEND_ENV}=orjson needs the orjson package (pip install orjson)')
+        return None
+    return orjson
+
+
+_orjson = _load_backend()
+
+
+def json_dumps_bytes(data):
+    if _orjson is not None:
+        try:
+            return _orjson.dumps(data, option=_orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+
+def json_dumps(data):
+    if _orjson is not None:
+        return json_dumps_bytes(data).decode('utf-8')
+    return json.dumps(data, separators=(',', ':'))
+
+
+def json_loads(text):
+    if _orjson is not None:
+        return _orjson.loads(text)
+    return json.loads(text)
 
 
 def write_json_output(filepath, data):
-    with open(filepath, 'w', encoding='utf-8') as outfile:
-        json.dump(data, outfile)
+    with open(filepath, 'wb') as outfile:
+        outfile.write(json_dumps_bytes(data))
+
+
+def read_json_input(filepath):
+    with open(filepath, 'rb') as infile:
+        return json_loads(infile.read())
+
+
+"""
+Writes a JSON array one item at a time
+
+with JsonArrayWriter(filepath) as writer:
+    for item in items:
+        writer.write(item)
+
+Items are written to `{filepath}.part` (one per line) as they arrive, and
+the file is moved into place only once the array is complete - an
+exception inside the `with` block leaves any existing file untouched.
+"""
+
+
+class JsonArrayWriter:
+    def __init__(self, filepath):
+        self._filepath = filepath
+        self._part_path = f'{filepath}.part'
+        self._output = None
+        self.count = 0
+
+    def __enter__(self):
+        self._output = open(self._part_path, 'w', encoding='utf-8')
+        self._output.write('[')
+        return self
+
+    def write(self, item):
+        self._output.write('\n' if self.count == 0 else ',\n')
+        self._output.write(json_dumps(item))
+        self.count = self.count + 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._output.write('\n]')
+        self._output.close()
+        if exc_type is None:
+            os.replace(self._part_path, self._filepath)
+        else:
+            os.remove(self._part_path)
+        return False
+
+
+def write_json_array_stream(filepath, items):
+    with JsonArrayWriter(filepath) as writer:
+        for item in items:
+            writer.write(item)
+    return writer.count
+
+
+def write_json_object_stream(filepath, key_values):
+    """
+    Writes a JSON object from an iterable of (key, value), one entry per line
+    """
+    part_path = f'{filepath}.part'
+    with open(part_path, 'w', encoding='utf-8') as outfile:
+        outfile.write('{')
+        separator = '\n'
+        for key, value in key_values:
+            outfile.write(separator)
+            outfile.write(f'{json_dumps(key)}: {json_dumps(value)}')
+            separator = ',\n'
+        outfile.write('\n}')
+    os.replace(part_path, filepath)
+
+
+def iter_json_array(filepath):
+    """
+    Yields the items of a JSON array file without loading the whole file.
+    Files written by JsonArrayWriter are read a line at a time; anything
+    else (e.g. a listing written as one line) is parsed incrementally.
+    """
+    with open(filepath, 'r', encoding='utf-8') as infile:
+        first_line = infile.readline()
+        if first_line.strip() != '[':
+            infile.seek(0)
+            yield from iter_json_array_stream(infile)
+            return
+        for line in infile:
+            line = line.strip()
+            if not line or line == ']':
+                continue
+            yield json_loads(line[:-1] if line.endswith(',') else line)
+
+
+def iter_json_array_stream(infile, chunk_size=JSON_READ_CHUNK_SIZE):
+    """
+    Yields the items of the JSON array read from a text file object,
+    holding only the current item (and the unparsed part of the current
+    chunk) in memory
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    at_end = False
+
+    def read_more():
+        nonlocal buffer, position, at_end
+        # large items are read in growing chunks, so each is decoded only a few times
+        chunk = infile.read(max(chunk_size, len(buffer) - position))
+        if not chunk:
+            at_end = True
+        buffer = buffer[position:] + chunk
+        position = 0
+
+    def next_character():
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position = position + 1
+            if position < len(buffer):
+                return buffer[position]
+            if at_end:
+                return None
+            read_more()
+
+    if next_character() != '[':
+        raise ValueError(f'expected a JSON array in {getattr(infile, "name", "input")}')
+    position = position + 1
+    if next_character() == ']':
+        return
+    while True:
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if at_end:
+                raise
+            read_more()
+            continue
+        # a number at the end of the buffer may continue in the next chunk
+        if end == len(buffer) and not at_end:
+            read_more()
+            continue
+        position = end
+        yield item
+        separator = next_character()
+        if separator == ']':
+            return
+        if separator != ',':
+            raise ValueError(
+                f'expected , or ] after item in {getattr(infile, "name", "input")}, found {separator!r}')
+        position = position + 1
+        next_character()
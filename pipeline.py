@@ -0,0 +1,195 @@
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+PUT_POLL_SECONDS = 1.0
+
+"""
+A bounded queue between the stages of a download
+
+pipe = BoundedPipe(maxsize, producers)
+
+One stage `put`s items (blocking while the pipe is full), and `close`s
+the pipe when it is done - or with the exception that stopped it. A pipe
+fed by several stages ends once each of its `producers` has closed it (or
+as soon as one closes it with an exception). The next stage iterates over
+the pipe until it is closed, and re-raises the producer's exception if
+there was one. If the consuming stage fails, it `abort`s the pipe so the
+producer stops (its `put` raises PipeAborted) rather than blocking forever.
+"""
+
+
+class PipeAborted(Exception):
+    pass
+
+
+class _PipeEnd:
+    def __init__(self, error=None):
+        self.error = error
+
+
+class BoundedPipe:
+    def __init__(self, maxsize, producers=1):
+        self._queue = queue.Queue(maxsize=max(1, maxsize))
+        self._aborted = False
+        self._lock = threading.Lock()
+        self._open_producers = max(1, producers)
+
+    def put(self, item):
+        while True:
+            if self._aborted:
+                raise PipeAborted()
+            try:
+                self._queue.put(item, timeout=PUT_POLL_SECONDS)
+                return
+            except queue.Full:
+                continue
+
+    def close(self, error=None):
+        with self._lock:
+            self._open_producers = self._open_producers - 1
+            if error is None and self._open_producers > 0:
+                return
+        try:
+            self.put(_PipeEnd(error))
+        except PipeAborted:
+            pass
+
+    def abort(self):
+        self._aborted = True
+
+    def __iter__(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=PUT_POLL_SECONDS)
+            except queue.Empty:
+                if self._aborted:
+                    raise PipeAborted()
+                continue
+            if isinstance(item, _PipeEnd):
+                # let any other consumers see the end too
+                self._queue.put(item)
+                if item.error is not None:
+                    raise item.error
+                return
+            yield item
+
+
+"""
+A stage of a download pipeline
+
+stage = PipelineStage(name, handle_item, input_pipe, threads, output_pipes)
+
+Calls `handle_item` for every item of the input pipe on `threads` threads,
+and closes its output pipes once the input is exhausted. If an item
+fails, the stage stops: its input pipe is aborted (so the stages before it
+stop too) and its output pipes are closed with the exception (so the
+stages after it stop once they have drained them). `join_stages` waits
+for the stages and raises the exception that stopped the pipeline.
+"""
+
+
+class PipelineStage:
+    def __init__(self, name, handle_item, input_pipe, threads=1, output_pipes=()):
+        self.name = name
+        self.error = None
+        self._handle_item = handle_item
+        self._input_pipe = input_pipe
+        self._output_pipes = output_pipes
+        self._lock = threading.Lock()
+        self._running = max(1, threads)
+        self._threads = [threading.Thread(target=self._run, name=f'{name}-{index}', daemon=True)
+                         for index in range(self._running)]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def _run(self):
+        try:
+            for item in self._input_pipe:
+                self._handle_item(item)
+        except BaseException as e:
+            with self._lock:
+                if self.error is None:
+                    self.error = e
+            self._input_pipe.abort()
+        finally:
+            with self._lock:
+                self._running = self._running - 1
+                finished = self._running == 0
+            if finished:
+                for output_pipe in self._output_pipes:
+                    output_pipe.close(self.error)
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+
+def join_stages(stages):
+    """
+    Waits for the stages to finish, then raises the exception that stopped
+    the pipeline (if one did) - the stages before the one that failed only
+    see PipeAborted, and the ones after it see the same exception
+    """
+    for stage in stages:
+        stage.join()
+    errors = [stage.error for stage in stages if stage.error is not None]
+    for error in errors:
+        if not isinstance(error, PipeAborted):
+            raise error
+    if errors:
+        raise errors[0]
+
+
+"""
+A budget of threads shared by nested thread pools
+
+thread_budget = ThreadBudget(threads)
+
+with thread_budget.executor(wanted) as executor:
+    executor.submit(...) / executor.map(...)
+
+Each executor gets as many of the `wanted` threads as are left in the
+budget, and gives them back when it exits - so pools started inside each
+other's work (e.g. for documents, then date windows, then pages) never
+run more than `threads` threads between them. An executor that gets no
+threads runs each call on the calling thread instead.
+"""
+
+
+class _SerialExecutor:
+    def submit(self, function, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(function(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+    def map(self, function, *iterables):
+        return map(function, *iterables)
+
+
+class ThreadBudget:
+    def __init__(self, threads):
+        self._lock = threading.Lock()
+        self._available = max(1, threads)
+
+    @contextmanager
+    def executor(self, wanted):
+        with self._lock:
+            granted = min(max(0, wanted), self._available)
+            self._available = self._available - granted
+        try:
+            if granted == 0:
+                yield _SerialExecutor()
+            else:
+                with ThreadPoolExecutor(max_workers=granted) as executor:
+                    yield executor
+        finally:
+            with self._lock:
+                self._available = self._available + granted
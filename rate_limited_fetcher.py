@@ -1,9 +1,12 @@
-import json
 import math
-import requests
 import time
+from download_metrics import endpoint_for_url
+from json_utils import json_loads
+from http_sessions import create_session, http_settings, request_timeout
+from rate_limiter import ApiKeyPool
+from request_retry import RetryPolicy, check_response_status
 
-SECONDS_PER_HOUR = (60 * 60)
+RATE_LIMIT_LOG_THRESHOLD = 5.0
 
 """
 A single response item from the fetcher class
@@ -22,39 +25,63 @@ class ResponseItem:
         self.data = response_data
         self.is_rate_limited = False
         self.wait_until = 0.0
+        self.headers = {}
 
 
 """
 A URL fetcher with the ability to be rate limited
 
-RateLimitedFetcher(logger, requests_per_hour, api_key)
-"""
+RateLimitedFetcher(logger, requests_per_hour, api_key, session, timeout, cache, metrics, retry_policy)
 
+Requests are sent on `session` (a pooled requests.Session, see
+http_sessions) with the given (connect, read) `timeout`.
 
-class RateLimitedFetcher:
-    def __init__(self, logger, requests_per_hour, api_key):
-        self._requests_per_hour = requests_per_hour
-        self._current_requests = 0
-        self._next_reset_time = 0
-        self._logger = logger
-        self._api_key = api_key
+`api_key` may be a single key or a list of keys - requests rotate across
+the keys that have budget left. Requests are paced by a token bucket per
+key that follows the rate limit headers returned by the API.
 
-    def _check_reset_timer(self):
-        if time.time() < self._next_reset_time:
-            return False
-        self._next_reset_time = time.time() + SECONDS_PER_HOUR + 10
-        self._current_requests = 0
-        return True
+With a `cache` (see response_cache), fresh cached responses are returned
+without using the request budget, and stale ones are revalidated with a
+conditional request - as are fresh ones, for a request that asks to
+`revalidate`.
 
-    def _check_current_limit(self):
-        if self._next_reset_time == 0:
-            self._next_reset_time = time.time() + SECONDS_PER_HOUR + 10
+With `metrics` (see download_metrics), every request's latency and size,
+time spent waiting on the rate limit, and cache hits are recorded.
 
-        if self._current_requests >= self._requests_per_hour:
-            if not self._check_reset_timer():
-                return False
+Requests that fail in a way that may pass (connection errors, timeouts,
+5xx responses) are retried, and endpoints that keep failing are paused, by
+the `retry_policy` (see request_retry - by default, a RetryPolicy with the
+default settings). Other error responses raise PermanentRequestError.
 
-        return True
+A single fetcher may be shared between threads - all of them draw
+from the same request budget. A caller that decides who goes next (see
+batch_scheduler) can reserve a request's budget with `reserve_api_key`
+first, and then send the request with `get_reserved`.
+"""
+
+
+class RateLimitedFetcher:
+    def __init__(self, logger, requests_per_hour, api_key, session=None, timeout=None, cache=None,
+                 metrics=None, retry_policy=None):
+        self._requests_per_hour = requests_per_hour
+        self._logger = logger
+        self._cache = cache
+        self._metrics = metrics
+        self._retry_policy = retry_policy or RetryPolicy(
+            logger=logger, metrics=metrics)
+        self._session = session
+        self._timeout = timeout
+        if session is None:
+            self._create_default_session()
+        api_keys = api_key if isinstance(
+            api_key, (list, tuple)) else [api_key]
+        self._key_pool = ApiKeyPool(
+            [key for key in api_keys if key] or [None], requests_per_hour)
+
+    def _create_default_session(self):
+        settings = http_settings(None, 'api')
+        self._session = create_session(settings)
+        self._timeout = self._timeout or request_timeout(settings)
 
     def _wait_time_delta(self, until_timestamp):
         current_time = time.time()
@@ -73,60 +100,153 @@ class RateLimitedFetcher:
             return ''
         return f'?{"&".join(params)}'
 
-    def _set_is_rate_limited(self):
-        self._current_requests = self._requests_per_hour * 1000
-        self._next_reset_time = time.time() + (60 * 5)  # 5 minutes
+    def _rate_limited_response(self, wait_seconds):
         wait_response = ResponseItem(429, None)
         wait_response.is_rate_limited = True
-        wait_response.wait_until = self._next_reset_time
+        wait_response.wait_until = time.time() + wait_seconds
         return wait_response
 
-    def _send_request(self, resource_url, query_params={}):
-        if not self._check_current_limit():
-            wait_response = ResponseItem(429, None)
-            wait_response.is_rate_limited = True
-            wait_response.wait_until = self._next_reset_time
-            return wait_response
-        request_headers = {
-            "Content-Type": "application/json"
-        }
+    def reserve_api_key(self):
+        """
+        Takes a request's budget from a key that has some - returns
+        (api_key, 0.0), or (None, seconds until a key will have budget)
+        """
+        return self._key_pool.acquire()
 
-        send_query_params = {
-            **query_params, 'api_key': self._api_key} if self._api_key else {**query_params}
+    def _reserve_request(self):
+        """
+        Returns (api_key, None) when a request may be sent with that key,
+        or (None, rate limited ResponseItem) if no key has budget left
+        """
+        api_key, wait_seconds = self._key_pool.acquire()
+        if wait_seconds > 0.0:
+            return None, self._rate_limited_response(wait_seconds)
+        return api_key, None
+
+    def _request_params(self, api_key, query_params):
+        return {**query_params, 'api_key': api_key} if api_key else {**query_params}
+
+    def _handle_response(self, api_key, resource_url, status_code, headers, text):
+        if status_code == 429:
+            return self._rate_limited_response(
+                self._key_pool.set_rate_limited(api_key, headers))
+        self._key_pool.update_from_headers(api_key, headers)
+        check_response_status(resource_url, status_code, text)
+
+        if text:
+            response_text = json_loads(text)
+        else:
+            response_text = None
+        response_item = ResponseItem(status_code, response_text)
+        response_item.headers = headers
+        return response_item
 
-        self._current_requests = self._current_requests + 1
-        response = requests.get(url=resource_url,
-                                params=send_query_params,
-                                headers=request_headers
-                                )
+    def _observe_request(self, resource_url, started, status_code, text):
+        if self._metrics is not None:
+            self._metrics.observe_request(endpoint_for_url(resource_url), time.time() - started,
+                                          len(text or ''), status_code)
 
-        if response.status_code == 429:
-            return self._set_is_rate_limited()
-        if response.status_code == 400:
-            raise Exception(
-                f"recevied a 400/BAD_REQUEST with: {response.text}")
+    def _check_cache(self, resource_url, query_params, revalidate=False):
+        """
+        Returns (cached ResponseItem, None) if the cache can answer the request,
+        otherwise (None, stale cached response to revalidate - if any)
+        """
+        if self._cache is None:
+            return None, None
+        fresh, stale = self._cache.lookup(resource_url, query_params, revalidate)
+        if fresh is None:
+            return None, stale
+        if self._metrics is not None:
+            self._metrics.increment('cache_hits')
+        self._logger.info(
+            f'cache hit (saved API call): {resource_url}{self._query_params_string(query_params)}')
+        return ResponseItem(200, fresh.data), None
 
-        if response.text:
-            response_text = json.loads(response.text)
+    def _update_cache(self, resource_url, query_params, response, stale):
+        """
+        Stores a response in the cache - or if the server said the stale cached
+        response is not modified, returns that instead
+        """
+        if self._cache is None:
+            return response
+        if response.code == 304 and stale is not None:
+            self._cache.revalidated(stale)
+            if self._metrics is not None:
+                self._metrics.increment('cache_revalidations')
+            self._logger.info(
+                f'cache revalidated (not modified): {resource_url}{self._query_params_string(query_params)}')
+            return ResponseItem(200, stale.data)
+        if response.code == 200 and response.data is not None:
+            self._cache.store(resource_url, query_params,
+                              response.data, response.headers)
+        return response
+
+    def _send_request(self, resource_url, query_params={}, extra_headers={}, reserved=None):
+        if reserved is not None:
+            api_key, = reserved
         else:
-            response_text = None
-        return ResponseItem(response.status_code, response_text)
+            api_key, wait_response = self._reserve_request()
+            if wait_response:
+                return wait_response
+        request_headers = {
+            "Content-Type": "application/json",
+            **extra_headers
+        }
 
-    def get_or_wait(self, resource_url, query_params={}):
+        started = time.time()
+        response = self._session.get(url=resource_url,
+                                     params=self._request_params(
+                                         api_key, query_params),
+                                     headers=request_headers,
+                                     timeout=self._timeout
+                                     )
+        self._observe_request(resource_url, started,
+                              response.status_code, response.text)
+        return self._handle_response(api_key, resource_url, response.status_code,
+                                     response.headers, response.text)
+
+    def _log_rate_limit_wait(self, wait_until_time):
+        if self._metrics is not None:
+            self._metrics.add_rate_limit_wait(wait_until_time - time.time())
+        if wait_until_time - time.time() >= RATE_LIMIT_LOG_THRESHOLD:
+            self._logger.info(
+                f'rate limit reached - waiting for {self._wait_time_delta(wait_until_time)}')
+
+    def get_or_wait(self, resource_url, query_params={}, revalidate=False):
         """
         Attempts to get send a GET request to the specified URL (with the parameters).
-        If the call was rate limited, or, the wait_until_time has not passed,
-        then it will self-throttle.
+        If the call was rate limited, or, no API key has budget left,
+        then it will self-throttle until one does. Raises RequestFailed if
+        the request keeps failing. With `revalidate`, a cached response is
+        only used if the server confirms it is not modified.
         """
+        return self._get(resource_url, query_params, revalidate=revalidate)
+
+    def get_reserved(self, api_key, resource_url, query_params={}, revalidate=False):
+        """
+        get_or_wait() for a request whose budget was already taken with
+        reserve_api_key() - it is handed back if the cache answers instead
+        """
+        return self._get(resource_url, query_params, (api_key,), revalidate)
+
+    def _get(self, resource_url, query_params, reserved=None, revalidate=False):
+        cached, stale = self._check_cache(resource_url, query_params, revalidate)
+        if cached is not None:
+            if reserved is not None:
+                self._key_pool.refund(*reserved)
+            return cached
         self._logger.info(
             f'getting: {resource_url}{self._query_params_string(query_params)}')
+        validation_headers = stale.validation_headers() if stale else {}
+        endpoint = endpoint_for_url(resource_url)
+        # only the first attempt uses the reserved budget
+        reservations = [reserved] if reserved is not None else []
         while True:
-            response = self._send_request(resource_url, query_params)
+            response = self._retry_policy.call(endpoint, lambda: self._send_request(
+                resource_url, query_params, validation_headers,
+                reservations.pop() if reservations else None))
             if response.is_rate_limited:
-                wait_until_time = response.wait_until
-                while time.time() < wait_until_time:
-                    self._logger.info(
-                        f'rate limit reached - waiting for {self._wait_time_delta(wait_until_time)}')
-                    time.sleep(60)
+                self._log_rate_limit_wait(response.wait_until)
+                time.sleep(max(0.0, response.wait_until - time.time()))
                 continue
-            return response
+            return self._update_cache(resource_url, query_params, response, stale)
@@ -0,0 +1,172 @@
+import threading
+import time
+
+SECONDS_PER_HOUR = (60 * 60)
+DEFAULT_BURST = 10
+DEFAULT_RATE_LIMITED_WAIT = 60.0
+
+"""
+Request budgeting for the rate limited fetchers
+
+TokenBucket(requests_per_hour, burst)
+
+A token bucket that refills smoothly at `requests_per_hour`, holding at most
+`burst` tokens. The bucket is kept in line with the rate limit headers the
+API sends back (X-RateLimit-Limit / X-RateLimit-Remaining, and Retry-After /
+X-RateLimit-Reset when present), so requests are paced to the quota the
+server actually reports rather than to a local guess.
+
+ApiKeyPool(api_keys, requests_per_hour)
+
+One TokenBucket per API key - requests rotate across the keys that have
+budget available.
+
+Neither class sleeps: they report how long the caller should wait, so
+both the threaded and the asyncio fetchers can use them.
+"""
+
+
+def _header_value(headers, name):
+    if not headers:
+        return None
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _reset_seconds(headers):
+    """
+    Seconds until the server's limit resets (if the server says)
+    """
+    retry_after = _header_value(headers, 'Retry-After')
+    if retry_after is not None:
+        return max(0.0, retry_after)
+    reset = _header_value(headers, 'X-RateLimit-Reset')
+    if reset is None:
+        return None
+    # the reset may be given as an epoch timestamp or as a number of seconds
+    if reset > 1000000000:
+        return max(0.0, reset - time.time())
+    return max(0.0, reset)
+
+
+class TokenBucket:
+    def __init__(self, requests_per_hour, burst=DEFAULT_BURST):
+        self._rate = requests_per_hour / SECONDS_PER_HOUR
+        self._capacity = max(1, burst)
+        self._tokens = float(self._capacity)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = max(0.0, now - self._updated)
+        self._tokens = min(float(self._capacity),
+                           self._tokens + (elapsed * self._rate))
+        self._updated = now
+
+    def reserve(self):
+        """
+        Takes a token if one is available. Returns 0 if it did, otherwise
+        the number of seconds until one will be.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                return self._blocked_until - now
+            self._refill(now)
+            if self._tokens >= 1.0:
+                self._tokens = self._tokens - 1.0
+                return 0.0
+            return (1.0 - self._tokens) / self._rate
+
+    def refund(self):
+        """
+        Returns a token that was reserved for a request that was not sent
+        """
+        with self._lock:
+            self._tokens = min(float(self._capacity), self._tokens + 1.0)
+
+    def update_from_headers(self, headers):
+        """
+        Aligns the bucket with the quota reported in a response's headers
+        """
+        limit = _header_value(headers, 'X-RateLimit-Limit')
+        remaining = _header_value(headers, 'X-RateLimit-Remaining')
+        reset_seconds = _reset_seconds(headers)
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if limit is not None and limit > 0:
+                self._rate = limit / SECONDS_PER_HOUR
+            if remaining is None:
+                return
+            self._tokens = min(self._tokens, max(0.0, remaining))
+            if remaining <= 0:
+                wait = reset_seconds if reset_seconds is not None else (
+                    1.0 / self._rate)
+                self._blocked_until = max(self._blocked_until, now + wait)
+            elif reset_seconds:
+                # spread what is left evenly over the time to the reset
+                self._rate = max(self._rate, remaining / reset_seconds)
+
+    def set_rate_limited(self, headers=None):
+        """
+        Empties the bucket after the server rejected a request, and returns
+        the number of seconds to wait before trying again
+        """
+        wait = _reset_seconds(headers)
+        if wait is None:
+            wait = DEFAULT_RATE_LIMITED_WAIT
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = 0.0
+            self._updated = now
+            self._blocked_until = max(self._blocked_until, now + wait)
+            return self._blocked_until - now
+
+
+class ApiKeyPool:
+    def __init__(self, api_keys, requests_per_hour, burst=DEFAULT_BURST):
+        if not api_keys:
+            api_keys = [None]
+        self._api_keys = list(api_keys)
+        self._buckets = {api_key: TokenBucket(requests_per_hour, burst)
+                         for api_key in self._api_keys}
+        self._next_index = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._api_keys)
+
+    def acquire(self):
+        """
+        Returns (api_key, 0) for a key with budget available, or
+        (None, seconds to wait) if every key is exhausted
+        """
+        with self._lock:
+            key_count = len(self._api_keys)
+            min_wait = None
+            for offset in range(key_count):
+                index = (self._next_index + offset) % key_count
+                api_key = self._api_keys[index]
+                wait = self._buckets[api_key].reserve()
+                if wait <= 0.0:
+                    self._next_index = (index + 1) % key_count
+                    return api_key, 0.0
+                if min_wait is None or wait < min_wait:
+                    min_wait = wait
+            return None, min_wait
+
+    def refund(self, api_key):
+        self._buckets[api_key].refund()
+
+    def update_from_headers(self, api_key, headers):
+        self._buckets[api_key].update_from_headers(headers)
+
+    def set_rate_limited(self, api_key, headers=None):
+        return self._buckets[api_key].set_rate_limited(headers)
@@ -0,0 +1,264 @@
+import asyncio
+import random
+import threading
+import time
+import requests
+
+DEFAULT_RETRY_SETTINGS = {
+    'attempts': 6,
+    'base_delay': 1.0,
+    'max_delay': 120.0,
+    'breaker_failures': 5,
+    'breaker_seconds': 60.0
+}
+# how often callers waiting on an open circuit check whether a trial
+# request has closed it again
+BREAKER_POLL_SECONDS = 0.25
+TRANSIENT_STATUS_CODES = [408]
+# error responses about the one item requested, rather than the request
+# (or the API key) as a whole
+ITEM_STATUS_CODES = [404, 410]
+
+"""
+Retries of failed requests, and a circuit breaker per endpoint
+
+RetryPolicy(settings, logger, metrics)
+
+The HTTP sessions only retry connections that could not be made (see
+http_sessions). A request that fails in a way that may pass - a connection
+error or reset, a timeout, a 408 or a 5xx response - is tried again by the policy,
+up to `attempts` times in all, after a jittered exponential backoff: a
+random delay of up to `base_delay * 2^attempt` seconds, capped at
+`max_delay`. Any other error response (other than a 429, which the
+fetchers wait out) is a PermanentRequestError and is not retried - an
+ItemUnavailable one for a 404 or 410, which only concern the item that was
+requested. A request that has used up its attempts raises RequestFailed.
+
+Every endpoint (`comment_details`, `attachments`, ...) has a circuit
+breaker: after `breaker_failures` different requests in a row have failed,
+its circuit opens and new requests to it wait for `breaker_seconds` rather
+than hammering a failing service. Then one trial request is let through -
+the circuit closes again if it succeeds, or stays open for another
+`breaker_seconds` if not. Only a request's first failure counts, and its
+retries do not wait for the circuit, so a few requests that always fail
+(e.g. for one broken comment) use up their attempts and are given up on
+without holding up the rest.
+
+The settings come from the `retry` section of config.json, e.g.:
+
+    "retry": {"attempts": 6, "base_delay": 1.0, "max_delay": 120,
+              "breaker_failures": 5, "breaker_seconds": 60}
+
+May be shared between threads (and by the asyncio downloader).
+"""
+
+
+class TransientRequestError(Exception):
+    def __init__(self, resource_url, status_code, text=None):
+        super().__init__(
+            f'received a {status_code} from {resource_url}: {(text or "")[:200]}')
+        self.status_code = status_code
+
+
+class PermanentRequestError(Exception):
+    def __init__(self, resource_url, status_code, text=None):
+        super().__init__(
+            f'received a {status_code} from {resource_url}: {(text or "")[:200]}')
+        self.status_code = status_code
+
+
+class ItemUnavailable(PermanentRequestError):
+    pass
+
+
+class RequestFailed(Exception):
+    def __init__(self, endpoint, attempts, error):
+        super().__init__(
+            f'{endpoint} request failed after {attempts} attempts: {error!r}')
+        self.endpoint = endpoint
+        self.error = error
+
+
+RETRYABLE_EXCEPTIONS = (requests.ConnectionError, requests.Timeout,
+                        requests.exceptions.ChunkedEncodingError, TransientRequestError)
+
+
+def retry_settings(config):
+    retry_config = (config or {}).get('retry') or {}
+    return {**DEFAULT_RETRY_SETTINGS, **retry_config}
+
+
+def is_transient_status(status_code):
+    return status_code >= 500 or status_code in TRANSIENT_STATUS_CODES
+
+
+def check_response_status(resource_url, status_code, text=None):
+    """
+    Raises TransientRequestError or PermanentRequestError for an error
+    response (other than a 429)
+    """
+    if status_code < 400 or status_code == 429:
+        return
+    if is_transient_status(status_code):
+        raise TransientRequestError(resource_url, status_code, text)
+    if status_code in ITEM_STATUS_CODES:
+        raise ItemUnavailable(resource_url, status_code, text)
+    raise PermanentRequestError(resource_url, status_code, text)
+
+
+def backoff_delay(attempt, base_delay, max_delay):
+    """
+    Returns a random delay of up to base_delay * 2^attempt seconds (capped
+    at max_delay), so clients that failed together do not retry together
+    """
+    return random.uniform(0.0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold, open_seconds):
+        self._failure_threshold = max(1, failure_threshold)
+        self._open_seconds = open_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._open_until = None
+        self._trial_running = False
+
+    def wait_seconds(self):
+        """
+        Returns how long a request has to wait for the circuit - 0.0 when it
+        may be sent (as the trial request, if the circuit was open)
+        """
+        with self._lock:
+            if self._open_until is None:
+                return 0.0
+            remaining = self._open_until - time.time()
+            if remaining > 0.0:
+                return remaining
+            if self._trial_running:
+                return BREAKER_POLL_SECONDS
+            self._trial_running = True
+            return 0.0
+
+    def succeeded(self):
+        with self._lock:
+            self._failures = 0
+            self._open_until = None
+            self._trial_running = False
+
+    def failed(self):
+        """
+        Records a failure - returns True if it opened the circuit
+        """
+        with self._lock:
+            self._failures = self._failures + 1
+            was_trial = self._trial_running
+            self._trial_running = False
+            if was_trial or (self._open_until is None and self._failures >= self._failure_threshold):
+                self._open_until = time.time() + self._open_seconds
+                return True
+            return False
+
+
+class RetryPolicy:
+    def __init__(self, settings=None, logger=None, metrics=None):
+        settings = {**DEFAULT_RETRY_SETTINGS, **(settings or {})}
+        self._attempts = max(1, settings['attempts'])
+        self._base_delay = settings['base_delay']
+        self._max_delay = settings['max_delay']
+        self._breaker_failures = settings['breaker_failures']
+        self._breaker_seconds = settings['breaker_seconds']
+        self._logger = logger
+        self._metrics = metrics
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+    def _breaker(self, endpoint):
+        with self._lock:
+            if endpoint not in self._breakers:
+                self._breakers[endpoint] = CircuitBreaker(
+                    self._breaker_failures, self._breaker_seconds)
+            return self._breakers[endpoint]
+
+    def _increment(self, counter):
+        if self._metrics is not None:
+            self._metrics.increment(counter)
+
+    def wait_seconds(self, endpoint):
+        return self._breaker(endpoint).wait_seconds()
+
+    def wait_for_endpoint(self, endpoint):
+        """
+        Blocks while the endpoint's circuit is open
+        """
+        while True:
+            wait = self.wait_seconds(endpoint)
+            if wait <= 0.0:
+                return
+            time.sleep(wait)
+
+    def succeeded(self, endpoint):
+        self._breaker(endpoint).succeeded()
+
+    def failed(self, endpoint, attempt, error):
+        """
+        Records the failure of a request's `attempt`th attempt and returns
+        how long to wait before the next one - or raises RequestFailed if it
+        was the last
+        """
+        if attempt == 1 and self._breaker(endpoint).failed():
+            self._increment('circuit_breaker_opened')
+            if self._logger is not None:
+                self._logger.warning(
+                    f'!! {endpoint} keeps failing - pausing its requests for {self._breaker_seconds}s')
+        if attempt >= self._attempts:
+            raise RequestFailed(endpoint, attempt, error)
+        self._increment('request_retries')
+        delay = backoff_delay(attempt, self._base_delay, self._max_delay)
+        if self._logger is not None:
+            self._logger.info(
+                f'-- {endpoint} request failed ({error!r}) - retrying in {delay:.1f}s')
+        return delay
+
+    def call(self, endpoint, function):
+        """
+        Returns function(), calling it again after a backoff while it raises
+        a retryable exception
+        """
+        attempt = 0
+        while True:
+            if attempt == 0:
+                self.wait_for_endpoint(endpoint)
+            try:
+                result = function()
+            except RETRYABLE_EXCEPTIONS as e:
+                attempt = attempt + 1
+                time.sleep(self.failed(endpoint, attempt, e))
+                continue
+            except BaseException:
+                # the service answered - the error is not its failure
+                self.succeeded(endpoint)
+                raise
+            self.succeeded(endpoint)
+            return result
+
+    async def call_async(self, endpoint, function, retryable=RETRYABLE_EXCEPTIONS):
+        """
+        The asyncio version of call() - `function` returns an awaitable
+        """
+        attempt = 0
+        while True:
+            wait = self.wait_seconds(endpoint) if attempt == 0 else 0.0
+            if wait > 0.0:
+                await asyncio.sleep(wait)
+                continue
+            try:
+                result = await function()
+            except retryable as e:
+                attempt = attempt + 1
+                await asyncio.sleep(self.failed(endpoint, attempt, e))
+                continue
+            except BaseException:
+                self.succeeded(endpoint)
+                raise
+            self.succeeded(endpoint)
+            return result
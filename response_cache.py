@@ -0,0 +1,172 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from json_utils import json_dumps, json_loads
+
+RESPONSE_CACHE_FILENAME = '__response_cache.db'
+DEFAULT_CACHE_SETTINGS = {
+    'ttl_seconds': 24 * 60 * 60,
+    'max_entries': 100000
+}
+UNCACHED_PARAMS = ['api_key']
+EVICT_EVERY = 1000
+
+"""
+A persistent cache of API responses
+
+ResponseCache(cache_path, ttl_seconds, max_entries)
+
+Responses are keyed by URL and query parameters (without the API key).
+A cached response younger than `ttl_seconds` is used as-is, saving the
+API call. An older one is revalidated with If-None-Match /
+If-Modified-Since when the server gave an ETag / Last-Modified for it,
+and dropped otherwise - as is any cached response when the lookup asks to
+`revalidate` (e.g. to be sure of the latest version). Beyond `max_entries`, the least recently used
+responses are evicted.
+
+May be shared between threads.
+"""
+
+
+def cache_settings(config, output_directory):
+    """
+    Returns the response cache settings from the `response_cache` section of
+    config.json (or None if the cache is not enabled)
+    """
+    cache_config = (config or {}).get('response_cache')
+    if not cache_config:
+        return None
+    if not isinstance(cache_config, dict):
+        cache_config = {}
+    settings = {**DEFAULT_CACHE_SETTINGS, **cache_config}
+    settings.setdefault('path', os.path.join(
+        output_directory, RESPONSE_CACHE_FILENAME))
+    return settings
+
+
+def create_response_cache(config, output_directory):
+    settings = cache_settings(config, output_directory)
+    if settings is None:
+        return None
+    return ResponseCache(settings['path'], settings['ttl_seconds'], settings['max_entries'])
+
+
+def cache_key(resource_url, query_params):
+    params = sorted((str(key), str(value)) for key, value in query_params.items()
+                    if key not in UNCACHED_PARAMS)
+    # always the json module, so the keys do not depend on the JSON backend
+    return json.dumps([resource_url, params])
+
+
+class CachedResponse:
+    def __init__(self, key, data, etag, last_modified, stored_at):
+        self.key = key
+        self.data = data
+        self.etag = etag
+        self.last_modified = last_modified
+        self.stored_at = stored_at
+
+    def validation_headers(self):
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ResponseCache:
+    def __init__(self, cache_path, ttl_seconds=DEFAULT_CACHE_SETTINGS['ttl_seconds'],
+                 max_entries=DEFAULT_CACHE_SETTINGS['max_entries']):
+        cache_directory = os.path.dirname(cache_path)
+        if cache_directory and not os.path.exists(cache_directory):
+            os.makedirs(cache_directory)
+        self._ttl_seconds = ttl_seconds
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(cache_path,
+                                           check_same_thread=False,
+                                           isolation_level=None,
+                                           timeout=60)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('''CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY, body TEXT NOT NULL, etag TEXT, last_modified TEXT,
+            stored_at REAL NOT NULL, last_used REAL NOT NULL)''')
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)')
+        self.saved_calls = 0
+        self.revalidated_calls = 0
+        self._stores_since_evict = EVICT_EVERY
+
+    def lookup(self, resource_url, query_params, revalidate=False):
+        """
+        Returns (fresh cached response, None) when the cache can answer on
+        its own (and need not `revalidate`), (None, stale cached response)
+        when it can be revalidated, or (None, None)
+        """
+        key = cache_key(resource_url, query_params)
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT body, etag, last_modified, stored_at FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None, None
+        body, etag, last_modified, stored_at = row
+        cached = CachedResponse(key, json_loads(
+            body), etag, last_modified, stored_at)
+        if not revalidate and time.time() - stored_at < self._ttl_seconds:
+            self._touch(key)
+            with self._lock:
+                self.saved_calls = self.saved_calls + 1
+            return cached, None
+        if etag or last_modified:
+            return None, cached
+        if not revalidate:
+            self._delete(key)
+        return None, None
+
+    def revalidated(self, cached):
+        """
+        Marks a stale cached response as confirmed (not modified) by the server
+        """
+        now = time.time()
+        with self._lock:
+            self.revalidated_calls = self.revalidated_calls + 1
+            self._connection.execute('UPDATE responses SET stored_at = ?, last_used = ? WHERE key = ?',
+                                     (now, now, cached.key))
+
+    def store(self, resource_url, query_params, data, headers):
+        now = time.time()
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                                     (cache_key(resource_url, query_params), json_dumps(data),
+                                      headers.get('ETag'), headers.get('Last-Modified'), now, now))
+            self._stores_since_evict = self._stores_since_evict + 1
+            if self._stores_since_evict >= EVICT_EVERY:
+                self._stores_since_evict = 0
+                self._evict()
+
+    def _evict(self):
+        count = self._connection.execute(
+            'SELECT COUNT(*) FROM responses').fetchone()[0]
+        if count <= self._max_entries:
+            return
+        self._connection.execute('''DELETE FROM responses WHERE key IN (
+            SELECT key FROM responses ORDER BY last_used LIMIT ?)''', (count - self._max_entries,))
+
+    def _touch(self, key):
+        with self._lock:
+            self._connection.execute(
+                'UPDATE responses SET last_used = ? WHERE key = ?', (time.time(), key))
+
+    def _delete(self, key):
+        with self._lock:
+            self._connection.execute(
+                'DELETE FROM responses WHERE key = ?', (key,))
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
@@ -0,0 +1,127 @@
+import os
+import sqlite3
+import threading
+from json_utils import read_json_input, json_dumps, json_loads
+
+RESUME_JOURNAL_FILENAME = '__resume_info.db'
+LEGACY_RESUME_FILENAME = '__resume_info.dat'
+
+"""
+Crash-safe resume information for a docket download
+
+ResumeJournal(output_directory)
+
+A small key/value store (an embedded SQLite table in the output directory)
+that is used like the resume info dict, e.g.:
+
+    if 'docket' not in journal:
+        journal['docket'] = docket_id
+
+Every assignment is committed as it happens, so an interrupted download
+keeps all of the progress it made, and lookups only read the keys that
+are asked for. A `__resume_info.dat` file from an older download is
+imported the first time the journal is opened.
+
+May be shared between threads.
+"""
+
+
+class ResumeJournal:
+    def __init__(self, output_directory):
+        if not os.path.exists(output_directory):
+            os.makedirs(output_directory)
+        self._output_directory = output_directory
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(os.path.join(output_directory, RESUME_JOURNAL_FILENAME),
+                                           check_same_thread=False,
+                                           isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS resume_info (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self._import_legacy_resume_info()
+
+    def _import_legacy_resume_info(self):
+        legacy_file = os.path.join(
+            self._output_directory, LEGACY_RESUME_FILENAME)
+        if not os.path.exists(legacy_file):
+            return
+        legacy_info = read_json_input(legacy_file)
+        with self._lock:
+            self._connection.execute('BEGIN')
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO resume_info (key, value) VALUES (?, ?)',
+                ((key, json_dumps(value)) for key, value in legacy_info.items()))
+            self._connection.execute('COMMIT')
+        os.replace(legacy_file, f'{legacy_file}.imported')
+
+    def __contains__(self, key):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT 1 FROM resume_info WHERE key = ?', (key,)).fetchone()
+        return row is not None
+
+    def __getitem__(self, key):
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT value FROM resume_info WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return json_loads(row[0])
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO resume_info (key, value) VALUES (?, ?)',
+                                     (key, json_dumps(value)))
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._connection.execute(
+                'DELETE FROM resume_info WHERE key = ?', (key,))
+
+    def update(self, key_values):
+        """
+        Sets many keys from an iterable of (key, value) in one transaction
+        """
+        with self._lock:
+            self._connection.execute('BEGIN')
+            try:
+                self._connection.executemany('INSERT OR REPLACE INTO resume_info (key, value) VALUES (?, ?)',
+                                             ((key, json_dumps(value)) for key, value in key_values))
+            except BaseException:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
+
+    def iter_prefix(self, prefix, batch_size=1000):
+        """
+        Yields (key, value) for every key starting with the prefix, in key
+        order, reading them in batches
+        """
+        last_key = prefix
+        while True:
+            with self._lock:
+                rows = self._connection.execute(
+                    'SELECT key, value FROM resume_info WHERE key > ? AND key < ? ORDER BY key LIMIT ?',
+                    (last_key, f'{prefix}\uffff', batch_size)).fetchall()
+            if not rows:
+                return
+            for key, value in rows:
+                yield key, json_loads(value)
+            last_key = rows[-1][0]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute('DELETE FROM resume_info')
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None